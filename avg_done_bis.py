@@ -1,58 +1,53 @@
 #! /usr/bin/env python3
 from sys import exit
-from glob import glob
 import re
 import numpy as np
-from os.path import exists, splitext
-from subprocess import call
+from os.path import exists
+from avg_done_sims import seed_files, seed_weights
+import nnplan
+import impack
 
 """
 averages mulitple runs of simulations. Simulation names are assumed to be of the form a_[b_...]SD.ext.im
 SD is the integer seed, and simulations are averaged over that.
+Seeds are weighted by their NN if it was recorded for all of them (see nnplan.py).
+Spectra packed with impack.py are read from their packs.
 """
 
-files = {}
-for res in glob("*.res"):
-    parts = res.replace(".res", "").split("_")
-    sd = parts[-1]
-    start = "_".join(parts[0:-1])
-    num_summed = 0
-    for im in glob(f"{start}_{sd}.*bis"):
-        b, ext = splitext(im)
-        b = b.lstrip(f"{start}_{sd}")
-        fstart = f"{start}{b}"
-        if fstart in files:
-            files[fstart].append(im)
-        else:
-            files[fstart] = [im]
+files = seed_files([".bis"])
+nns = nnplan.job_nns()
 
 for f, specs in files.items():
     outf = f"{f}.avg.bis"
     if exists(outf):
         print(f"skipping {outf}")
         continue
+    weights = seed_weights(specs, ".bis", nns)
     num_summed = 0
+    wsum = 0.0
     for sf in specs:
-        spec = np.fromfile(sf, dtype=np.float32)
+        spec = impack.fromfile(sf, np.float32)
         # try:
         #    spec = np.fromfile(specfile, dtype=np.float32)
         # except:
         #    print(f"error reading {sf}")
         #    continue
+        w = weights[sf] if weights is not None else 1.0
         if num_summed == 0:
-            sum = spec.astype(np.float64)
+            sum = w * spec.astype(np.float64)
         else:
             if len(spec.shape) != 1 or spec.shape[0] != sum.shape[0]:
                 print(f"spectrum {f} has a different size than previous ones".Skipping)
                 continue
-            sum += spec.astype(np.float64)
+            sum += w * spec.astype(np.float64)
         num_summed += 1
+        wsum += w
     if num_summed <= 1:
         print(" summed 1 or fewer spectra for {outf}: no output generated")
     else:
         print(f"saving {outf}. summed {num_summed}")
         try:
-            (sum / num_summed).astype(np.float32).tofile(outf)
+            (sum / wsum).astype(np.float32).tofile(outf)
         except:
             print("error generating {outf}")
             exit(1)
@@ -1,66 +1,245 @@
 #! /usr/bin/env python3
 from sys import exit
-from glob import glob
-import re
-import numpy as np
-import NumpyIm as npi
-from os.path import exists, splitext
-from subprocess import call
-from runcmd import runcmd
+import json
+import os
+import imio
+import impack
+from os.path import exists
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+import click
+import nnplan
+from seedstats import RunningStats
 
 """
 averages mulitple runs of simulations. Simulation names are assumed to be of the form a_[b_...]SD.ext.im
 SD is the integer seed, and simulations are averaged over that.
+
+The average is updated incrementally. Next to the mean, {group}.avg.im, the
+sample variance over the seeds is saved in {group}.var.im and the number of
+seeds and which seeds were used in {group}.avg.json. When more seeds have
+finished, only the new seeds are read and added to the saved mean and
+variance. With --sem the standard error of the mean, {group}.sem.im, is
+also saved.
+
+When the seeds were run with different NN (see nnplan.py), the NN of each
+seed is read from the *_nn_plan.json files and the seeds are weighted by
+it, so seeds that simulated more photons count more.
+
+Seeds packed with impack.py are read from their packs.
 """
 
-files = {}
-for res in glob("*.res"):
-    parts = res.replace(".res", "").split("_")
-    sd = parts[-1]
-    start = "_".join(parts[0:-1])
-    num_summed = 0
-    for im in glob(f"{start}_{sd}.*im"):
-        b, ext = splitext(im)
-        b = b.lstrip(f"{start}_{sd}")
-        fstart = f"{start}{b}"
-        if fstart in files:
-            files[fstart].append(im)
-        else:
-            files[fstart] = [im]
-
-for f, ims in files.items():
-    print(f"{f}:{len(ims)} {ims[0]}")
-    outf = f"{f}.avg.im"
-    if exists(outf):
-        print(f"skipping {outf}")
-        continue
-    num_summed = 0
+
+def seed_files(exts, path="."):
+    """Index the outputs of finished simulations with one directory scan
+
+    Returns a dict mapping each group, {start}{suffix}, to the list of
+    files {start}_{sd}{suffix}{ext} of the seeds that have a
+    {start}_{sd}.res file, for every ext in exts (e.g. ".im"). The outputs
+    in {start}_{sd}.impack files are listed under their own names.
+    """
+    names = [e.name for e in os.scandir(path) if e.is_file()]
+    done = set(n[: -len(".res")] for n in names if n.endswith(".res"))
+    loose = set(names)
+    for name in [n for n in names if n.endswith(impack.EXT)]:
+        if name[: -len(impack.EXT)] not in done:
+            continue
+        try:
+            pack = impack.open_pack(os.path.join(path, name) if path != "." else name)
+        except impack.error as e:
+            print(e)
+            continue
+        names.extend(m for m in pack.members if m not in loose)
+    files = {}
+    for name in names:
+        ext = next((e for e in exts if name.endswith(e)), None)
+        if ext is None or "_" not in name:
+            continue
+        base, group = split_seed(name, ext)
+        if base not in done:
+            continue
+        files.setdefault(group, []).append(
+            name if path == "." else os.path.join(path, name)
+        )
+    return files
+
+
+def split_seed(name, ext):
+    """(base, group) of the seed file {start}_{sd}{suffix}{ext}"""
+    start, last = name[: -len(ext)].rsplit("_", 1)
+    sd = last.split(".", 1)[0]
+    return f"{start}_{sd}", f"{start}{last[len(sd) :]}"
+
+
+def seed_weights(ims, ext, nns):
+    """NN of each seed file from nnplan.job_nns(), or None if any is missing"""
+    weights = {}
     for im in ims:
+        base, _ = split_seed(os.path.basename(im), ext)
+        if base not in nns:
+            return None
+        weights[im] = float(nns[base])
+    return weights
+
+
+def load_state(f, weighted=False):
+    """Return (RunningStats, seed files already averaged) for group f
+
+    Returns (None, []) if nothing has been averaged yet and (None, None) if
+    there is an average without the state needed to add to it or it was
+    weighted differently.
+    """
+    outf = f"{f}.avg.im"
+    statef = f"{f}.avg.json"
+    if not exists(outf):
+        return None, []
+    if not exists(statef):
+        return None, None
+    with open(statef, "r") as fp:
+        state = json.load(fp)
+    if state.get("weights", "equal") != ("nn" if weighted else "equal"):
+        return None, None
+    n = state["n"]
+    mean = imio.read(outf)
+    var = imio.read(f"{f}.var.im") if n > 1 else None
+    stats = RunningStats.from_mean_var(n, mean, var, state.get("wsum"))
+    return stats, state["seeds"]
+
+
+def save_state(f, stats, seeds, header_file, sem=False, weighted=False):
+    outf = f"{f}.avg.im"
+    # Copy the header from a simulation output to the averaged files
+    impack.write_like(stats.mean(), outf, header_file)
+    impack.write_like(stats.var(), f"{f}.var.im", header_file)
+    if sem:
+        impack.write_like(stats.sem(), f"{f}.sem.im", header_file)
+    # the state is written last so an interrupted update is redone
+    with open(f"{f}.avg.json", "w") as fp:
+        state = dict(
+            n=stats.n,
+            seeds=sorted(seeds),
+            weights="nn" if weighted else "equal",
+            wsum=stats.wsum,
+        )
+        json.dump(state, fp, indent=1)
+
+
+def average_group(f, ims, sem=False, rebuild=False, weights=None):
+    """Add the new seeds of group f to its average
+
+    weights maps the seed files to their weights (NN); None averages them
+    with equal weights.
+    """
+    weighted = weights is not None
+    if rebuild:
+        stats, done = None, []
+    else:
+        stats, done = load_state(f, weighted)
+    if done is None:
+        print(
+            f"skipping {f}.avg.im: it has no {f}.avg.json or was averaged with "
+            f"{'equal' if weighted else 'NN'} weights. Use --rebuild to redo it"
+        )
+        return True
+    new = [im for im in ims if im not in set(done)]
+    if len(new) == 0:
+        print(f"{f}.avg.im is up to date with {len(done)} seeds")
+        return True
+    added = []
+    for im in new:
         try:
-            pix = npi.ArrayFromIm(im)
-        except npi.error as e:
-            print(f"error reading {im}")
+            pix = impack.read(im)
+        except imio.error as e:
+            print(f"error reading {im}: {e}")
             print("   skipping")
             continue
-        if num_summed == 0:
-            sum = pix.astype(np.float64)
-        else:
-            sum += pix.astype(np.float64)
-        num_summed += 1
-    if num_summed <= 1:
-        print(" summed 1 or fewer images for {outf}: no output generated")
-    else:
-        print(f"saving {outf}. summed {num_summed}")
+        if stats is None:
+            stats = RunningStats()
         try:
-            npi.ArrayToIm(sum.astype(np.float32) / num_summed, outf)
+            stats.add(pix, weight=weights[im] if weighted else 1.0)
+        except ValueError as e:
+            print(f"error adding {im}: {e}")
+            print("   skipping")
+            continue
+        added.append(im)
+    if stats is None or stats.n <= 1:
+        print(f" summed 1 or fewer images for {f}.avg.im: no output generated")
+        return True
+    print(f"saving {f}.avg.im. added {len(added)} to {len(done)} seeds")
+    try:
+        save_state(f, stats, list(done) + added, ims[0], sem=sem, weighted=weighted)
+    except (imio.error, OSError) as e:
+        print(f"error generating {f}.avg.im: {e}")
+        return False
+    return True
+
+
+def group_memory(ims):
+    """Estimate of the memory needed to average a group
+
+    The running sum and sum of squares are float64, i.e. 2 times the size
+    of a float32 input image each, and saving the mean and variance needs
+    a few more temporaries of that size. Images are read through a memmap.
+    """
+    return 8 * max(impack.getsize(im) for im in ims)
+
+
+def default_memory():
+    # half of the physical memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**31
+
 
-            # Copy the header from a simulation output to the averaged file
-            cmd = f"imgcpinfo {ims[0]} {outf}" # overwrites previous output
-            print("Running: " + cmd)
-            runcmd(cmd,1,2)
+@click.command()
+@click.option("--sem", is_flag=True, help="also save the standard error of the mean")
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    help="average all seeds again instead of adding new seeds to saved averages",
+)
+@click.option(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="maximum number of groups to average at a time (default is number of CPUs)",
+)
+@click.option(
+    "--mem-gb",
+    type=float,
+    default=None,
+    help="memory the averaging processes may use (default is half the physical memory)",
+)
+def avg_done_sims(sem, rebuild, maxproc, mem_gb):
+    files = seed_files([".im"])
+    if len(files) == 0:
+        print("no finished simulations found")
+        exit(0)
+    if maxproc is None:
+        maxproc = cpu_count()
+    if mem_gb is None:
+        mem_gb = default_memory()
+    # limit the number of processes so the largest groups fit in memory together
+    per_group = max(group_memory(ims) for ims in files.values())
+    nproc = max(1, min(maxproc, len(files), int(mem_gb * 2**30 // per_group)))
+    print(f"averaging {len(files)} groups with {nproc} processes")
+    nns = nnplan.job_nns()
+    ok = True
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        futures = {}
+        for f, ims in files.items():
+            print(f"{f}:{len(ims)} {ims[0]}")
+            weights = seed_weights(ims, ".im", nns)
+            if weights is None and len(nns) > 0:
+                print(f"    no NN recorded for some seeds of {f}: equal weights")
+            args = (f, sorted(ims), sem, rebuild, weights)
+            futures[pool.submit(average_group, *args)] = f
+        for fut in as_completed(futures):
+            try:
+                ok = fut.result() and ok
+            except Exception as e:
+                print(f"error averaging {futures[fut]}: {e}")
+                ok = False
+    exit(0 if ok else 1)
 
-        except npi.error as e:
-            print("error generating {outf}: {e}")
-            exit(1)
 
-exit(0)
+if __name__ == "__main__":
+    avg_done_sims()
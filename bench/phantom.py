@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+"""
+Synthetic NEMA style phantom and simulation directory for the benchmarks.
+
+'phantom.py DIR' writes into DIR
+
+  nema_dens.im           density map (mg/cc, uint16): a water cylinder with
+                         a lung insert along its axis
+  nemab1.im ... nemab6   source maps (uint16) of the 6 hot spheres, 37 to 10
+                         mm in diameter, on a ring around the lung insert
+  config.par             runspectsims config that runs the stub simind
+  bench.win, {rn}.isd    energy windows and emission files
+  activity.par           activity of each sphere (same concentration) and
+                         the frame duration, for post_process_simind.py
+  recon.im               an image of the spheres like a recon (128^3 or the
+                         phantom size, blurred) in counts for a calibration
+                         factor of 1 cps/MBq, for quantify.py
+
+The sizes of the images and the number of objects, radionuclides, windows,
+projection angles and score 41 components are options so the amount of
+work can be scaled from a quick check to a realistic sweep.
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the stubs only read imio's own layout (see imio.py)
+os.environ.setdefault("IMIO_NATIVE", "1")
+import imio  # noqa: E402
+
+# diameters (mm) of the NEMA IEC body phantom spheres, largest first
+SPHERE_DIAMETERS = [37, 28, 22, 17, 13, 10]
+# radionuclides of the Ac-225 decay chain and energy windows (keV)
+RADIONUCLIDES = ["ac225", "fr221", "at217", "bi213", "po213", "tl209"]
+WINDOWS = [(196, 240), (396, 484), (100, 140), (60, 80)]
+# activity concentration (MBq/mL) of the spheres
+CONCENTRATION = 0.27
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin")
+
+
+def sphere_centers(size, pixsize, n):
+    """Centers (x, y, z) in voxels of the n spheres on a 57.2 mm ring"""
+    c = (size - 1) / 2.0
+    ring = 5.72 / pixsize
+    angles = np.arange(n) * 2 * np.pi / len(SPHERE_DIAMETERS)
+    return [(c + ring * np.cos(a), c + ring * np.sin(a), c) for a in angles]
+
+
+def density_map(size, pixsize):
+    """Water cylinder (20 cm diameter, 18 cm long) with a 5 cm lung insert"""
+    c = (size - 1) / 2.0
+    z, y, x = np.ogrid[:size, :size, :size]
+    r2 = ((x - c) ** 2 + (y - c) ** 2) * pixsize**2
+    body = (r2 <= 10.0**2) & (np.abs(z - c) * pixsize <= 9.0)
+    dens = np.where(body, 1000, 0)
+    dens = np.where(body & (r2 <= 2.5**2), 300, dens)
+    return dens.astype(np.uint16)
+
+
+def source_map(size, pixsize, center, diameter_mm, value):
+    """Sphere of 'value' photons per voxel"""
+    cx, cy, cz = center
+    r = diameter_mm / 20.0 / pixsize
+    z, y, x = np.ogrid[:size, :size, :size]
+    inside = (x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2 <= r * r
+    return np.where(inside, value, 0).astype(np.uint16)
+
+
+def block_average(vol, n):
+    if vol.shape[0] == n:
+        return vol
+    f = vol.shape[0] // n
+    if f * n != vol.shape[0]:
+        # nearest voxel is good enough for a stand-in recon
+        idx = (np.arange(n) * vol.shape[0] / n).astype(int)
+        return vol[np.ix_(idx, idx, idx)]
+    return vol.reshape(n, f, n, f, n, f).mean(axis=(1, 3, 5))
+
+
+def write_config(d, nobjects, radionuclides, nn, nang, pixsize, components):
+    objects = " ".join(f"nemab{i + 1}" for i in range(nobjects))
+    with open(os.path.join(d, "config.par"), "w") as fp:
+        fp.write(
+            f"""[parms]
+collimator=SY-HE
+simind={os.path.join(BIN_DIR, "simind")}
+smc_dir={os.path.abspath(d)}/
+ewin_file=bench
+nn={nn}
+nang={nang}
+pixsize={pixsize}
+isdfile=ac225
+prefix=sim
+photon_energy=-1
+densmap=nema_dens
+smc_file=voxphan.smc
+objects={objects}
+radionuclides={" ".join(radionuclides)}
+e_low=60
+e_high=600
+score41_val={components}
+
+[isd_files]
+"""
+        )
+
+
+def make_phantom(
+    d,
+    size=192,
+    pixsize=None,
+    nobjects=6,
+    nradionuclides=6,
+    nwindows=2,
+    nang=60,
+    components=16,
+    nn=10,
+    value=20,
+    frame_duration=30.0,
+):
+    """Write the phantom and the simulation inputs to directory d"""
+    if pixsize is None:
+        # same 46 cm field of view at every size
+        pixsize = round(0.24 * 192 / size, 4)
+    os.makedirs(d, exist_ok=True)
+    rns = RADIONUCLIDES[:nradionuclides]
+    imio.write(density_map(size, pixsize), os.path.join(d, "nema_dens.im"))
+    centers = sphere_centers(size, pixsize, nobjects)
+    voxel_mL = pixsize**3
+    activities = {}
+    nrec = min(128, size)
+    recon = np.zeros((nrec, nrec, nrec), dtype=np.float32)
+    for i in range(nobjects):
+        obj = f"nemab{i + 1}"
+        src = source_map(size, pixsize, centers[i], SPHERE_DIAMETERS[i], value)
+        imio.write(src, os.path.join(d, f"{obj}.im"))
+        activities[obj] = CONCENTRATION * voxel_mL * np.count_nonzero(src)
+        # counts of a calibration factor of 1 cps/MBq
+        occ = block_average(src.astype(np.float32), nrec)
+        recon += occ * (activities[obj] * frame_duration * nang / occ.sum())
+    # resolution of a SPECT recon, about 1 cm FWHM
+    from scipy import ndimage
+
+    sigma = 1.0 / 2.355 / (pixsize * size / nrec)
+    recon = ndimage.gaussian_filter(recon, sigma)
+    # in the orientation of the attenuation maps (create_atn.py), like a
+    # recon from osemmw, so quantify has to rotate the source spheres
+    recon = np.ascontiguousarray(np.rot90(recon, k=3, axes=(1, 2)))
+    spacing = pixsize * size / nrec
+    imio.write(
+        recon,
+        os.path.join(d, "recon.im"),
+        header={"SliceThickness": str(spacing), "PixelWidth": str(spacing)},
+    )
+    with open(os.path.join(d, "activity.par"), "w") as fp:
+        for obj, a in activities.items():
+            fp.write(f"{obj} = {a:.4f}\n")
+        fp.write(f"\nframe duration = {frame_duration}\n")
+    with open(os.path.join(d, "bench.win"), "w") as fp:
+        for lo, hi in WINDOWS[:nwindows]:
+            fp.write(f"{lo},{hi},0\n")
+    for rn in rns:
+        with open(os.path.join(d, f"{rn}.isd"), "w") as fp:
+            fp.write(f"{rn} emissions\n218.0 0.114\n440.0 0.261\n")
+    write_config(d, nobjects, rns, nn, nang, pixsize, components)
+    return dict(size=size, pixsize=pixsize, objects=nobjects, radionuclides=rns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a NEMA style benchmark phantom and config to DIR"
+    )
+    parser.add_argument("dir")
+    parser.add_argument(
+        "--size", type=int, default=192, help="image size (default 192)"
+    )
+    parser.add_argument(
+        "--pixsize",
+        type=float,
+        default=None,
+        help="voxel size in cm (default 46 cm / size)",
+    )
+    parser.add_argument(
+        "--objects", type=int, default=6, help="number of spheres, 1-6 (default 6)"
+    )
+    parser.add_argument(
+        "--radionuclides",
+        type=int,
+        default=6,
+        help="number of radionuclides, 1-6 (default 6)",
+    )
+    parser.add_argument(
+        "--windows",
+        type=int,
+        default=2,
+        help="number of energy windows, 1-4 (default 2)",
+    )
+    parser.add_argument(
+        "--nang", type=int, default=60, help="number of projection angles (default 60)"
+    )
+    parser.add_argument(
+        "--components", type=int, default=16, help="score41_val (default 16)"
+    )
+    parser.add_argument(
+        "--nn", type=int, default=10, help="NN in config.par (default 10)"
+    )
+    args = parser.parse_args()
+    if not 1 <= args.objects <= len(SPHERE_DIAMETERS):
+        print(f"--objects must be 1 to {len(SPHERE_DIAMETERS)}")
+        sys.exit(1)
+    if not 1 <= args.radionuclides <= len(RADIONUCLIDES):
+        print(f"--radionuclides must be 1 to {len(RADIONUCLIDES)}")
+        sys.exit(1)
+    if not 1 <= args.windows <= len(WINDOWS):
+        print(f"--windows must be 1 to {len(WINDOWS)}")
+        sys.exit(1)
+    info = make_phantom(
+        args.dir,
+        size=args.size,
+        pixsize=args.pixsize,
+        nobjects=args.objects,
+        nradionuclides=args.radionuclides,
+        nwindows=args.windows,
+        nang=args.nang,
+        components=args.components,
+        nn=args.nn,
+    )
+    print(
+        f"wrote a {info['size']}^3 phantom with {info['objects']} spheres to {args.dir}"
+    )
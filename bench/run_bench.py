@@ -0,0 +1,446 @@
+#! /usr/bin/env python3
+"""
+Benchmark of the simulation and post-processing pipeline.
+
+'run_bench.py run' makes a phantom (phantom.py) in a work directory and runs
+the pipeline on it with the stub simind and header tools in bench/bin:
+
+  phantom       phantom.py: density and source maps, config, recon
+  simulate      runspectsims.py with the stub simind
+  average       avg_done_sims.py
+  average_bis   avg_done_bis.py
+  post_process  post_process_simind.py activity.par
+  create_atn    create_atn.py for every window
+  quantify      quantify.py --spheres on the recon
+  headers       header lookups on all the outputs, through imio and the
+                stub header tools ('run_bench.py headers DIR')
+
+Every stage is run as its own process. Its wall time and the CPU time and
+maximum RSS of it and its children (from wait4) are reported, and its
+outputs are checked. With --save-baseline FILE the results are saved and
+with --baseline FILE they are compared: a stage that is more than
+--tolerance slower (and at least --min-diff seconds) than the baseline
+of the same scale is a regression and the exit status is 1.
+
+The images are written in imio's own layout (IMIO_NATIVE=all), which the
+stub tools read directly, so by default the benchmark doesn't time the
+usual .im layout that osemmw reads. --layout default runs the stages with
+the usual layout instead: the images are written with NumpyIm (which must
+be installed) and their header fields are kept by the stub tools, which
+report the layout from the image loaded with NumpyIm. The real header
+tools and NumpyIm may be faster or slower than the stubs, so compare
+baselines of the same layout only.
+
+--scale small runs in a few seconds. --scale full is a realistic sweep
+(192^3 maps, 60 angles, 6 spheres and 6 radionuclides, thousands of files)
+and needs about 13 GB of disk in the work directory.
+"""
+
+import csv
+import importlib.util
+import json
+import os
+import platform
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from glob import glob
+import click
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import imio  # noqa: E402
+import metrics  # noqa: E402
+from runcmd import JobPool  # noqa: E402
+from phantom import WINDOWS  # noqa: E402
+
+STAGES = [
+    "phantom",
+    "simulate",
+    "average",
+    "average_bis",
+    "post_process",
+    "create_atn",
+    "quantify",
+    "headers",
+]
+
+SCALES = {
+    "small": dict(
+        size=64, nang=32, objects=3, radionuclides=2, windows=2, components=16, seeds=3
+    ),
+    "full": dict(
+        size=192, nang=60, objects=6, radionuclides=6, windows=2, components=4, seeds=2
+    ),
+}
+
+
+def script(name):
+    return shlex.quote(os.path.join(REPO_DIR, name))
+
+
+def stage_command(stage, scale, maxproc):
+    """Shell command that runs a stage in the work directory"""
+    py = shlex.quote(sys.executable)
+    if stage == "phantom":
+        return (
+            f"{py} {shlex.quote(os.path.join(BENCH_DIR, 'phantom.py'))} . "
+            f"--size {scale['size']} --nang {scale['nang']} --objects {scale['objects']} "
+            f"--radionuclides {scale['radionuclides']} --windows {scale['windows']} "
+            f"--components {scale['components']}"
+        )
+    if stage == "simulate":
+        return (
+            f"{py} {script('runspectsims.py')} config.par 1 {scale['seeds'] + 1} "
+            f"--maxproc {maxproc}"
+        )
+    if stage == "average":
+        return f"{py} {script('avg_done_sims.py')} --maxproc {maxproc}"
+    if stage == "average_bis":
+        return f"{py} {script('avg_done_bis.py')}"
+    if stage == "post_process":
+        return (
+            f"{py} {script('post_process_simind.py')} activity.par --maxproc {maxproc}"
+        )
+    if stage == "create_atn":
+        keVs = " ".join(str(sum(w) / 2) for w in WINDOWS[: scale["windows"]])
+        # there is no hu2atn stub, the maps are made from the table
+        return f"{py} {script('create_atn.py')} {keVs} --table"
+    if stage == "quantify":
+        sources = ",".join(f"nemab{i + 1}" for i in range(scale["objects"]))
+        return (
+            f"{py} {script('quantify.py')} --spheres 1 prj.nf.w01.im recon.im "
+            f"--par activity.par --sources {sources} --results quantify_results.csv"
+        )
+    if stage == "headers":
+        return f"{py} {shlex.quote(os.path.abspath(__file__))} headers ."
+    raise ValueError(f"unknown stage {stage}")
+
+
+def expected_outputs(stage, scale):
+    """(glob pattern, number of files) a successful stage leaves"""
+    jobs = scale["seeds"] * scale["objects"] * scale["radionuclides"]
+    ncomp = min(scale["components"] - 1, 16) if scale["components"] > 1 else 0
+    groups = scale["objects"] * scale["radionuclides"] * scale["windows"] * (1 + ncomp)
+    return {
+        "phantom": ("nemab*.im", scale["objects"]),
+        "simulate": ("sim_*.res", jobs),
+        "average": ("sim_*.avg.im", groups),
+        "average_bis": ("sim_*.avg.bis", scale["objects"] * scale["radionuclides"]),
+        "post_process": ("prj.n*.w??.im", 2 * scale["windows"]),
+        "create_atn": ("atn.w?.im", scale["windows"]),
+        "quantify": ("quantify_results.csv", 1),
+        "headers": (None, 0),
+    }[stage]
+
+
+def check_quantify(workdir):
+    """Error if a source sphere isn't on a hot sphere of the recon
+
+    The bench recon is rotated like an osemmw recon, so this fails if
+    quantify doesn't put the source spheres in the recon's orientation.
+    """
+    with open(os.path.join(workdir, "quantify_results.csv"), "r") as fp:
+        rows = list(csv.DictReader(fp))
+    missed = [r["name"] for r in rows if not r.get("detected_radius")]
+    if len(rows) == 0 or missed:
+        return f"source spheres not found in the recon: {', '.join(missed) or 'all'}"
+    return ""
+
+
+def run_stage(stage, workdir, scale, maxproc, env):
+    cmd = stage_command(stage, scale, maxproc)
+    log = os.path.join(workdir, f"{stage}.log")
+    pool = JobPool(maxruns=1)
+    pool.submit(f"{cmd} > {shlex.quote(log)} 2>&1", rundir=workdir, key=stage, env=env)
+    job = pool.wait_one()
+    rec = metrics.job_record(job, stage=stage, cmd=cmd)
+    pattern, n = expected_outputs(stage, scale)
+    rec["error"] = ""
+    if job.returncode != 0:
+        rec["error"] = f"exit status {job.returncode}, see {log}"
+    elif pattern is not None:
+        found = len(glob(os.path.join(workdir, pattern)))
+        if found != n:
+            rec["error"] = f"{found} {pattern} files instead of {n}, see {log}"
+        elif stage == "quantify":
+            rec["error"] = check_quantify(workdir)
+    rec["files"] = len(os.listdir(workdir))
+    return rec
+
+
+def compare(results, baseline, tolerance, min_diff):
+    """Stages that are slower than in the baseline"""
+    # baselines from before --layout are of the native layout
+    if dict({"layout": "native"}, **baseline.get("scale", {})) != results["scale"]:
+        print("the baseline was run at a different scale: not comparing")
+        return []
+    slower = []
+    for stage, rec in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None or base.get("error") or rec["error"]:
+            continue
+        if (
+            rec["wall"] > base["wall"] * (1 + tolerance)
+            and rec["wall"] - base["wall"] >= min_diff
+        ):
+            slower.append((stage, base["wall"], rec["wall"]))
+    return slower
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'stage':<13} {'wall s':>9} {'cpu s':>9} {'rss MB':>8} {'files':>7} {'baseline s':>11}"
+    )
+    for stage, r in results["stages"].items():
+        cpu = r.get("utime", 0) + r.get("stime", 0)
+        base = "-"
+        if baseline is not None and stage in baseline.get("stages", {}):
+            base = f"{baseline['stages'][stage]['wall']:.2f}"
+        print(
+            f"{stage:<13} {r['wall']:>9.2f} {cpu:>9.2f} {r.get('maxrss_mb', 0):>8.1f} "
+            f"{r['files']:>7} {base:>11}"
+            + (f"  FAILED: {r['error']}" if r["error"] else "")
+        )
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--scale", "scale_name", type=click.Choice(list(SCALES)), default="small")
+@click.option(
+    "--size", type=int, default=None, help="size of the maps (overrides --scale)"
+)
+@click.option(
+    "--nang", type=int, default=None, help="number of angles (overrides --scale)"
+)
+@click.option(
+    "--seeds",
+    type=int,
+    default=None,
+    help="number of seeds, at least 2 (overrides --scale)",
+)
+@click.option(
+    "--objects", type=int, default=None, help="number of spheres (overrides --scale)"
+)
+@click.option(
+    "--components", type=int, default=None, help="score41_val (overrides --scale)"
+)
+@click.option(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="--maxproc of the stages (default is number of CPUs)",
+)
+@click.option(
+    "--sim-delay",
+    type=float,
+    default=0.0,
+    help="seconds every stub simind run takes (default 0)",
+)
+@click.option(
+    "--sim-rate",
+    type=float,
+    default=0.0,
+    help="photons per second of the stub simind, so runs take time in proportion to their work",
+)
+@click.option(
+    "--stages",
+    default=",".join(STAGES),
+    help="comma separated stages to run (the earlier stages must have been run in --workdir)",
+)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="directory to run in (default is a new temporary directory, removed afterwards)",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(["native", "default"]),
+    default="native",
+    help="write imio's own layout (native, the default) or the usual .im layout "
+    "with NumpyIm (default)",
+)
+@click.option("--keep", is_flag=True, help="keep the temporary work directory")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), default=None)
+@click.option("--save-baseline", type=click.Path(dir_okay=False), default=None)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="fraction a stage may be slower than the baseline (default 0.25)",
+)
+@click.option(
+    "--min-diff",
+    type=float,
+    default=0.5,
+    help="seconds a stage must be slower than the baseline to count (default 0.5)",
+)
+def run(
+    scale_name,
+    size,
+    nang,
+    seeds,
+    objects,
+    components,
+    maxproc,
+    sim_delay,
+    sim_rate,
+    stages,
+    workdir,
+    layout,
+    keep,
+    baseline,
+    save_baseline,
+    tolerance,
+    min_diff,
+):
+    """Run the pipeline stages on a synthetic phantom and time them"""
+    scale = dict(SCALES[scale_name])
+    for k, v in dict(
+        size=size, nang=nang, seeds=seeds, objects=objects, components=components
+    ).items():
+        if v is not None:
+            scale[k] = v
+    if scale["seeds"] < 2:
+        print("--seeds must be at least 2 so there is something to average")
+        sys.exit(1)
+    stages = [s.strip() for s in stages.split(",")]
+    for s in stages:
+        if s not in STAGES:
+            print(f"unknown stage {s}: the stages are {', '.join(STAGES)}")
+            sys.exit(1)
+    if maxproc is None:
+        maxproc = os.cpu_count()
+    scale["maxproc"] = maxproc
+    scale["sim_delay"] = sim_delay
+    scale["sim_rate"] = sim_rate
+    scale["layout"] = layout
+    if layout == "default" and importlib.util.find_spec("NumpyIm") is None:
+        print("--layout default writes the images with NumpyIm, which isn't installed")
+        sys.exit(1)
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix="simbench.")
+    os.makedirs(workdir, exist_ok=True)
+    workdir = os.path.abspath(workdir)
+    print(f"running {', '.join(stages)} in {workdir}")
+    print(", ".join(f"{k}={v}" for k, v in scale.items()))
+
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(BENCH_DIR, "bin") + os.pathsep + env.get("PATH", "")
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    env["SIMIND_STUB_DELAY"] = str(sim_delay)
+    env["SIMIND_STUB_RATE"] = str(sim_rate)
+    # imio's own layout, also for the osemmw inputs, or the usual .im layout
+    env["IMIO_NATIVE"] = "all" if layout == "native" else "0"
+
+    results = dict(
+        scale=scale,
+        host=platform.node(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        date=time.strftime("%Y-%m-%d %H:%M:%S"),
+        stages={},
+    )
+    ok = True
+    for stage in stages:
+        rec = run_stage(stage, workdir, scale, maxproc, env)
+        results["stages"][stage] = rec
+        print(
+            f"{stage}: {rec['wall']:.2f} s"
+            + (f" FAILED: {rec['error']}" if rec["error"] else "")
+        )
+        if rec["error"]:
+            ok = False
+            break
+
+    base = None
+    if baseline is not None:
+        with open(baseline, "r") as fp:
+            base = json.load(fp)
+    print()
+    print_results(results, base)
+    if base is not None:
+        slower = compare(results, base, tolerance, min_diff)
+        for stage, b, t in slower:
+            print(
+                f"regression: {stage} took {t:.2f} s, {t / b - 1:.0%} more than the baseline {b:.2f} s"
+            )
+        ok = ok and len(slower) == 0
+    if save_baseline is not None:
+        with open(save_baseline, "w") as fp:
+            json.dump(results, fp, indent=1)
+        print(f"saved the results to {save_baseline}")
+    if temporary and not keep:
+        shutil.rmtree(workdir)
+    elif temporary:
+        print(f"kept {workdir}")
+    sys.exit(0 if ok else 1)
+
+
+@cli.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--key", default="Number of Projections", help="field to look up")
+@click.option(
+    "--tools",
+    type=int,
+    default=20,
+    help="number of files read through the header tools",
+)
+def headers(directory, key, tools):
+    """Time header lookups on the simulation outputs in DIRECTORY
+
+    The fields of every sim_*.im are looked up twice through imio (the second
+    time from its cache). Then the same lookups are done for files without
+    an imio header, which imio reads with the header tools.
+    """
+    ims = sorted(glob(os.path.join(directory, "sim_*.im")))
+    if len(ims) == 0:
+        print(f"no sim_*.im in {directory}")
+        sys.exit(1)
+    for what in ["cold", "cached"]:
+        t = time.perf_counter()
+        missing = sum(imio.get_field(f, key) is None for f in ims)
+        t = time.perf_counter() - t
+        print(
+            f"{len(ims)} imio headers ({what}): {t:.3f} s, {1e6 * t / len(ims):.0f} us/file"
+        )
+        if missing:
+            print(f"{missing} files have no {key}")
+            sys.exit(1)
+    # raw files with their fields in a .hdr file, read by the stub header tools
+    tooldir = os.path.join(directory, "tool_headers")
+    os.makedirs(tooldir, exist_ok=True)
+    raws = []
+    for i, f in enumerate(ims[:tools]):
+        raw = os.path.join(tooldir, f"raw{i}.im")
+        with open(raw, "wb") as fp:
+            fp.write(b"\0" * 1024)
+        with open(raw + ".hdr", "w") as fp:
+            for k, v in imio.read_header(f).items():
+                fp.write(f"{k}\t{v}\n")
+        raws.append(raw)
+    for what in ["cold", "cached"]:
+        t = time.perf_counter()
+        missing = sum(imio.get_field(f, key) is None for f in raws)
+        t = time.perf_counter() - t
+        print(
+            f"{len(raws)} tool headers ({what}): {t:.3f} s, {1e3 * t / len(raws):.1f} ms/file"
+        )
+        if missing:
+            print(f"{missing} files have no {key}")
+            sys.exit(1)
+    shutil.rmtree(tooldir)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,101 +1,206 @@
 #! /usr/bin/env python3
-from os.path import exists
-from sys import exit, argv
+import argparse
+import configparser
+import os
+from functools import lru_cache
+from os.path import exists, islink
+from sys import exit
 from glob import glob
 import numpy as np
-import NumpyIm as npi
-from runcmd import runcmd
-
-# Ensure a keV was input by the user
-if len(argv) < 2:
-    print("Usage: create_atn.py keV [keV 2] ... [keV n]")
-    print("Uses SIMIND density map to make attenuation maps (downsampled to 128x128x128 if needed) at the desired keVs")
-    exit(1)
-
-# Make a list of keVs from user input
-keVs = []
-for i in range(1,len(argv)):
-    keVs.append(float(argv[i]))
-
-# Check if SIMIND density map exists
-dens_map_txt = "*dens*.im"
-dens_map_files = glob(dens_map_txt)
-if len(dens_map_files) < 1:
-    print("No density map found")
-    exit(1)
-elif len(dens_map_files) > 1:
-    print("More than one density map found, using " + dens_map_files[0])
-
-# Load density map
-dens_map_file = dens_map_files[0]
-pix = npi.ArrayFromIm(dens_map_file)
-
-# Check if there is only water and air
-mask = (pix != 0) & (pix != 1000)
-has_other_values = np.any(mask)
-if has_other_values:
-    print("Script doesn't handle all densities in the image")
-    exit(1)
-
-# Convert density map to CT
-pix[pix == 0] = -1000 # convert air
-pix[pix == 1000] = 0 # convert water
-
-# Rotate CT -90 degrees about Z axis
-pix = np.rot90(pix, k=3, axes=(1, 2))
-
-# Save CT as .im
-npi.ArrayToIm(pix.astype(np.float32), "ct.im")
-
-# Reduce CT to 128x128x128 if necessary
-shape = pix.shape
-x_factor = shape[2] / 128
-y_factor = shape[1] / 128
-z_factor = shape[0] / 128
-
-if shape[0] != 128 or shape[1] != 128 or shape[2] != 128:
-    print("Downsampling CT")
-    if exists("ct_128.im"):
-        print("Removing previous ct_128.im")
-        cmd = "rm ct_128.im"
-        print("Running: " + cmd)
-        runcmd(cmd,1)
-
-    cmd = f"collapse3d -a {x_factor} {y_factor} {z_factor} ct.im ct_128.im" # average the collapse, not sum, since it's not activity units
-    print("Running: " + cmd)
-    runcmd(cmd,1)
-
-    ct_name = "ct_128.im"
-else:
-    print("No downsampling needed")
-    ct_name = "ct.im"
-
-# Create attenuation map from CT for each keV
-i = 0
-for keV in keVs:
-    i += 1
-    cmd = f"./hu2atn -e {keV} -s 0.48 {ct_name} atn.w{i}.im"
-    print("Running: " + cmd)
-    runcmd(cmd,1)
-
-    # Update pixel spacing rows and columns in header
-    cmd = f"imsetinfo -i \"Pixel Spacing Rows\" \"4.8\" -i \"Pixel Spacing Cols\" \"4.8\" -i \"Slices Spacing\" \"-4.8\" -i \"Modality\" \"CT\" atn.w{i}.im"
-    print("Running: " + cmd)
-    runcmd(cmd,1)
-
-# Create symbolic links
-if exists("atn.w1i1.im"):
-    cmd = "rm atn.w1i1.im"
-    print("Running: " + cmd)
-    runcmd(cmd,1)
-cmd = "ln -s atn.w1.im atn.w1i1.im"
-print("Running: " + cmd)
-runcmd(cmd,1)
-
-if exists("atn.w1i2.im"):
-    cmd = "rm atn.w1i2.im"
-    print("Running: " + cmd)
-    runcmd(cmd,1)
-cmd = "ln -s atn.w1.im atn.w1i2.im"
-print("Running: " + cmd)
-runcmd(cmd,1)
+import imio
+from runcmd import runcmd, waitall
+
+# Mass attenuation coefficients (cm^2/g, total with coherent scattering)
+# from the NIST XCOM / X-ray mass attenuation tables. Bone is ICRU-44
+# cortical bone.
+MU_ENERGIES_KEV = np.array([10, 15, 20, 30, 40, 50, 60, 80, 100, 150, 200,
+                            300, 400, 500, 600, 800, 1000, 1250, 1500, 2000], dtype=np.float64)
+MU_RHO = {
+    "air": [5.120, 1.614, 0.7779, 0.3538, 0.2485, 0.2080, 0.1875, 0.1662, 0.1541, 0.1356,
+            0.1233, 0.1067, 0.09549, 0.08712, 0.08055, 0.07074, 0.06358, 0.05687, 0.05175, 0.04447],
+    "water": [5.329, 1.673, 0.8096, 0.3756, 0.2683, 0.2269, 0.2059, 0.1837, 0.1707, 0.1505,
+              0.1370, 0.1186, 0.1061, 0.09687, 0.08956, 0.07865, 0.07072, 0.06323, 0.05754, 0.04942],
+    "bone": [28.51, 9.032, 4.001, 1.331, 0.6655, 0.4242, 0.3148, 0.2229, 0.1855, 0.1480,
+             0.1309, 0.1113, 0.09908, 0.09022, 0.08332, 0.07308, 0.06566, 0.05871, 0.05346, 0.04607],
+}
+# materials the density map is split into: voxels with a density of at least
+# the bone threshold are bone, other voxels water (air has a density of 0)
+MATERIALS = ["water", "bone"]
+
+@lru_cache(maxsize=None)
+def mu_table(keVs):
+    """(energy, material) table of mass attenuation coefficients (cm^2/g)
+
+    keVs is a tuple of energies. The NIST values are interpolated log-log.
+    """
+    for keV in keVs:
+        if keV < MU_ENERGIES_KEV[0] or keV > MU_ENERGIES_KEV[-1]:
+            raise ValueError(f"{keV} keV is outside the attenuation table "
+                             f"({MU_ENERGIES_KEV[0]:g}-{MU_ENERGIES_KEV[-1]:g} keV)")
+    logE = np.log(MU_ENERGIES_KEV)
+    table = np.empty((len(keVs), len(MATERIALS)))
+    for m, material in enumerate(MATERIALS):
+        table[:, m] = np.exp(np.interp(np.log(keVs), logE, np.log(MU_RHO[material])))
+    return table
+
+def average_matrix(n_in, n_out):
+    """(n_out, n_in) matrix that averages input voxels into output voxels
+
+    Non-integer factors split the border voxels by their overlap.
+    """
+    edges = np.arange(n_out + 1) * (n_in / n_out)
+    lo = np.maximum(edges[:-1, np.newaxis], np.arange(n_in)[np.newaxis, :])
+    hi = np.minimum(edges[1:, np.newaxis], np.arange(1, n_in + 1)[np.newaxis, :])
+    m = np.maximum(hi - lo, 0.0)
+    return m / m.sum(axis=1, keepdims=True)
+
+def block_average(vol, shape):
+    """Average a 3D array down to 'shape'"""
+    if vol.shape == tuple(shape):
+        return vol
+    if all(n % s == 0 for n, s in zip(vol.shape, shape, strict=True)):
+        f = [n // s for n, s in zip(vol.shape, shape, strict=True)]
+        return vol.reshape(shape[0], f[0], shape[1], f[1], shape[2], f[2]).mean(axis=(1, 3, 5))
+    Z, Y, X = [average_matrix(n, s) for n, s in zip(vol.shape, shape, strict=True)]
+    return np.einsum("az,zyx,by,cx->abc", Z, vol, Y, X, optimize=True)
+
+def material_densities(dens, bone_threshold, shape):
+    """Density (g/cc) of each material averaged to 'shape'
+
+    dens is the SIMIND density map in mg/cc. Returns a (material, z, y, x)
+    array so the attenuation map at any energy is a linear combination.
+    """
+    rho = np.asarray(dens, dtype=np.float32) / 1000.0
+    bone = rho >= bone_threshold
+    out = np.empty((len(MATERIALS),) + tuple(shape), dtype=np.float64)
+    out[MATERIALS.index("water")] = block_average(np.where(bone, 0, rho), shape)
+    out[MATERIALS.index("bone")] = block_average(np.where(bone, rho, 0), shape)
+    return out
+
+def default_pixsize():
+    # pixel size of the simulation from config.par, if there is one
+    if not exists("config.par"):
+        return None
+    parser = configparser.ConfigParser(inline_comment_prefixes=("#",))
+    parser.read("config.par")
+    try:
+        return parser.getfloat("parms", "pixsize")
+    except (configparser.Error, ValueError):
+        return None
+
+def write_ct(dens, shape):
+    """Write the density map as a CT (HU) of 'shape' for hu2atn
+
+    The density (mg/cc) is converted with HU = density - 1000, so air is
+    -1000 and water 0, and averaged down to 'shape'. Returns the file name.
+    """
+    hu = block_average(np.asarray(dens, dtype=np.float32) - 1000.0, shape)
+    ct_name = "ct.im" if shape == dens.shape else f"ct_{shape[2]}.im"
+    print(f"Saving {ct_name}")
+    # hu2atn reads it, so it is written in the usual .im layout
+    imio.write(hu, ct_name, header={"Modality": "CT"}, dtype=np.float32,
+               native=imio.RECON_NATIVE)
+    return ct_name
+
+def replace_link(target, link):
+    if exists(link) or islink(link):
+        print(f"Removing previous {link}")
+        os.unlink(link)
+    print(f"Linking {link} to {target}")
+    os.symlink(target, link)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Uses SIMIND density map to make attenuation maps (downsampled to 128x128x128 "
+                    "if needed) at the desired keVs. By default the density map is converted to a "
+                    "CT and the maps are made with hu2atn; with --table they are made in-process "
+                    "from NIST mass attenuation coefficients, treating voxels with a density of at "
+                    "least the bone threshold as bone and other voxels as water, in 1/cm.")
+    parser.add_argument("keVs", type=float, nargs="+", metavar="keV", help="energies of the maps, atn.w1.im, atn.w2.im, ...")
+    parser.add_argument("--density", default=None, help="density map (default *dens*.im)")
+    parser.add_argument("--hu2atn", default="./hu2atn", help="hu2atn program (default ./hu2atn)")
+    parser.add_argument("--table", action="store_true",
+                        help="make the maps from the built-in attenuation table instead of hu2atn")
+    parser.add_argument("--bone-threshold", type=float, default=1.2,
+                        help="density (g/cc) at and above which voxels are bone with --table (default 1.2)")
+    parser.add_argument("--size", type=int, default=128, help="size of the maps (default 128)")
+    parser.add_argument("--pixsize", type=float, default=None,
+                        help="voxel size (cm) of the density map (default pixsize from config.par)")
+    args = parser.parse_args()
+
+    # Check if SIMIND density map exists
+    if args.density is not None:
+        dens_map_file = args.density
+    else:
+        dens_map_txt = "*dens*.im"
+        dens_map_files = glob(dens_map_txt)
+        if len(dens_map_files) < 1:
+            print("No density map found")
+            exit(1)
+        elif len(dens_map_files) > 1:
+            print("More than one density map found, using " + dens_map_files[0])
+        dens_map_file = dens_map_files[0]
+
+    pixsize = args.pixsize if args.pixsize is not None else default_pixsize()
+    if pixsize is None:
+        print("No pixsize in config.par: use --pixsize")
+        exit(1)
+    if args.table:
+        try:
+            table = mu_table(tuple(args.keVs))
+        except ValueError as e:
+            print(e)
+            exit(1)
+
+    # Load density map
+    try:
+        dens = imio.read(dens_map_file)
+    except imio.error as e:
+        print(e)
+        exit(1)
+    if dens.min() < 0:
+        print(f"{dens_map_file} has negative densities")
+        exit(1)
+
+    # Rotate -90 degrees about Z axis
+    dens = np.rot90(dens, k=3, axes=(1, 2))
+
+    # Reduce to size^3 if necessary
+    shape = tuple(min(args.size, n) for n in dens.shape)
+    if shape != dens.shape:
+        print(f"Downsampling {dens.shape} to {shape}")
+    else:
+        print("No downsampling needed")
+    spacing = pixsize * dens.shape[2] / shape[2]
+    fields = {"Pixel Spacing Rows": spacing * 10, "Pixel Spacing Cols": spacing * 10,
+              "Slices Spacing": -spacing * 10, "Modality": "CT"}
+
+    if args.table:
+        # Create attenuation map for each keV: mu (1/cm) = sum over materials
+        # of rho (g/cc) * mu/rho (cm^2/g); e.g. water at 140 keV is 0.154/cm
+        rho = material_densities(dens, args.bone_threshold, shape)
+        for i, keV in enumerate(args.keVs, 1):
+            atn = np.einsum("m,mzyx->zyx", table[i - 1], rho)
+            print(f"Saving atn.w{i}.im for {keV} keV")
+            # osemmw reads it, so it is written in the usual .im layout
+            imio.write(atn, f"atn.w{i}.im", header={k: str(v) for k, v in fields.items()},
+                       dtype=np.float32, native=imio.RECON_NATIVE)
+    else:
+        # Create attenuation map from CT for each keV with hu2atn
+        ct_name = write_ct(dens, shape)
+        for i, keV in enumerate(args.keVs, 1):
+            cmd = f"{args.hu2atn} -e {keV} -s {spacing:g} {ct_name} atn.w{i}.im"
+            print("Running: " + cmd)
+            runcmd(cmd, 1)
+        waitall()
+        for i in range(1, len(args.keVs) + 1):
+            if not exists(f"atn.w{i}.im"):
+                print(f"hu2atn didn't write atn.w{i}.im")
+                exit(1)
+            # Update pixel spacing rows and columns in header
+            print(f"Setting pixel spacing and modality of atn.w{i}.im")
+            imio.set_fields(f"atn.w{i}.im", fields)
+
+    # Create symbolic links
+    replace_link("atn.w1.im", "atn.w1i1.im")
+    replace_link("atn.w1.im", "atn.w1i2.im")
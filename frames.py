@@ -0,0 +1,121 @@
+"""
+Frame tables for dynamic studies.
+
+A frame table is a text file with one row per frame. The first line that
+isn't a comment names the columns, e.g.
+
+    # a 3 frame study: activities in MBq, times in seconds
+    start  duration  liver  tumor  ac225:kidney
+    0      60        10     2      1.5
+    60     60        9      2.5    1.4
+    120    120       8      3      1.2
+
+duration is required. start is optional; without it frames follow each
+other starting at 0. The other columns are the activity (MBq) of a VOI
+during the frame, for all radionuclides, or of one radionuclide in a VOI
+when the column is named rn:voi (e.g. for daughters of Ac-225 that are
+not in equilibrium).
+
+Instead of activities, the activities can come from a time-activity curve
+file with the same layout and a time column (s) instead of start and
+duration. The activity of a frame is then the average of the linearly
+interpolated curve over the frame.
+"""
+
+import re
+import numpy as np
+
+
+class error(Exception):
+    pass
+
+
+def read_table(path):
+    """Return (column names, rows of floats) of a whitespace separated table"""
+    names = None
+    rows = []
+    try:
+        fp = open(path, "r")
+    except OSError as e:
+        raise error(f"error reading {path}: {e}") from e
+    with fp:
+        for n, line in enumerate(fp, 1):
+            line = re.sub("#.*", "", line).strip()
+            if len(line) == 0:
+                continue
+            if names is None:
+                names = line.split()
+                continue
+            values = line.split()
+            if len(values) != len(names):
+                raise error(
+                    f"{path}:{n}: expected {len(names)} values, got {len(values)}"
+                )
+            try:
+                rows.append([float(v) for v in values])
+            except ValueError as e:
+                raise error(f"{path}:{n}: {e}") from e
+    if names is None or len(rows) == 0:
+        raise error(f"{path} has no frames")
+    return names, np.array(rows, dtype=np.float64)
+
+
+def read_frames(path):
+    """Return (start, duration, activities) of the frames in a frame table
+
+    start and duration are arrays in seconds and activities is a dict
+    mapping a column name (voi or rn:voi) to an array of MBq per frame.
+    """
+    names, rows = read_table(path)
+    cols = dict(zip(names, rows.T, strict=True))
+    if "duration" not in cols:
+        raise error(f"{path} has no duration column")
+    duration = cols.pop("duration")
+    if np.any(duration <= 0):
+        raise error(f"{path}: frame durations must be > 0")
+    if "start" in cols:
+        start = cols.pop("start")
+    else:
+        start = np.concatenate([[0.0], np.cumsum(duration)[:-1]])
+    return start, duration, cols
+
+
+def tac_activities(path, start, duration):
+    """Average activity of each frame from a time-activity curve file"""
+    names, rows = read_table(path)
+    cols = dict(zip(names, rows.T, strict=True))
+    if "time" not in cols:
+        raise error(f"{path} has no time column")
+    t = cols.pop("time")
+    order = np.argsort(t)
+    t = t[order]
+    out = {}
+    for name, a in cols.items():
+        a = a[order]
+        act = np.empty(len(start))
+        for f, (t0, dt) in enumerate(zip(start, duration, strict=True)):
+            # integrate the piecewise linear curve exactly
+            knots = np.concatenate([[t0], t[(t > t0) & (t < t0 + dt)], [t0 + dt]])
+            y = np.interp(knots, t, a)
+            act[f] = np.sum((y[1:] + y[:-1]) * np.diff(knots)) / (2 * dt)
+        out[name] = act
+    return out
+
+
+def frame_weights(activities, duration, rns, vois):
+    """(frame, rn, voi) array of MBq * s for every frame
+
+    Uses the rn:voi column if there is one, otherwise the voi column.
+    """
+    w = np.zeros((len(duration), len(rns), len(vois)))
+    missing = []
+    for r, rn in enumerate(rns):
+        for v, voi in enumerate(vois):
+            act = activities.get(f"{rn}:{voi}", activities.get(voi))
+            if act is None:
+                missing.append(f"{rn}:{voi}")
+                continue
+            w[:, r, v] = act * duration
+    if len(missing) > 0:
+        raise error(f"no activity for {', '.join(missing)}")
+    return w
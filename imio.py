@@ -0,0 +1,610 @@
+"""
+Reading and writing .im images without loading them into memory.
+
+Images are written in the .im layout that osemmw, NumpyIm and the image
+tools (header, imghdr, imgcpinfo, imsetinfo, collapse, addnoise) read:
+the pixels are written with NumpyIm and the header fields are set with
+the tools.
+
+Reading an .im file doesn't load it. The layout the header gives is
+taken from the fields 'header -i' reports (LAYOUT_KEYS: the dimensions
+from fastest to slowest, the pixel type and the byte order). The pixels
+are taken to be stored in C order (slowest index first, e.g. z, y, x for
+a volume or angle, row, column for projections) at the end of the file,
+after a header of the file size minus the size of the pixels. That isn't
+assumed: the first file of each layout (header size, shape and pixel type)
+a process reads is also loaded with NumpyIm, and files of that layout are
+only memory mapped if the two agree. Files whose header doesn't give the
+layout, or whose layout didn't check out, are loaded with NumpyIm.
+
+In the same way ImWriter streams the pixels to a temporary file and has
+NumpyIm write the image from a memory map of it. Once two images of the
+same shape and pixel type written by NumpyIm are the NumpyIm header
+followed by exactly the pixels written, and the two headers are the same,
+that header is kept and later images of that shape and type are written
+directly as the header followed by the pixels, without NumpyIm.
+
+Setting IMIO_NATIVE=1 in the environment writes a simpler layout of
+imio's own instead, for tools that only use imio (the benchmark in bench/
+and its stub tools): a text header that starts with the line IM_MAGIC,
+has one "key<TAB>value" line per field and ends with a form feed, padded
+with NULs to a multiple of IM_BLOCK bytes, followed by the pixels. osemmw,
+NumpyIm and the image tools can't read these files, so it is off by
+default, and the osemmw inputs (projections and attenuation maps, written
+with native=RECON_NATIVE) stay in the usual layout unless IMIO_NATIVE=all.
+Files in either layout are read.
+
+ImFile(path).pixels() returns a read-only numpy memmap of the pixels, so
+only the parts of the image that are used are read, and slabs() iterates
+over it in chunks along the first axis. ImWriter writes an image one chunk
+along the first axis at a time, so the image is never held in memory by
+imio (NumpyIm may hold it while it writes the first images of a shape).
+
+read_header, get_field, set_fields, copy_header and write_like read and
+change header fields (Pixel Size, SliceThickness, Actual Frame Duration,
+Modality, ...). The header of an imio file is read and written in-process.
+The .im header isn't decoded here, so for .im files the tools are still
+run: 'header -i' once per file (the fields are cached until the file
+changes, so later reads of the same file don't run it again), imsetinfo
+for set_fields and imgcpinfo for copy_header.
+"""
+
+import os
+import shutil
+import subprocess
+import numpy as np
+
+IM_MAGIC = "IMHEADER"
+IM_BLOCK = 512
+HEADER_END = "\f"
+
+# set IMIO_NATIVE=1 to write imio's own layout, which only imio reads, and
+# IMIO_NATIVE=all to also write the osemmw inputs in it
+NATIVE = os.environ.get("IMIO_NATIVE", "0") in ("1", "all")
+RECON_NATIVE = os.environ.get("IMIO_NATIVE", "0") == "all"
+
+
+class error(Exception):
+    pass
+
+
+def _npi():
+    # NumpyIm is only needed for files without an imio header
+    try:
+        import NumpyIm
+    except ImportError:
+        raise error("NumpyIm is needed to read or write this image but isn't installed") from None
+    return NumpyIm
+
+
+def parse_header(data):
+    """Parse the header at the start of 'data' (bytes)
+
+    Returns (fields, offset of the pixels) or (None, 0) if data does not
+    start with an imio header.
+    """
+    magic = (IM_MAGIC + "\n").encode("ascii")
+    if not data.startswith(magic):
+        return None, 0
+    end = data.find(HEADER_END.encode("ascii"))
+    if end < 0:
+        raise error("header is not terminated")
+    fields = {}
+    for line in data[len(magic) : end].decode("latin-1").split("\n"):
+        if len(line) == 0:
+            continue
+        key, _, value = line.partition("\t")
+        fields[key] = value
+    offset = -(-(end + 1) // IM_BLOCK) * IM_BLOCK
+    return fields, offset
+
+
+def format_header(fields):
+    """Return the header for 'fields' as bytes, padded to IM_BLOCK"""
+    lines = [IM_MAGIC]
+    for key, value in fields.items():
+        if "\t" in key or "\n" in key or "\n" in str(value):
+            raise error(f"header field {key!r} can't contain tabs or newlines")
+        lines.append(f"{key}\t{value}")
+    text = ("\n".join(lines) + "\n" + HEADER_END).encode("latin-1")
+    return text + b"\0" * (-len(text) % IM_BLOCK)
+
+
+def read_native_header(path):
+    """Return (fields, pixel offset) of an .im file or (None, 0) if it
+    doesn't have an imio header"""
+    magic = IM_MAGIC.encode("ascii")
+    try:
+        with open(path, "rb") as fp:
+            head = fp.read(IM_BLOCK)
+            if head.startswith(magic):
+                # the header can be longer than one block
+                while head.find(HEADER_END.encode("ascii")) < 0:
+                    more = fp.read(IM_BLOCK)
+                    if len(more) == 0:
+                        raise error(f"{path}: header is not terminated")
+                    head += more
+    except OSError as e:
+        raise error(f"error reading {path}: {e}") from e
+    return parse_header(head)
+
+
+def image_fields(shape, dtype, fields=None):
+    """Header fields for an image with the given shape and pixel type
+
+    Fields from 'fields' are kept except the ones describing the layout.
+    """
+    dtype = np.dtype(dtype)
+    out = {
+        "Dimensions": " ".join(str(n) for n in reversed(shape)),
+        "Pixel Type": dtype.newbyteorder("=").name,
+        "Byte Order": "big" if dtype.byteorder == ">" else "little",
+    }
+    if fields is not None:
+        for key, value in fields.items():
+            if key not in out:
+                out[key] = value
+    return out
+
+
+# whether the pixels of files of a layout, (header size, shape, pixel type),
+# were found where im_layout() puts them
+_layouts = {}
+# NumpyIm's header for a (shape, pixel type), once two writes agreed on it,
+# and the first header seen
+_writer_headers = {}
+_first_headers = {}
+
+
+def _layout_key(shape, dtype, offset):
+    return offset, tuple(shape), np.dtype(dtype).str
+
+
+def _check_layout(path, layout, pix):
+    """True if the pixels NumpyIm read from path are where layout puts them"""
+    shape, dtype, offset = layout
+    if tuple(pix.shape) != tuple(shape):
+        return False
+    mapped = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return bool(np.array_equal(mapped, pix))
+
+
+def _same_bytes(path, offset, raw):
+    """True if path holds exactly the bytes of the file raw from offset on"""
+    if os.path.getsize(path) - offset != os.path.getsize(raw):
+        return False
+    with open(path, "rb") as a, open(raw, "rb") as b:
+        a.seek(offset)
+        while True:
+            x = a.read(16 * 2**20)
+            if x != b.read(16 * 2**20):
+                return False
+            if len(x) == 0:
+                return True
+
+
+def _learn_header(path, raw, shape, dtype):
+    """Keep NumpyIm's header for (shape, dtype) if path is it plus raw"""
+    key = (tuple(shape), np.dtype(dtype).str)
+    offset = os.path.getsize(path) - os.path.getsize(raw)
+    if offset < 0 or not _same_bytes(path, offset, raw):
+        return
+    with open(path, "rb") as fp:
+        head = fp.read(offset)
+    if _first_headers.get(key) == head:
+        _writer_headers[key] = head
+        _layouts[_layout_key(shape, dtype, offset)] = True
+    else:
+        _first_headers[key] = head
+
+
+class ImFile:
+    """An .im file opened for reading
+
+    Attributes:
+      path: file name
+      header: dict of the header fields (empty for NumpyIm-only files)
+      shape, dtype: shape (slowest first) and pixel type of the image
+      offset: byte offset of the pixels in the file
+      native: True if the file has an imio header (IMIO_NATIVE=1 layout);
+        the pixels of other files are memory mapped if their header gives
+        the layout (see im_layout) and loaded with NumpyIm if it doesn't
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._array = None
+        fields, offset = read_native_header(path)
+        if fields is not None:
+            self.native = True
+            self.header = fields
+            self.offset = offset
+            try:
+                self.shape = tuple(
+                    int(n) for n in reversed(fields["Dimensions"].split())
+                )
+                dtype = np.dtype(fields["Pixel Type"])
+            except (KeyError, TypeError, ValueError) as e:
+                raise error(f"{path}: bad image header: {e}") from e
+            self.dtype = dtype.newbyteorder(
+                ">" if fields.get("Byte Order", "little") == "big" else "<"
+            )
+            expected = self.offset + int(np.prod(self.shape)) * self.dtype.itemsize
+            if os.path.getsize(path) < expected:
+                raise error(f"{path} is shorter than its header says")
+        else:
+            self.native = False
+            self.header = {}
+            layout = im_layout(path)
+            if layout is not None and _layouts.get(_layout_key(*layout)):
+                self.shape, self.dtype, self.offset = layout
+                return
+            self.offset = 0
+            npi = _npi()
+            try:
+                self._array = npi.ArrayFromIm(path)
+            except npi.error as e:
+                raise error(f"error reading {path}: {e}") from e
+            self.shape = self._array.shape
+            self.dtype = self._array.dtype
+            if layout is not None and _layout_key(*layout) not in _layouts:
+                _layouts[_layout_key(*layout)] = _check_layout(
+                    path, layout, self._array
+                )
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def pixels(self, mode="r"):
+        """The pixels as a numpy memmap ('r' or 'r+') or array"""
+        if self._array is not None:
+            return self._array
+        return np.memmap(
+            self.path, dtype=self.dtype, mode=mode, offset=self.offset, shape=self.shape
+        )
+
+    def slabs(self, size=None, max_bytes=64 * 2**20):
+        """Iterate over (start, stop, pixels[start:stop]) along the first axis
+
+        If size is None each slab is at most max_bytes long.
+        """
+        pix = self.pixels()
+        n = self.shape[0]
+        if size is None:
+            per = max(1, self.nbytes // max(n, 1))
+            size = max(1, max_bytes // per)
+        for i in range(0, n, size):
+            yield i, min(i + size, n), pix[i : i + size]
+
+
+def read(path):
+    """Return the pixels of an .im file as a read-only memmap (or array)"""
+    return ImFile(path).pixels()
+
+
+class ImWriter:
+    """Write an .im file one chunk along the first axis at a time
+
+    with ImWriter(path, shape, np.float32, header) as w:
+        for slab in ...:
+            w.write(slab)
+
+    'header' is a dict of extra header fields (e.g. copied from another
+    image's ImFile.header). The chunks are written to a temporary file as
+    they come. In the default layout the image is then written from it with
+    NumpyIm (or the header NumpyIm writes for this shape and type, once it
+    is known, followed by the pixels) when it is complete and the fields are
+    set with imsetinfo. With IMIO_NATIVE=1 the temporary file gets an imio
+    header and is renamed when it is complete.
+    'native' overrides IMIO_NATIVE (RECON_NATIVE for files osemmw reads).
+    """
+
+    def __init__(self, path, shape, dtype=np.float32, header=None, native=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fields = image_fields(self.shape, self.dtype, header)
+        self.done = 0
+        self.tmp = f"{path}.{os.getpid()}.tmp"
+        self.native = NATIVE if native is None else native
+        # the pixels without a header in the default layout
+        self.raw = self.tmp if self.native else f"{path}.{os.getpid()}.raw"
+        self.fp = open(self.raw, "wb")
+        if self.native:
+            self.fp.write(format_header(self.fields))
+
+    def write(self, chunk):
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        if chunk.ndim == len(self.shape) - 1:
+            chunk = chunk[np.newaxis]
+        if chunk.shape[1:] != self.shape[1:]:
+            raise error(f"chunk shape {chunk.shape} doesn't fit image {self.shape}")
+        if self.done + chunk.shape[0] > self.shape[0]:
+            raise error(f"too many slices written to {self.path}")
+        self.fp.write(np.ascontiguousarray(chunk).tobytes())
+        self.done += chunk.shape[0]
+
+    def close(self):
+        if self.done != self.shape[0]:
+            self.abort()
+            raise error(
+                f"{self.path}: only {self.done} of {self.shape[0]} slices were written"
+            )
+        self.fp.close()
+        self.fp = None
+        if self.native:
+            os.replace(self.tmp, self.path)
+            return
+        try:
+            head = _writer_headers.get((self.shape, self.dtype.str))
+            if head is not None:
+                with open(self.raw, "rb") as src, open(self.tmp, "wb") as dst:
+                    dst.write(head)
+                    shutil.copyfileobj(src, dst, 16 * 2**20)
+                os.replace(self.tmp, self.path)
+            else:
+                self._write_numpyim()
+        finally:
+            for f in [self.raw, self.tmp]:
+                if os.path.exists(f):
+                    os.unlink(f)
+        # the header fields other than the layout are set with imsetinfo
+        set_fields(self.path, self.fields)
+
+    def _write_numpyim(self):
+        npi = _npi()
+        if os.path.getsize(self.raw) == 0:
+            pix = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            pix = np.memmap(self.raw, dtype=self.dtype, mode="r", shape=self.shape)
+        try:
+            npi.ArrayToIm(pix, self.path)
+        except npi.error as e:
+            raise error(f"error writing {self.path}: {e}") from e
+        del pix
+        _learn_header(self.path, self.raw, self.shape, self.dtype)
+
+    def abort(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        for f in [self.raw, self.tmp]:
+            if os.path.exists(f):
+                os.unlink(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def write(pix, path, header=None, dtype=None, native=None):
+    """Write the array 'pix' to an .im file"""
+    pix = np.asarray(pix)
+    if dtype is None:
+        dtype = pix.dtype
+    with ImWriter(path, pix.shape, dtype, header, native) as w:
+        for i in range(0, max(pix.shape[0], 1), 64):
+            w.write(pix[i : i + 64])
+
+
+# Header fields
+#
+# The header of a file is read once and kept in memory until the file's
+# mtime or size changes, so repeated lookups don't reread the file. Files
+# without an imio header are read with 'header -i' (and fields it doesn't
+# list with 'imghdr -i'), and changed with imgcpinfo and imsetinfo; their
+# results are cached the same way.
+
+# fields that describe the pixel layout and can't be set or copied
+LAYOUT_FIELDS = ("Dimensions", "Pixel Type", "Byte Order")
+
+# other names the same field is stored under
+ALIASES = {
+    "SliceThickness": ["Slice Thickness"],
+    "PixelWidth": ["Pixel Width"],
+    "Actual Frame Duration": ["ActualFrameDuration"],
+    "Number of Projections": ["NumberOfProjections"],
+}
+
+_headers = {}
+_fields = {}
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        raise error(f"error reading {path}: {e}") from e
+    return st.st_mtime_ns, st.st_size
+
+
+def _tool_output(cmd):
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode("latin-1")
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise error(f"error running {cmd[0]}: {e}") from e
+
+
+def _cached_header(path):
+    """(native, fields) of path; fields must not be changed"""
+    stamp = _stamp(path)
+    cached = _headers.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1], cached[2]
+    fields, _ = read_native_header(path)
+    native = fields is not None
+    if not native:
+        fields = {}
+        for line in _tool_output(["header", "-i", path]).strip().split("\n"):
+            key, _, value = line.partition("\t")
+            if len(value) > 0:
+                fields[key.strip().rstrip(":")] = value.strip()
+    _headers[path] = (stamp, native, fields)
+    return native, fields
+
+
+def read_header(path):
+    """Return a dict of the header fields of an image"""
+    return dict(_cached_header(path)[1])
+
+
+# fields of 'header -i' that give the pixel layout of an .im file
+LAYOUT_KEYS = {
+    "dims": ["Dimensions", "Image Dimensions", "Matrix Size"],
+    "type": ["Pixel Type", "Data Type", "Pixel Format"],
+    "order": ["Byte Order", "Endian"],
+}
+
+# C names of pixel types; numpy reads "float" and "int" as 64 bit types
+C_TYPES = {
+    "float": "float32",
+    "double": "float64",
+    "short": "int16",
+    "unsigned short": "uint16",
+    "int": "int32",
+    "unsigned int": "uint32",
+    "char": "int8",
+    "unsigned char": "uint8",
+    "byte": "uint8",
+}
+
+
+def im_layout(path):
+    """(shape, dtype, offset) of the pixels of an .im file from its header
+
+    Returns None if the header fields don't give the layout or it doesn't
+    fit the file size.
+    """
+    try:
+        _, fields = _cached_header(path)
+    except error:
+        return None
+
+    def field(key):
+        for k in LAYOUT_KEYS[key]:
+            if k in fields:
+                return fields[k]
+        return None
+
+    dims, ptype = field("dims"), field("type")
+    if dims is None or ptype is None:
+        return None
+    try:
+        shape = tuple(int(n) for n in reversed(dims.replace("x", " ").split()))
+        ptype = ptype.strip().lower()
+        dtype = np.dtype(C_TYPES.get(ptype, ptype))
+    except (TypeError, ValueError):
+        return None
+    if (
+        len(shape) == 0
+        or min(shape) < 1
+        or dtype.kind not in "uif"
+        or (ptype not in C_TYPES and not any(c.isdigit() for c in ptype))
+    ):
+        return None
+    order = (field("order") or "little").strip().lower()
+    dtype = dtype.newbyteorder(">" if order.startswith("big") else "<")
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    offset = os.path.getsize(path) - nbytes
+    if offset < 0:
+        return None
+    return shape, dtype, offset
+
+
+def get_field(path, key, default=None):
+    """Return the value (a string) of a header field or default"""
+    native, fields = _cached_header(path)
+    for k in [key] + ALIASES.get(key, []):
+        if k in fields:
+            return fields[k]
+    if native:
+        return default
+    # imghdr also knows fields 'header -i' doesn't list
+    stamp = _stamp(path)
+    cached = _fields.get((path, key))
+    if cached is None or cached[0] != stamp:
+        try:
+            value = _tool_output(["imghdr", "-i", key, path]).strip()
+        except error:
+            value = ""
+        cached = (stamp, value)
+        _fields[(path, key)] = cached
+    return cached[1] if len(cached[1]) > 0 else default
+
+
+def _forget(path):
+    _headers.pop(path, None)
+    for k in [k for k in _fields if k[0] == path]:
+        del _fields[k]
+
+
+def set_fields(path, fields):
+    """Set header fields of an image
+
+    The header of an imio file is rewritten in place if it still fits in
+    front of the pixels, otherwise the file is rewritten. The fields of an
+    .im file are set with one imsetinfo run.
+    """
+    fields = dict((k, str(v)) for k, v in fields.items() if k not in LAYOUT_FIELDS)
+    if len(fields) == 0:
+        return
+    native, old = _cached_header(path)
+    _forget(path)
+    if not native:
+        cmd = ["imsetinfo"]
+        for k, v in fields.items():
+            cmd += ["-i", k, v]
+        if subprocess.call(cmd + [path]) != 0:
+            raise error(f"imsetinfo failed for {path}")
+        return
+    _, offset = read_native_header(path)
+    new = dict(old)
+    new.update(fields)
+    head = format_header(new)
+    if len(head) == offset:
+        with open(path, "r+b") as fp:
+            fp.write(head)
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(path, "rb") as src, open(tmp, "wb") as dst:
+        dst.write(head)
+        src.seek(offset)
+        shutil.copyfileobj(src, dst, 16 * 2**20)
+    os.replace(tmp, path)
+
+
+def copy_header(src, dst, fields=None):
+    """Copy the header fields of src (and set 'fields') to the image dst
+
+    For an .im dst this runs imgcpinfo (and imsetinfo if there are fields).
+    """
+    if not _cached_header(dst)[0]:
+        _forget(dst)
+        if subprocess.call(["imgcpinfo", src, dst]) != 0:
+            raise error(f"imgcpinfo failed for {src} {dst}")
+        if fields:
+            set_fields(dst, fields)
+        return
+    new = read_header(src)
+    if fields is not None:
+        new.update(fields)
+    set_fields(dst, new)
+
+
+def write_like(pix, path, header_file, fields=None, dtype=np.float32, native=None):
+    """Write pix to path with the header of header_file plus 'fields'"""
+    if not (NATIVE if native is None else native):
+        write(pix, path, dtype=dtype, native=False)
+        copy_header(header_file, path, fields)
+        return
+    header = read_header(header_file)
+    if fields is not None:
+        header.update((k, str(v)) for k, v in fields.items())
+    write(pix, path, header=header, dtype=dtype, native=True)
@@ -0,0 +1,629 @@
+#! /usr/bin/env python3
+"""
+One container file per simulation job instead of tens of small files.
+
+With score41_val=16 a job writes 16 component images per window besides
+the total projection, the spectrum, the attenuation map and the log. On a
+shared filesystem creating, listing and opening that many files is slower
+than reading them. 'impack.py pack' gathers the outputs of a finished job,
+{base}.*, into {base}.impack and removes them; {base}.res is kept since it
+marks the job as finished. 'impack.py unpack' restores the files.
+
+An .impack file is the magic line IMPACK_MAGIC, the data of the members, a
+JSON index and a trailer with the offset and length of the index. The
+index lists every member with its name, window and score 41 component
+(for {base}.wNN[.{comp}].im) and the offset, stored length and raw length
+of its chunks. Every file is stored as its bytes, so unpacking restores it
+byte for byte. For images the index also has the header fields, shape,
+pixel type and pixel offset that imio.ImFile found, and the bytes are split
+into the header and chunks of about CHUNK_BYTES of whole rows along the
+first axis, so the pixels are read from the pack without decoding the file
+again. Images whose header doesn't give the layout (see imio.im_layout)
+are decoded from a temporary copy when they are read. With --level 1..9
+each chunk is zlib compressed (chunks that don't get smaller are stored as
+they are); with --level 0 nothing is compressed and the pixels are read in
+place.
+
+avg_done_sims.py, avg_done_bis.py and post_process_simind.py read packed
+outputs by their original names through open_image(), read(), fromfile(),
+read_header() and get_field(). A pack is opened once, memory mapped and
+closed, so reading every member of a job takes one open; processes forked
+after that share the mapping.
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import zlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import escape, glob
+from multiprocessing import cpu_count
+from sys import exit
+
+import click
+import numpy as np
+
+import imio
+
+IMPACK_MAGIC = b"IMPACK2\n"
+# offset and length of the index at the end of the file
+TRAILER = struct.Struct("<8sQQ")
+TRAILER_MAGIC = b"IMPINDEX"
+EXT = ".impack"
+CHUNK_BYTES = 4 * 2**20
+
+# {base}.wNN.im and {base}.wNN.{comp}.im
+MEMBER_RE = re.compile(r"\.w(\d+)(?:\.(\w+))?\.im$")
+
+
+class error(imio.error):
+    pass
+
+
+def pack_file(base):
+    return base + EXT
+
+
+def job_files(base):
+    """Outputs of the job {base} (without the pack itself)"""
+    return sorted(
+        f
+        for f in glob(escape(base) + ".*")
+        if not f.endswith(EXT) and not f.endswith(".tmp") and os.path.isfile(f)
+    )
+
+
+class PackedImage:
+    """An image in a pack, with the attributes of imio.ImFile"""
+
+    def __init__(self, pack, name, entry):
+        self.path = name
+        self.pack = pack
+        self.entry = entry
+        self.header = entry["header"]
+        self.shape = tuple(entry["shape"])
+        self.dtype = np.dtype(entry["dtype"])
+        self.offset = entry["offset"]
+        self.native = False
+        self._array = None
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def _pixel_chunks(self):
+        return self.entry["chunks"][self.entry["pixels"] :]
+
+    def _rows(self, chunk):
+        data = self.pack.chunk(chunk)
+        n = chunk[2] // max(1, self.nbytes // max(self.shape[0], 1))
+        return np.frombuffer(data, dtype=self.dtype).reshape((n,) + self.shape[1:])
+
+    def _decoded(self):
+        # the layout isn't known: read a temporary copy of the file
+        if self._array is None:
+            fd, tmp = tempfile.mkstemp(suffix=".im")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(self.pack.read_bytes(os.path.basename(self.path)))
+                self._array = np.array(imio.ImFile(tmp).pixels())
+            finally:
+                os.unlink(tmp)
+            self._array.flags.writeable = False
+        return self._array
+
+    def pixels(self, mode="r"):
+        """The pixels as a read-only array (a view of the pack if it isn't
+        compressed)"""
+        if mode != "r":
+            raise error(
+                f"{self.path} is packed in {self.pack.path}: it can't be changed"
+            )
+        if self.offset is None:
+            return self._decoded()
+        chunks = self._pixel_chunks
+        if all(not c[3] for c in chunks) and len(chunks) > 0:
+            # stored as is and one after the other
+            return np.ndarray(
+                self.shape, dtype=self.dtype, buffer=self.pack.map, offset=chunks[0][0]
+            )
+        pix = np.empty(self.shape, dtype=self.dtype)
+        i = 0
+        for c in chunks:
+            rows = self._rows(c)
+            pix[i : i + rows.shape[0]] = rows
+            i += rows.shape[0]
+        pix.flags.writeable = False
+        return pix
+
+    def slabs(self, size=None, max_bytes=64 * 2**20):
+        """Iterate over (start, stop, pixels[start:stop]) along the first axis"""
+        if (
+            size is not None
+            or self.offset is None
+            or not any(c[3] for c in self._pixel_chunks)
+        ):
+            pix = self.pixels()
+            n = self.shape[0]
+            if size is None:
+                per = max(1, self.nbytes // max(n, 1))
+                size = max(1, max_bytes // per)
+            for i in range(0, n, size):
+                yield i, min(i + size, n), pix[i : i + size]
+            return
+        # one chunk at a time so only one is decompressed
+        i = 0
+        for c in self._pixel_chunks:
+            rows = self._rows(c)
+            yield i, i + rows.shape[0], rows
+            i += rows.shape[0]
+
+
+class Pack:
+    """An .impack file opened for reading
+
+    Attributes:
+      path: file name
+      base: job base name the members start with
+      members: dict of the index entries by member name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "rb") as fp:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise error(f"error reading {path}: {e}") from e
+        if self.map[: len(IMPACK_MAGIC)] != IMPACK_MAGIC or len(self.map) < (
+            len(IMPACK_MAGIC) + TRAILER.size
+        ):
+            raise error(f"{path} is not an impack file")
+        magic, offset, length = TRAILER.unpack(self.map[-TRAILER.size :])
+        if magic != TRAILER_MAGIC or offset + length > len(self.map) - TRAILER.size:
+            raise error(f"{path}: the index is missing or damaged")
+        try:
+            index = json.loads(self.map[offset : offset + length].decode("utf-8"))
+        except ValueError as e:
+            raise error(f"{path}: bad index: {e}") from e
+        self.base = index["base"]
+        self.level = index.get("level", 0)
+        self.members = {m["name"]: m for m in index["members"]}
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def names(self, window=None, component=None):
+        """Member names, optionally of one window and component ('total' is
+        the total projection)"""
+        return [
+            n
+            for n, m in self.members.items()
+            if (window is None or m.get("window") == window)
+            and (component is None or m.get("component") == component)
+        ]
+
+    def chunk(self, c):
+        offset, stored, raw, compressed = c
+        data = self.map[offset : offset + stored]
+        if compressed:
+            data = zlib.decompress(data)
+        if len(data) != raw:
+            raise error(f"{self.path}: chunk at {offset} is damaged")
+        return data
+
+    def image(self, name):
+        entry = self.members[name]
+        if entry["kind"] != "image":
+            raise error(f"{name} in {self.path} is not an image")
+        return PackedImage(self, name, entry)
+
+    def read_bytes(self, name):
+        return b"".join(self.chunk(c) for c in self.members[name]["chunks"])
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # arrays still use the mapping; it is closed when they are freed
+            pass
+
+
+# open packs by path and the pack of every member seen so far; a pack is
+# opened (and mapped) once per process
+_packs = {}
+_members = {}
+
+
+def open_pack(path):
+    """The Pack for path, opened once and cached"""
+    pack = _packs.get(path)
+    if pack is not None:
+        return pack
+    pack = Pack(path)
+    _packs[path] = pack
+    d = os.path.dirname(path)
+    for name in pack.members:
+        _members[os.path.join(d, name)] = path
+    return pack
+
+
+def _forget(path):
+    pack = _packs.pop(path, None)
+    if pack is None:
+        return
+    for name in [n for n, p in _members.items() if p == path]:
+        del _members[name]
+
+
+def find(name):
+    """The Pack that holds the file 'name', or None if it isn't packed
+
+    A file that exists isn't looked up in packs. The pack of a job output
+    {base}{suffix} is {base}.impack, tried for every '.' in the name.
+    """
+    path = _members.get(name)
+    if path is not None:
+        return _packs[path]
+    if os.path.exists(name):
+        return None
+    d, b = os.path.split(name)
+    for i in [m.start() for m in re.finditer(r"\.", b)]:
+        cand = os.path.join(d, b[:i] + EXT)
+        if cand in _packs or os.path.exists(cand):
+            pack = open_pack(cand)
+            if b in pack:
+                return pack
+    return None
+
+
+def source(name):
+    """The file name holds the contents of name: its pack or name itself"""
+    pack = find(name)
+    return name if pack is None else pack.path
+
+
+def open_image(name):
+    """imio.ImFile for name, or a PackedImage if name is packed"""
+    pack = find(name)
+    if pack is None:
+        return imio.ImFile(name)
+    return pack.image(os.path.basename(name))
+
+
+def read(name):
+    """The pixels of the image name (see imio.read)"""
+    return open_image(name).pixels()
+
+
+def fromfile(name, dtype):
+    """np.fromfile() of name, also for a packed file"""
+    pack = find(name)
+    if pack is None:
+        return np.fromfile(name, dtype=dtype)
+    return np.frombuffer(pack.read_bytes(os.path.basename(name)), dtype=dtype).copy()
+
+
+def getsize(name):
+    pack = find(name)
+    if pack is None:
+        return os.path.getsize(name)
+    return sum(c[2] for c in pack.members[os.path.basename(name)]["chunks"])
+
+
+def read_header(name):
+    """Header fields of the image name (see imio.read_header)"""
+    pack = find(name)
+    if pack is None:
+        return imio.read_header(name)
+    fields = pack.members[os.path.basename(name)]["header"]
+    return {k: v for k, v in fields.items() if k not in imio.LAYOUT_FIELDS}
+
+
+def get_field(name, key, default=None):
+    """Value of a header field of the image name (see imio.get_field)"""
+    if find(name) is None:
+        return imio.get_field(name, key, default)
+    fields = read_header(name)
+    for k in [key] + imio.ALIASES.get(key, []):
+        if k in fields:
+            return fields[k]
+    return default
+
+
+def write_like(pix, path, header_file, fields=None, dtype=np.float32, native=None):
+    """imio.write_like() with a header_file that can be packed"""
+    if find(header_file) is None:
+        imio.write_like(pix, path, header_file, fields, dtype, native)
+        return
+    header = read_header(header_file)
+    if fields is not None:
+        header.update((k, str(v)) for k, v in fields.items())
+    imio.write(pix, path, header=header, dtype=dtype, native=native)
+
+
+def _chunks(fp, data, level):
+    """Write data (bytes) in one chunk and return its index entry"""
+    raw = len(data)
+    compressed = False
+    if level > 0:
+        z = zlib.compress(data, level)
+        if len(z) < raw:
+            data = z
+            compressed = True
+    offset = fp.tell()
+    fp.write(data)
+    return [offset, len(data), raw, compressed]
+
+
+def _member(name, base):
+    entry = {"name": name, "window": None, "component": None}
+    m = MEMBER_RE.search(name[len(base) :])
+    if m is not None:
+        entry["window"] = int(m.group(1))
+        entry["component"] = m.group(2) or "total"
+    return entry
+
+
+def _write_file(fp, entry, src, size, level, chunk_bytes, start=0):
+    """Store the bytes of src from start to size in chunks of chunk_bytes"""
+    src.seek(start)
+    for i in range(start, max(size, start + 1), chunk_bytes):
+        data = src.read(min(chunk_bytes, size - i))
+        entry["chunks"].append(_chunks(fp, data, level))
+
+
+def _write_image(fp, entry, im, level, chunk_bytes):
+    """Store the bytes of the image im, the pixels in chunks of whole rows"""
+    header = dict(im.header) if im.native else imio.read_header(im.path)
+    entry.update(
+        kind="image",
+        header=imio.image_fields(im.shape, im.dtype, header),
+        shape=list(im.shape),
+        dtype=im.dtype.str,
+        chunks=[],
+        offset=None,
+        pixels=0,
+    )
+    size = os.path.getsize(im.path)
+    with open(im.path, "rb") as src:
+        if not isinstance(im.pixels(), np.memmap):
+            # loaded with NumpyIm: the pixels are decoded when they are read
+            _write_file(fp, entry, src, size, level, chunk_bytes)
+            return
+        entry["offset"] = im.offset
+        if im.offset > 0:
+            entry["chunks"].append(_chunks(fp, src.read(im.offset), level))
+            entry["pixels"] = 1
+        per = max(1, im.nbytes // max(im.shape[0], 1))
+        step = per * max(1, chunk_bytes // per)
+        _write_file(fp, entry, src, size, level, step, start=im.offset)
+
+
+def pack(base, level=1, keep=False, chunk_bytes=CHUNK_BYTES):
+    """Pack the outputs of the job base into {base}.impack
+
+    Members already in the pack are kept unless a file of the same name
+    replaces them. The packed files are removed unless keep is set;
+    {base}.res stays in place. Returns the number of files packed.
+    """
+    if not os.path.exists(f"{base}.res"):
+        raise error(f"{base}.res doesn't exist: {base} hasn't finished")
+    path = pack_file(base)
+    files = job_files(base)
+    old = None
+    if os.path.exists(path):
+        if files == [f"{base}.res"]:
+            return 0
+        _forget(path)
+        old = Pack(path)
+    loose = set(os.path.basename(f) for f in files)
+    name0 = os.path.basename(base)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    index = {"version": 2, "base": name0, "level": level, "members": []}
+    try:
+        with open(tmp, "wb") as fp:
+            fp.write(IMPACK_MAGIC)
+            for f in files:
+                name = os.path.basename(f)
+                entry = _member(name, name0)
+                im = None
+                if name.endswith(".im"):
+                    try:
+                        im = imio.ImFile(f)
+                    except imio.error:
+                        im = None
+                if im is not None:
+                    _write_image(fp, entry, im, level, chunk_bytes)
+                else:
+                    entry.update(kind="file", chunks=[])
+                    with open(f, "rb") as src:
+                        _write_file(
+                            fp, entry, src, os.path.getsize(f), level, chunk_bytes
+                        )
+                index["members"].append(entry)
+            if old is not None:
+                # copy the members that aren't replaced as they are stored
+                for name, m in old.members.items():
+                    if name in loose:
+                        continue
+                    m = dict(m)
+                    chunks = []
+                    for c in m["chunks"]:
+                        offset = fp.tell()
+                        fp.write(old.map[c[0] : c[0] + c[1]])
+                        chunks.append([offset] + list(c[1:]))
+                    m["chunks"] = chunks
+                    index["members"].append(m)
+            offset = fp.tell()
+            data = json.dumps(index).encode("utf-8")
+            fp.write(data)
+            fp.write(TRAILER.pack(TRAILER_MAGIC, offset, len(data)))
+    except (OSError, imio.error):
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(tmp, path)
+    if not keep:
+        for f in files:
+            if f != f"{base}.res":
+                os.unlink(f)
+    return len(files)
+
+
+def unpack(path, keep=False, overwrite=False):
+    """Write the members of the pack path back as files, byte for byte
+
+    Files that exist are left alone unless overwrite is set. The pack is
+    removed unless keep is set. Returns the number of files written.
+    """
+    d = os.path.dirname(path)
+    _forget(path)
+    p = Pack(path)
+    n = 0
+    try:
+        for name, m in p.members.items():
+            f = os.path.join(d, name)
+            if os.path.exists(f) and not overwrite:
+                continue
+            tmp = f"{f}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as fp:
+                for c in m["chunks"]:
+                    fp.write(p.chunk(c))
+            os.replace(tmp, f)
+            n += 1
+    finally:
+        p.close()
+    if not keep:
+        os.unlink(path)
+    return n
+
+
+def finished_jobs(path="."):
+    """Base names of the finished jobs in path that have outputs to pack"""
+    names = [e.name for e in os.scandir(path) if e.is_file()]
+    done = set(n[: -len(".res")] for n in names if n.endswith(".res"))
+    bases = set()
+    for n in names:
+        if n.endswith(".res") or n.endswith(EXT) or n.endswith(".tmp"):
+            continue
+        parts = n.split(".")
+        for i in range(1, len(parts)):
+            if ".".join(parts[:i]) in done:
+                bases.add(".".join(parts[:i]))
+                break
+    return sorted(b if path == "." else os.path.join(path, b) for b in bases)
+
+
+def run_all(func, items, maxproc, what):
+    ok = True
+    with ProcessPoolExecutor(max_workers=max(1, min(maxproc, len(items)))) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for fut in as_completed(futures):
+            item = futures[fut]
+            try:
+                n = fut.result()
+            except (OSError, imio.error) as e:
+                print(f"error {what} {item}: {e}")
+                ok = False
+                continue
+            print(f"{what} {item}: {n} files")
+    return ok
+
+
+@click.group()
+def cli():
+    """Pack simulation outputs into one file per job and unpack them"""
+
+
+@cli.command("pack")
+@click.option(
+    "--level",
+    type=click.IntRange(0, 9),
+    default=1,
+    help="zlib compression level, 0 for none (default 1)",
+)
+@click.option("--keep", is_flag=True, help="keep the packed files")
+@click.option(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="maximum number of jobs to pack at a time (default is number of CPUs)",
+)
+@click.argument("bases", nargs=-1)
+def pack_cmd(level, keep, maxproc, bases):
+    """Pack the outputs of the jobs BASES (default every finished job)"""
+    if len(bases) == 0:
+        bases = finished_jobs()
+    if len(bases) == 0:
+        print("no finished jobs to pack")
+        exit(0)
+    ok = run_all(
+        partial(pack, level=level, keep=keep),
+        list(bases),
+        maxproc or cpu_count(),
+        "packing",
+    )
+    exit(0 if ok else 1)
+
+
+@cli.command("unpack")
+@click.option("--keep", is_flag=True, help="keep the packs")
+@click.option("--overwrite", is_flag=True, help="overwrite files that exist")
+@click.option(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="maximum number of packs to unpack at a time (default is number of CPUs)",
+)
+@click.argument("packs", nargs=-1)
+def unpack_cmd(keep, overwrite, maxproc, packs):
+    """Restore the files in PACKS (default every *.impack file)"""
+    if len(packs) == 0:
+        packs = sorted(glob("*" + EXT))
+    if len(packs) == 0:
+        print("no packs found")
+        exit(0)
+    ok = run_all(
+        partial(unpack, keep=keep, overwrite=overwrite),
+        list(packs),
+        maxproc or cpu_count(),
+        "unpacking",
+    )
+    exit(0 if ok else 1)
+
+
+@cli.command("list")
+@click.argument("packs", nargs=-1, required=True)
+def list_cmd(packs):
+    """Print the index of PACKS"""
+    for path in packs:
+        try:
+            p = Pack(path)
+        except error as e:
+            print(e)
+            exit(1)
+        stored = raw = 0
+        for name, m in p.members.items():
+            s = sum(c[1] for c in m["chunks"])
+            r = sum(c[2] for c in m["chunks"])
+            stored += s
+            raw += r
+            where = ""
+            if m.get("window") is not None:
+                where = f"w{m['window']:02d} {m['component']}"
+            print(f"{name:40s} {where:16s} {r:12d} {s:12d}")
+        print(f"{path}: {len(p.members)} files, {raw} bytes stored in {stored}")
+        p.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+"""
+SQLite database with the state of every simulation job of a sweep.
+
+runspectsims.py records each job (key is the output base name) with its
+simind options and command, its state (pending, running, done, failed),
+the host and pid that ran it, start and end times, exit code and the
+output files it produced. This is used to resume a sweep and to answer
+"what's left" without looking for .log/.res files:
+
+    jobdb.py status sim_jobs.db
+    jobdb.py reset --failed sim_jobs.db
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+import click
+
+STATES = ["pending", "running", "done", "failed"]
+
+SCHEMA = """
+create table if not exists jobs (
+    key text primary key,
+    rn text,
+    obj text,
+    seed integer,
+    nn integer,
+    opts text,
+    cmd text,
+    state text not null default 'pending',
+    host text,
+    pid integer,
+    started real,
+    ended real,
+    exit_code integer,
+    outputs text
+)
+"""
+
+
+class JobDB:
+    def __init__(self, path):
+        self.path = path
+        # several processes (e.g. runspectsims and jobdb.py status) may use the
+        # database at the same time, so wait for locks rather than fail
+        self.con = sqlite3.connect(path, timeout=60)
+        self.con.row_factory = sqlite3.Row
+        with self.con:
+            self.con.execute(SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def get(self, key):
+        return self.con.execute("select * from jobs where key=?", (key,)).fetchone()
+
+    def add(
+        self, key, rn=None, obj=None, seed=None, nn=None, opts=None, state="pending"
+    ):
+        """Add a job if it is not already in the database. Returns its state"""
+        with self.con:
+            self.con.execute(
+                "insert or ignore into jobs (key, rn, obj, seed, nn, opts, state) "
+                "values (?, ?, ?, ?, ?, ?, ?)",
+                (key, rn, obj, seed, nn, opts, state),
+            )
+            # the options can change (e.g. a different NN) for jobs not yet run
+            self.con.execute(
+                "update jobs set opts=?, nn=? where key=? and state='pending'",
+                (opts, nn, key),
+            )
+        return self.get(key)["state"]
+
+    def start(self, key, cmd, pid=None, start=None):
+        with self.con:
+            self.con.execute(
+                "update jobs set state='running', cmd=?, host=?, pid=?, started=?, "
+                "ended=null, exit_code=null where key=?",
+                (cmd, socket.gethostname(), pid, start or time.time(), key),
+            )
+
+    def finish(self, key, exit_code, start=None, end=None, outputs=None):
+        state = "done" if exit_code == 0 else "failed"
+        with self.con:
+            self.con.execute(
+                "update jobs set state=?, exit_code=?, started=coalesce(?, started), "
+                "ended=?, outputs=? where key=?",
+                (
+                    state,
+                    exit_code,
+                    start,
+                    end or time.time(),
+                    json.dumps(outputs or []),
+                    key,
+                ),
+            )
+
+    def reset(self, failed=False, stale=True):
+        """Set failed jobs and/or stale running jobs back to pending
+
+        A running job is stale if it was started on this host by a process
+        that no longer exists. Returns the number of reset jobs.
+        """
+        n = 0
+        with self.con:
+            if failed:
+                n += self.con.execute(
+                    "update jobs set state='pending' where state='failed'"
+                ).rowcount
+            if stale:
+                host = socket.gethostname()
+                rows = self.con.execute(
+                    "select key, pid from jobs where state='running' and host=?",
+                    (host,),
+                ).fetchall()
+                for row in rows:
+                    if row["pid"] is not None and pid_alive(row["pid"]):
+                        continue
+                    self.con.execute(
+                        "update jobs set state='pending' where key=?", (row["key"],)
+                    )
+                    n += 1
+        return n
+
+    def counts(self):
+        counts = {s: 0 for s in STATES}
+        for row in self.con.execute("select state, count(*) from jobs group by state"):
+            counts[row[0]] = row[1]
+        return counts
+
+    def keys(self, states):
+        marks = ",".join("?" * len(states))
+        return [
+            row[0]
+            for row in self.con.execute(
+                f"select key from jobs where state in ({marks}) order by key", states
+            )
+        ]
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--list", "list_left", is_flag=True, help="list the jobs that are not done"
+)
+@click.argument("dbfile", type=click.Path(exists=True, dir_okay=False))
+def status(dbfile, list_left):
+    """Print the number of jobs in each state"""
+    db = JobDB(dbfile)
+    counts = db.counts()
+    for s in STATES:
+        print(f"{s}: {counts[s]}")
+    if list_left:
+        for state in ["pending", "running", "failed"]:
+            for key in db.keys([state]):
+                print(f"{state}\t{key}")
+
+
+@cli.command()
+@click.option("--failed", is_flag=True, help="also reset jobs that failed")
+@click.argument("dbfile", type=click.Path(exists=True, dir_okay=False))
+def reset(dbfile, failed):
+    """Set stale running jobs (and optionally failed jobs) back to pending"""
+    db = JobDB(dbfile)
+    n = db.reset(failed=failed)
+    print(f"reset {n} jobs to pending")
+
+
+if __name__ == "__main__":
+    cli()
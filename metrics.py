@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+"""
+Resource use of the jobs of a sweep.
+
+runspectsims.py (and run_osemmw.py) append one JSON line per finished job
+to a metrics file, by default {prefix}_metrics.jsonl. A record has the job
+key (e.g. rn, obj, seed, nn, nang), when it was queued, started and ended,
+its wall time, user and system CPU time and maximum RSS from the rusage
+of wait4(), its exit status and the host. runspectsims also records the
+number of photons simulated, NN times the counts in the source map, and
+the number of jobs it ran at a time (maxproc).
+
+    metrics.py summary sim_metrics.jsonl
+
+reports the photons per CPU second by radionuclide and object, the time
+jobs waited to be started and how busy the cores were over the sweep.
+"""
+
+import json
+import socket
+from collections import defaultdict
+from sys import exit
+import numpy as np
+import click
+
+
+def job_record(job, **fields):
+    """Metrics record of a finished runcmd.Job plus 'fields'"""
+    rec = dict(key=job.key)
+    rec.update(fields)
+    rec.update(
+        host=socket.gethostname(),
+        returncode=job.returncode,
+        queued=job.queued,
+        start=job.start,
+        end=job.end,
+        wall=job.wall,
+        wait=job.start - job.queued if job.queued is not None else None,
+    )
+    if job.rusage is not None:
+        rec.update(
+            utime=job.rusage.ru_utime,
+            stime=job.rusage.ru_stime,
+            # ru_maxrss is in kB on Linux
+            maxrss_mb=job.rusage.ru_maxrss / 1024,
+        )
+    return rec
+
+
+def append(path, record):
+    """Append a record to a JSONL metrics file"""
+    with open(path, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+
+
+def read(paths):
+    records = []
+    for path in paths:
+        with open(path, "r") as fp:
+            for n, line in enumerate(fp, 1):
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"{path}:{n}: skipping bad record")
+    return records
+
+
+def summarize(records):
+    """Print the throughput, waiting times and core use of the records"""
+    ok = [r for r in records if r.get("returncode") == 0 and "utime" in r]
+    print(f"{len(records)} jobs, {len(ok)} finished successfully")
+    groups = defaultdict(list)
+    for r in ok:
+        groups[(r.get("rn", "-"), r.get("obj", "-"))].append(r)
+    if len(groups) > 0:
+        print()
+        print(
+            f"{'rn':<10} {'obj':<12} {'jobs':>5} {'wall s':>10} {'cpu s':>10} "
+            f"{'photons/cpu s':>14} {'max rss MB':>10}"
+        )
+    for (rn, obj), rs in sorted(groups.items()):
+        cpu = sum(r["utime"] + r["stime"] for r in rs)
+        wall = np.mean([r["wall"] for r in rs])
+        photons = sum(r.get("photons", 0) for r in rs)
+        rate = f"{photons / cpu:14.4g}" if photons > 0 and cpu > 0 else f"{'-':>14}"
+        rss = max(r.get("maxrss_mb", 0) for r in rs)
+        print(
+            f"{rn:<10} {obj:<12} {len(rs):>5} {wall:>10.1f} {cpu:>10.1f} {rate} {rss:>10.1f}"
+        )
+    waits = [r["wait"] for r in records if r.get("wait") is not None]
+    if len(waits) > 0:
+        print()
+        print(
+            f"queue wait: mean {np.mean(waits):.1f} s, median {np.median(waits):.1f} s, "
+            f"max {np.max(waits):.1f} s"
+        )
+    starts = [r["start"] for r in records if r.get("start") is not None]
+    ends = [r["end"] for r in records if r.get("end") is not None]
+    if len(starts) == 0 or len(ends) == 0:
+        return
+    span = max(ends) - min(starts)
+    if span <= 0:
+        return
+    busy = sum(r["wall"] for r in records if r.get("wall") is not None)
+    cpu = sum(r.get("utime", 0) + r.get("stime", 0) for r in records)
+    print(f"sweep: {span:.1f} s, {busy / span:.2f} jobs running on average")
+    slots = max((r.get("maxproc") or 0) for r in records)
+    if slots > 0:
+        print(
+            f"core use: {100 * cpu / (span * slots):.1f}% of {slots} job slots "
+            f"({100 * busy / (span * slots):.1f}% of slots occupied)"
+        )
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+def summary(files):
+    """Summarize one or more metrics files"""
+    records = read(files)
+    if len(records) == 0:
+        print("no records")
+        exit(1)
+    summarize(records)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,123 @@
+"""
+Photon budget of every object and radionuclide.
+
+Instead of one NN for everything, runspectsims.py --plan PARFILE picks NN
+for each (radionuclide, object) from the activities in PARFILE (the par
+file of post_process_simind.py: MBq per VOI or per rn:voi, and the frame
+duration) so the simulation noise of every projection is a fixed fraction
+of the Poisson noise of the acquisition it is scaled to.
+
+A projection of an object with activity A (MBq) acquired for t seconds
+per view has A 1e6 t decays per view, times the yield of the radionuclide.
+simind simulates NN times the sum of the source map decays per view and
+seed, times the same yield, and the projections are averaged over the
+seeds. The relative noise of the averaged simulation is then
+sqrt(A 1e6 t / (NN sum seeds)) times that of the acquisition, so for a
+ratio 'noise'
+
+    NN = A 1e6 t / (noise^2 sum seeds)
+
+The yields and the detection efficiency cancel. Objects with a low
+activity for their size and radionuclides with little activity get a
+small NN, so the photons simulated (and the CPU time) follow the activity
+instead of every job using the NN the most demanding one needs.
+
+The NN of every job is recorded in {prefix}_nn_plan.json so
+avg_done_sims.py and avg_done_bis.py can weight the seeds by their NN.
+"""
+
+import json
+import os
+import re
+from glob import glob, escape
+import numpy as np
+
+
+class error(Exception):
+    pass
+
+
+def read_par(path):
+    """key = value pairs of a par file like activity_frame_time.par"""
+    par = {}
+    try:
+        fp = open(path, "r")
+    except OSError as e:
+        raise error(f"error reading {path}: {e}") from e
+    with fp:
+        for n, line in enumerate(fp, 1):
+            line = re.sub("#.*", "", line).strip()
+            if len(line) == 0:
+                continue
+            k, sep, v = line.partition("=")
+            if len(sep) == 0:
+                raise error(f"{path}:{n}: expected key = value")
+            par[k.strip()] = v.strip()
+    return par
+
+
+def activities(par, rns, objs):
+    """Activity (MBq) of each (rn, obj): the rn:obj key or the obj key"""
+    act = {}
+    missing = []
+    for rn in rns:
+        for obj in objs:
+            v = par.get(f"{rn}:{obj}", par.get(obj))
+            if v is None:
+                missing.append(obj)
+                continue
+            try:
+                act[(rn, obj)] = float(v)
+            except ValueError:
+                raise error(f"activity of {rn}:{obj} is not a number: {v}") from None
+    if missing:
+        raise error(f"no activity for {', '.join(sorted(set(missing)))}")
+    return act
+
+
+def plan_nn(objsums, act, frame_duration, noise, nseeds):
+    """NN of each (rn, obj) for a noise ratio 'noise' with nseeds seeds"""
+    nns = {}
+    for (rn, obj), a in act.items():
+        nn = a * 1e6 * frame_duration / (noise**2 * objsums[obj] * nseeds)
+        nns[(rn, obj)] = max(1, int(np.ceil(nn)))
+    return nns
+
+
+def plan_file(prefix):
+    return f"{prefix}_nn_plan.json"
+
+
+def save_plan(prefix, plan=None, jobs=None):
+    """Update {prefix}_nn_plan.json with a plan and the NN of jobs
+
+    jobs maps job base names to NN and is merged with the jobs already
+    recorded, so seeds run with an earlier plan keep their NN. The names
+    are kept without the directory of the prefix, like the outputs next
+    to the file.
+    """
+    path = plan_file(prefix)
+    state = dict(plan=None, jobs={})
+    if os.path.exists(path):
+        with open(path, "r") as fp:
+            state.update(json.load(fp))
+    if plan is not None:
+        state["plan"] = plan
+    if jobs:
+        state["jobs"].update((os.path.basename(b), nn) for b, nn in jobs.items())
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(state, fp, indent=1)
+    os.replace(tmp, path)
+
+
+def job_nns(path="."):
+    """NN of every job recorded in the *_nn_plan.json files in path"""
+    nns = {}
+    for f in sorted(glob(os.path.join(escape(path), "*_nn_plan.json"))):
+        try:
+            with open(f, "r") as fp:
+                nns.update(json.load(fp).get("jobs", {}))
+        except (OSError, ValueError) as e:
+            print(f"error reading {f}: {e}")
+    return nns
@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+"""
+Draw many Poisson noise realizations of noise free projections.
+
+    noisegen.py -k 200 prj.nf.w01.im prj.nf.w02.im
+
+reads each noise free projection once and writes K noisy realizations of
+it, either stacked in one file, prj.n.wNN.kK.im with shape (K, angle, y, x),
+or (with --per-file) streamed to one file per realization,
+prj.n.wNN.rRRRR.im. Realization r of a projection is drawn from child r of
+a SeedSequence made from --seed and the window number, so every
+realization has its own independent stream, the realizations don't depend
+on the number of threads and the first realizations are the same when K is
+increased. The realizations are sampled in parallel threads (numpy releases
+the GIL while sampling).
+
+The stacked file is streamed to disk a realization at a time, but in the
+usual .im layout NumpyIm writes it (see imio) and loads it whole to do so,
+so when the stack would be more than MAX_STACK_BYTES the realizations are
+written one per file instead.
+"""
+
+import re
+from os.path import basename, dirname, join
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from sys import exit
+import numpy as np
+import click
+import imio
+
+# largest stacked file written in the usual .im layout, which NumpyIm loads
+# whole to write
+MAX_STACK_BYTES = 2**30
+
+
+def output_prefix(path):
+    """prj.nf.w01.im -> prj.n.w01"""
+    name = basename(path)
+    if name.endswith(".im"):
+        name = name[: -len(".im")]
+    name = re.sub(r"(^|\.)nf\.", r"\1n.", name, count=1)
+    return join(dirname(path), name)
+
+
+def window_key(path):
+    """Numbers in the file name (window, frame) used to seed its noise"""
+    return [int(n) for n in re.findall(r"\.[wf](\d+)", basename(path))]
+
+
+def realization_rngs(seed, path, k):
+    ss = np.random.SeedSequence([seed] + window_key(path))
+    return [np.random.default_rng(s) for s in ss.spawn(k)]
+
+
+def realizations(pix, rngs, threads):
+    """Yield the noisy realizations in order, 'threads' at a time"""
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for i in range(0, len(rngs), threads):
+            batch = rngs[i : i + threads]
+            yield from pool.map(lambda rng: rng.poisson(pix).astype(np.float32), batch)
+
+
+def generate(path, k, seed, threads, per_file):
+    im = imio.ImFile(path)
+    # read the noise free projection once
+    pix = np.maximum(np.asarray(im.pixels(), dtype=np.float64), 0.0)
+    header = imio.read_header(path)
+    prefix = output_prefix(path)
+    rngs = realization_rngs(seed, path, k)
+    stack_bytes = 4 * k * int(np.prod(im.shape))
+    if not per_file and not imio.NATIVE and stack_bytes > MAX_STACK_BYTES:
+        print(
+            f"{k} realizations of {path} need {stack_bytes / 2**30:.1f} GB, "
+            "writing one file per realization"
+        )
+        per_file = True
+    if per_file:
+        for r, noisy in enumerate(realizations(pix, rngs, threads)):
+            hdr = dict(header, **{"Noise Realization": str(r)})
+            imio.write(noisy, f"{prefix}.r{r:04d}.im", header=hdr)
+        print(f"wrote {k} realizations of {path} to {prefix}.r*.im")
+        return
+    outf = f"{prefix}.k{k}.im"
+    with imio.ImWriter(outf, (k,) + im.shape, np.float32, header) as w:
+        for noisy in realizations(pix, rngs, threads):
+            w.write(noisy)
+    print(f"wrote {k} realizations of {path} to {outf}")
+
+
+@click.command()
+@click.option(
+    "-k", "--realizations", "k", type=int, default=100, help="number of realizations"
+)
+@click.option("--seed", type=int, default=0, help="seed of the noise")
+@click.option(
+    "--threads",
+    type=int,
+    default=None,
+    help="number of sampling threads (default is number of CPUs)",
+)
+@click.option("--per-file", is_flag=True, help="write one file per realization")
+@click.argument("projections", nargs=-1, required=True)
+def noisegen(k, seed, threads, per_file, projections):
+    if k < 1:
+        print("--realizations must be at least 1")
+        exit(1)
+    if threads is None:
+        threads = cpu_count()
+    ok = True
+    for path in projections:
+        try:
+            generate(path, k, seed, max(1, threads), per_file)
+        except imio.error as e:
+            print(f"error generating noise for {path}: {e}")
+            ok = False
+    exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    noisegen()
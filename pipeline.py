@@ -0,0 +1,446 @@
+#! /usr/bin/env python3
+"""
+Incremental driver for the whole simulation pipeline.
+
+The stages are nodes of a dependency graph:
+
+  simulate      runspectsims.py                 config, density and source maps
+  average       avg_done_sims.py                seed images of simulate
+  average_bis   avg_done_bis.py                 seed spectra of simulate
+  post_process  post_process_simind.py          averages, activity par file
+  create_atn    create_atn.py                   density map, config
+  recon         run_osemmw.py                   projections, attenuation maps
+  quantify      quantify.py                     recons, projections
+
+A node is run when its signature, a hash of its command line and of the
+contents of its input files, differs from the one saved when it last ran
+(or its outputs are missing), so only what changed is rebuilt. E.g.
+changing an activity in the par file reruns post_process and the stages
+after it but doesn't average the seeds again. Nodes whose inputs are ready
+run in parallel (--maxproc). The signatures, file hashes and logs are kept
+in .pipeline/ in the simulation directory.
+
+The parameters are in a [pipeline] section of the config file:
+
+  [pipeline]
+  stages = simulate average average_bis post_process create_atn
+  seeds = 1 11                    # start and end seed for runspectsims.py
+  activity = activity_frame_time.par
+  keVs = 218 440                  # energies of the attenuation maps
+  frames = frames.txt             # optional, see post_process_simind.py
+  tac = tac.txt                   # optional
+  recon_outputs = recons/*/recon*.im  # outputs of the recon stage
+  quantify_results = quantify_results.csv
+
+and {stage}_args adds arguments to a stage's command (e.g. simulate_args =
+--maxproc 8 or quantify_args = --spheres 1 prj.nf.w01.im
+recons/collapsed.prj.nf.w0+mwosem.2ws+atn.w1/reconi1.1.im).
+Any argument that names an existing file is an input of the stage.
+
+    pipeline.py run [--maxproc N] [--force STAGE] [STAGE ...]
+    pipeline.py status
+"""
+
+import configparser
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+import time
+from glob import glob
+from os.path import exists
+from sys import exit
+import click
+from runcmd import JobPool
+from smicache import content_hash
+from avg_done_sims import seed_files
+import impack
+
+STATE_DIR = ".pipeline"
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STAGES = ["simulate", "average", "average_bis", "post_process", "create_atn"]
+
+
+class error(Exception):
+    pass
+
+
+class Node:
+    """A stage: its command, the stages it needs and its files
+
+    inputs() and outputs() are called when the node is about to run, after
+    the nodes it depends on have finished. 'params' are the settings it
+    reads from the config file. 'clean' are removed before the node runs
+    (for scripts that skip existing outputs).
+    """
+
+    def __init__(self, name, cmd, deps, inputs, outputs, params="", clean=()):
+        self.name = name
+        self.cmd = cmd.strip()
+        self.params = params
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.clean = clean
+
+
+def script(name):
+    return f"{shlex.quote(sys.executable)} {shlex.quote(os.path.join(REPO_DIR, name))}"
+
+
+def arg_files(args):
+    return [a for a in shlex.split(args) if exists(a) and os.path.isfile(a)]
+
+
+def globs(*patterns):
+    files = set()
+    for p in patterns:
+        files.update(f for f in glob(p) if os.path.isfile(f))
+    return sorted(files)
+
+
+def build_graph(configfile):
+    """Nodes of the stages listed in the [pipeline] section of configfile"""
+    config = configparser.ConfigParser(inline_comment_prefixes=("#",))
+    config.read(configfile)
+    if "pipeline" not in config:
+        raise error(f"{configfile} has no [pipeline] section")
+    pp = config["pipeline"]
+    parms = config["parms"]
+    prefix = parms.get("prefix", "sim")
+    densmap = parms.get("densmap")
+    objs = re.split(r"[, ]+", parms.get("objects", "").strip())
+    rns = re.split(r"[, ]+", parms.get("radionuclides", "").strip())
+    isd = config["isd_files"] if "isd_files" in config else {}
+    # the simulation settings; the [pipeline] section doesn't change them
+    sim_params = json.dumps(
+        {s: dict(config[s]) for s in ["parms", "isd_files"] if s in config},
+        sort_keys=True,
+    )
+    stages = pp.get("stages", " ".join(DEFAULT_STAGES)).split()
+
+    def args(stage):
+        return pp.get(f"{stage}_args", "")
+
+    def need(key, stage):
+        if key not in pp:
+            raise error(f"the {stage} stage needs '{key}' in the [pipeline] section")
+        return pp[key]
+
+    def dep_outputs(*names):
+        return lambda: [f for n in names if n in nodes for f in nodes[n].outputs()]
+
+    nodes = {}
+    for stage in stages:
+        # bound to the input lambdas below as a default, so each gets its own
+        stage_args = args(stage)
+        if stage == "simulate":
+            seeds = need("seeds", stage).split()
+            isds = [isd.get(rn, rn) for rn in rns]
+            isds = [f if f.endswith(".isd") else f + ".isd" for f in isds]
+            sim_inputs = [f"{densmap}.im", parms.get("ewin_file", "") + ".win"]
+            sim_inputs += [f"{o}.im" for o in objs] + isds
+            nodes[stage] = Node(
+                stage,
+                f"{script('runspectsims.py')} {shlex.quote(configfile)} "
+                f"{seeds[0]} {seeds[1]} {args(stage)}",
+                [],
+                lambda i=sim_inputs: [f for f in i if exists(f)],
+                lambda: globs(f"{prefix}_*.res"),
+                params=sim_params,
+            )
+        elif stage == "average":
+            nodes[stage] = Node(
+                stage,
+                f"{script('avg_done_sims.py')} {args(stage)}",
+                ["simulate"],
+                lambda: (
+                    sorted(
+                        set(
+                            impack.source(f)
+                            for fs in seed_files([".im"]).values()
+                            for f in fs
+                        )
+                    )
+                    + globs("*_nn_plan.json")
+                ),
+                lambda: globs(f"{prefix}_*.avg.im"),
+            )
+        elif stage == "average_bis":
+            nodes[stage] = Node(
+                stage,
+                f"{script('avg_done_bis.py')} {args(stage)}",
+                ["simulate"],
+                lambda: (
+                    sorted(
+                        set(
+                            impack.source(f)
+                            for fs in seed_files([".bis"]).values()
+                            for f in fs
+                        )
+                    )
+                    + globs("*_nn_plan.json")
+                ),
+                lambda: globs(f"{prefix}_*.avg.bis"),
+                clean=[f"{prefix}_*.avg.bis"],
+            )
+        elif stage == "post_process":
+            activity = need("activity", stage)
+            extra = ""
+            par_inputs = [activity]
+            for key in ["frames", "tac"]:
+                if key in pp:
+                    extra += f" --{key} {shlex.quote(pp[key])}"
+                    par_inputs.append(pp[key])
+            nodes[stage] = Node(
+                stage,
+                f"{script('post_process_simind.py')} {shlex.quote(activity)} "
+                f"--overwrite{extra} {args(stage)}",
+                ["average"],
+                lambda p=par_inputs, a=stage_args: (
+                    globs("sim*w??.avg.im") + p + arg_files(a)
+                ),
+                lambda: globs("prj.n*.im", "collapsed.prj.n*.im"),
+            )
+        elif stage == "create_atn":
+            keVs = need("keVs", stage)
+            nodes[stage] = Node(
+                stage,
+                f"{script('create_atn.py')} {keVs} --density {shlex.quote(densmap + '.im')} "
+                f"{args(stage)}",
+                [],
+                lambda: [f"{densmap}.im"],
+                lambda: globs("atn.w*.im"),
+                params=parms.get("pixsize", ""),
+            )
+        elif stage == "recon":
+            outputs = pp.get("recon_outputs", "recons/*/recon*.im").split()
+            nodes[stage] = Node(
+                stage,
+                f"{script('run_osemmw.py')} --overwrite {args(stage)}",
+                ["post_process", "create_atn"],
+                lambda a=stage_args: (
+                    dep_outputs("post_process", "create_atn")() + arg_files(a)
+                ),
+                lambda o=outputs: globs(*o),
+            )
+        elif stage == "quantify":
+            results = pp.get("quantify_results", "quantify_results.csv")
+            nodes[stage] = Node(
+                stage,
+                f"{script('quantify.py')} {args(stage)} --results {shlex.quote(results)}",
+                ["recon", "post_process"],
+                lambda a=stage_args: (
+                    dep_outputs("recon", "post_process")() + arg_files(a)
+                ),
+                lambda r=results: globs(r),
+            )
+        else:
+            raise error(f"unknown stage {stage}")
+    # dependencies on stages that aren't in the pipeline are dropped
+    for node in nodes.values():
+        node.deps = [d for d in node.deps if d in nodes]
+    return nodes
+
+
+def load_state():
+    if not exists(STATE_FILE):
+        return dict(nodes={}, files={})
+    with open(STATE_FILE, "r") as fp:
+        return json.load(fp)
+
+
+def save_state(state):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = f"{STATE_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(state, fp, indent=1)
+    os.replace(tmp, STATE_FILE)
+
+
+def file_hash(path, cache):
+    """Content hash of path; files whose size and mtime didn't change
+    since they were last hashed aren't read again"""
+    st = os.stat(path)
+    c = cache.get(path)
+    if c is not None and c[0] == st.st_size and c[1] == st.st_mtime_ns:
+        return c[2]
+    h = content_hash(path)
+    cache[path] = [st.st_size, st.st_mtime_ns, h]
+    return h
+
+
+def signature(node, cache):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(node.cmd.encode())
+    h.update(f"\0{node.params}".encode())
+    for f in sorted(set(node.inputs())):
+        h.update(f"\0{f}\0{file_hash(f, cache)}".encode())
+    return h.hexdigest()
+
+
+def needed(nodes, targets):
+    """The targets and every node they depend on, in graph order"""
+    order = []
+
+    def visit(name, path):
+        if name in path:
+            raise error(f"dependency cycle: {' -> '.join(path + [name])}")
+        if name in order:
+            return
+        for d in nodes[name].deps:
+            visit(d, path + [name])
+        order.append(name)
+
+    for t in targets:
+        visit(t, [])
+    return order
+
+
+def stale_reason(node, state, cache, force):
+    """Why a node has to run, or None if it is up to date"""
+    if node.name in force:
+        return "forced"
+    saved = state["nodes"].get(node.name)
+    if saved is None or not saved.get("ok"):
+        return "never ran"
+    if len(node.outputs()) == 0:
+        return "outputs are missing"
+    if saved["signature"] != signature(node, cache):
+        return "inputs or parameters changed"
+    return None
+
+
+def get_nodes(configfile, targets):
+    try:
+        nodes = build_graph(configfile)
+        for t in targets:
+            if t not in nodes:
+                raise error(f"{t} is not a stage of the pipeline: {', '.join(nodes)}")
+        order = needed(nodes, targets if targets else list(nodes))
+    except (error, configparser.Error, KeyError) as e:
+        print(e)
+        exit(1)
+    return nodes, order
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--config", "configfile", default="config.par", type=click.Path(exists=True)
+)
+@click.option(
+    "--maxproc",
+    type=int,
+    default=2,
+    help="maximum number of stages to run at a time (default 2). The stages "
+    "themselves can run several processes",
+)
+@click.option("--force", multiple=True, help="run this stage even if it is up to date")
+@click.option("--dry-run", is_flag=True, help="only print what would be run")
+@click.argument("targets", nargs=-1)
+def run(configfile, maxproc, force, dry_run, targets):
+    """Bring TARGETS (default all stages) up to date"""
+    nodes, order = get_nodes(configfile, targets)
+    state = load_state()
+    cache = state["files"]
+    os.makedirs(STATE_DIR, exist_ok=True)
+    status = {}  # name -> 'done', 'running', 'failed' or 'blocked'
+    will_run = set()  # with --dry-run
+    sigs = {}
+    pool = JobPool(maxruns=max(1, maxproc))
+
+    def finished(job):
+        name = job.key
+        ok = job.returncode == 0
+        status[name] = "done" if ok else "failed"
+        print(f"{name}: {'finished' if ok else 'FAILED'} in {job.wall:.1f} s")
+        if not ok:
+            print(f"    see {os.path.join(STATE_DIR, name + '.log')}")
+        # the signature is of the inputs the stage ran on
+        state["nodes"][name] = dict(
+            signature=sigs[name], ok=ok, end=job.end, wall=job.wall, cmd=nodes[name].cmd
+        )
+        save_state(state)
+
+    while True:
+        progress = False
+        for name in order:
+            if name in status:
+                continue
+            node = nodes[name]
+            dstat = [status.get(d) for d in node.deps]
+            if any(s in ("failed", "blocked") for s in dstat):
+                status[name] = "blocked"
+                print(f"{name}: not run, a stage it needs failed")
+                progress = True
+                continue
+            if any(s != "done" for s in dstat) or len(pool) >= pool.maxruns:
+                continue
+            progress = True
+            if dry_run and any(d in will_run for d in node.deps):
+                # its inputs are only known after the stages before it ran
+                print(
+                    f"{name}: would run if the outputs of {', '.join(node.deps)} change"
+                )
+                will_run.add(name)
+                status[name] = "done"
+                continue
+            reason = stale_reason(node, state, cache, force)
+            if reason is None:
+                print(f"{name}: up to date")
+                status[name] = "done"
+                continue
+            if dry_run:
+                print(f"{name}: would run ({reason}): {node.cmd}")
+                will_run.add(name)
+                status[name] = "done"
+                continue
+            for pattern in node.clean:
+                for f in glob(pattern):
+                    os.remove(f)
+            sigs[name] = signature(node, cache)
+            log = os.path.join(STATE_DIR, f"{name}.log")
+            print(f"{name}: running ({reason}): {node.cmd}")
+            status[name] = "running"
+            pool.submit(
+                f"{node.cmd} > {shlex.quote(log)} 2>&1", key=name, on_exit=finished
+            )
+        if not progress:
+            if pool.wait_one() is None:
+                break
+    if not dry_run:
+        save_state(state)
+    failed = [n for n in order if status.get(n) in ("failed", "blocked")]
+    exit(1 if failed else 0)
+
+
+@cli.command()
+@click.option(
+    "--config", "configfile", default="config.par", type=click.Path(exists=True)
+)
+def status(configfile):
+    """Print which stages are up to date"""
+    nodes, order = get_nodes(configfile, [])
+    state = load_state()
+    for name in order:
+        saved = state["nodes"].get(name, {})
+        reason = stale_reason(nodes[name], state, state["files"], ())
+        when = ""
+        if saved.get("end"):
+            when = time.strftime(
+                " (last run %Y-%m-%d %H:%M)", time.localtime(saved["end"])
+            )
+        print(f"{name:<13} {reason or 'up to date'}{when}")
+    save_state(state)
+
+
+if __name__ == "__main__":
+    cli()
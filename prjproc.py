@@ -0,0 +1,257 @@
+"""
+Post-processing of projections: binning to a smaller matrix and Poisson
+noise, done in-process instead of with collapse and addnoise. The header
+fields are set with imio, which still runs imgcpinfo and imsetinfo for
+.im files (see imio).
+
+Projections are arrays of shape (angle, row, column). Binning sums the
+counts of the input pixels covered by each output pixel. When the binning
+factor isn't an integer, input pixels on the border of two output pixels are
+split between them in proportion to their overlap, so the total number of
+counts is kept. Noise is drawn from a numpy Generator seeded from the noise
+seed and the window number, so a rerun gives the same noisy projections.
+"""
+
+import numpy as np
+import imio
+import impack
+
+PRJ_SIZE = 128
+
+
+def rebin_matrix(n_in, n_out):
+    """(n_out, n_in) matrix of the overlap of output and input pixels
+
+    Output pixel j covers input pixels [j*f, (j+1)*f) with f = n_in/n_out.
+    Each column sums to 1, so multiplying by it keeps the sum.
+    """
+    f = n_in / n_out
+    edges = np.arange(n_out + 1) * f
+    lo = np.maximum(edges[:-1, np.newaxis], np.arange(n_in)[np.newaxis, :])
+    hi = np.minimum(edges[1:, np.newaxis], np.arange(1, n_in + 1)[np.newaxis, :])
+    return np.maximum(hi - lo, 0.0)
+
+
+def rebin(pix, rows, cols):
+    """Bin the last two axes of pix to rows x cols, keeping the sum"""
+    shape = pix.shape
+    if shape[-2] % rows == 0 and shape[-1] % cols == 0:
+        # integer factors: a reshape and sum is faster than the matrices
+        fr = shape[-2] // rows
+        fc = shape[-1] // cols
+        out = pix.reshape(shape[:-2] + (rows, fr, cols, fc))
+        return out.sum(axis=(-3, -1), dtype=np.float64)
+    R = rebin_matrix(shape[-2], rows)
+    C = rebin_matrix(shape[-1], cols)
+    return np.einsum("ay,...yx,bx->...ab", R, pix, C, optimize=True)
+
+
+def noise_rng(seed, window):
+    """Random generator for the noisy projections of a window
+
+    window can also be a list, e.g. [window, frame]
+    """
+    key = list(window) if isinstance(window, (list, tuple)) else [window]
+    return np.random.default_rng(np.random.SeedSequence([seed] + key))
+
+
+def add_noise(pix, rng):
+    """Poisson noise realization of the expected counts in pix"""
+    return rng.poisson(np.maximum(pix, 0.0)).astype(np.float32)
+
+
+def binned_fields(header_file, shape, rows, cols):
+    """Pixel spacing fields for an image of 'shape' binned to rows x cols"""
+    try:
+        pix_size = [float(s) for s in impack.get_field(header_file, "Pixel Size").split()]
+    except (AttributeError, ValueError, imio.error):
+        print("no Pixel Size in the header: pixel spacing isn't updated")
+        return {}
+    # same convention as the old collapse step: rows scale with the x factor
+    return {
+        "Pixel Spacing Rows": pix_size[0] * shape[2] / cols,
+        "Pixel Spacing Cols": pix_size[1] * shape[1] / rows,
+    }
+
+
+def process_window(
+    pix,
+    header_file,
+    nf_outf,
+    n_outf,
+    frame_duration_s,
+    rng,
+    size=PRJ_SIZE,
+):
+    """Write the noise free and noisy projections of one window
+
+    pix is the noise free projection in counts. Writes nf_outf and n_outf
+    and, if the projections are larger than size x size, the binned
+    collapsed.{nf_outf} and collapsed.{n_outf}. The header is copied from
+    header_file.
+    """
+    fields = {"Actual Frame Duration": frame_duration_s * 1000}
+    noisy = add_noise(pix, rng)
+    # osemmw reads these, so they are written in the usual .im layout
+    native = imio.RECON_NATIVE
+    impack.write_like(pix, nf_outf, header_file, fields, native=native)
+    impack.write_like(noisy, n_outf, header_file, fields, native=native)
+    rows = min(size, pix.shape[1])
+    cols = min(size, pix.shape[2])
+    if (rows, cols) == pix.shape[1:]:
+        return
+    binned = dict(fields)
+    binned.update(binned_fields(header_file, pix.shape, rows, cols))
+    for im, outf in [(pix, nf_outf), (noisy, n_outf)]:
+        print(f"    Saving collapsed.{outf}")
+        impack.write_like(
+            rebin(im, rows, cols), f"collapsed.{outf}", header_file, binned, native=native
+        )
+
+
+def combine(
+    files, rns, vois, activities, scale=1.0, keep_sums=False, max_bytes=256 * 2**20
+):
+    """Combine the basis projections of one window
+
+    files maps (rn, voi) to the projection of that radionuclide in that VOI
+    (cps/MBq); missing pairs count as 0. The projections are stacked as a
+    (rn, voi, angle, y, x) array and contracted with the activity vector
+    (MBq of each VOI), a slab of angles at a time so only max_bytes of the
+    stack is in memory. Returns the combined projection times scale and,
+    with keep_sums, a dict of the sum over radionuclides for each VOI.
+    """
+    ims = {}
+    shape = None
+    for key, f in files.items():
+        ims[key] = impack.open_image(f)
+        if shape is None:
+            shape = ims[key].shape
+        elif ims[key].shape != shape:
+            raise imio.error(f"{f} has shape {ims[key].shape}, expected {shape}")
+    pix = {key: im.pixels() for key, im in ims.items()}
+    weights = np.array([activities[v] for v in vois], dtype=np.float64) * scale
+    total = np.empty(shape, dtype=np.float64)
+    sums = {v: np.empty(shape, dtype=np.float64) for v in vois} if keep_sums else None
+    per_angle = 4 * len(rns) * len(vois) * int(np.prod(shape[1:]))
+    step = max(1, max_bytes // max(per_angle, 1))
+    for a in range(0, shape[0], step):
+        b = min(a + step, shape[0])
+        stack = np.zeros((len(rns), len(vois), b - a) + shape[1:], dtype=np.float32)
+        for r, rn in enumerate(rns):
+            for v, voi in enumerate(vois):
+                if (rn, voi) in pix:
+                    stack[r, v] = pix[(rn, voi)][a:b]
+        total[a:b] = np.einsum("rv...,v->...", stack, weights, dtype=np.float64)
+        if keep_sums:
+            by_voi = stack.sum(axis=0, dtype=np.float64)
+            for v, voi in enumerate(vois):
+                sums[voi][a:b] = by_voi[v]
+    return total, sums
+
+
+def frame_name(prefix, frame, num_txt):
+    return f"{prefix}.f{frame + 1:03d}.w{num_txt}.im"
+
+
+def synthesize_frames(
+    files,
+    rns,
+    vois,
+    weights,
+    durations,
+    header_file,
+    num_txt,
+    rngs,
+    size=PRJ_SIZE,
+    max_bytes=256 * 2**20,
+    max_frames=16,
+):
+    """Write the noise free and noisy projections of all frames of a window
+
+    weights is a (frame, rn, voi) array of MBq * s and rngs has one random
+    generator per frame. Like combine(), the basis projections are read a
+    slab of angles at a time; for each slab the frames are computed with one
+    contraction and their noise free, noisy and binned slabs are passed to
+    imio.ImWriter, which streams them to temporary files. The frames are
+    done in batches of at most max_frames, so no more than 4 * max_frames
+    images are open at once (the basis projections are read once per
+    batch). In the usual .im layout NumpyIm may load an image whole when
+    its writer is closed (see imio), one image at a time. Writes
+    prj.nf.fFFF.wNN.im, prj.n.fFFF.wNN.im and their collapsed. versions.
+    """
+    ims = {}
+    shape = None
+    for key, f in files.items():
+        ims[key] = impack.open_image(f)
+        if shape is None:
+            shape = ims[key].shape
+        elif ims[key].shape != shape:
+            raise imio.error(f"{f} has shape {ims[key].shape}, expected {shape}")
+    pix = {key: im.pixels() for key, im in ims.items()}
+    rows = min(size, shape[1])
+    cols = min(size, shape[2])
+    binned = (rows, cols) != shape[1:]
+    header = impack.read_header(header_file)
+    spacing = binned_fields(header_file, shape, rows, cols) if binned else {}
+    max_frames = max(1, max_frames)
+    for first in range(0, len(durations), max_frames):
+        frames = range(first, min(first + max_frames, len(durations)))
+        writers = []
+        try:
+            for f in frames:
+                hdr = dict(header)
+                hdr["Actual Frame Duration"] = str(durations[f] * 1000)
+                out = []
+                for prefix in ["prj.nf", "prj.n"]:
+                    out.append(
+                        imio.ImWriter(
+                            frame_name(prefix, f, num_txt),
+                            shape,
+                            np.float32,
+                            hdr,
+                            native=imio.RECON_NATIVE,
+                        )
+                    )
+                if binned:
+                    chdr = dict(hdr)
+                    chdr.update((k, str(v)) for k, v in spacing.items())
+                    for prefix in ["collapsed.prj.nf", "collapsed.prj.n"]:
+                        name = frame_name(prefix, f, num_txt)
+                        out.append(
+                            imio.ImWriter(
+                                name,
+                                (shape[0], rows, cols),
+                                np.float32,
+                                chdr,
+                                native=imio.RECON_NATIVE,
+                            )
+                        )
+                writers.append(out)
+            per_angle = 4 * len(rns) * len(vois) * int(np.prod(shape[1:]))
+            per_angle += 16 * len(frames) * int(np.prod(shape[1:]))
+            step = max(1, max_bytes // max(per_angle, 1))
+            w = weights[frames.start:frames.stop]
+            for a in range(0, shape[0], step):
+                b = min(a + step, shape[0])
+                stack = np.zeros((len(rns), len(vois), b - a) + shape[1:], dtype=np.float32)
+                for r, rn in enumerate(rns):
+                    for v, voi in enumerate(vois):
+                        if (rn, voi) in pix:
+                            stack[r, v] = pix[(rn, voi)][a:b]
+                nf = np.einsum("rv...,frv->f...", stack, w, dtype=np.float64)
+                for i, out in enumerate(writers):
+                    noisy = add_noise(nf[i], rngs[frames[i]])
+                    out[0].write(nf[i])
+                    out[1].write(noisy)
+                    if binned:
+                        out[2].write(rebin(nf[i], rows, cols))
+                        out[3].write(rebin(noisy, rows, cols))
+            for out in writers:
+                for wr in out:
+                    wr.close()
+        except BaseException:
+            for out in writers:
+                for wr in out:
+                    wr.abort()
+            raise
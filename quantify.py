@@ -1,76 +1,25 @@
 #! /usr/bin/env python3
+import argparse
+import csv
+import json
 from os.path import exists
-from sys import exit, argv
+from sys import exit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 import numpy as np
-import NumpyIm as npi
-import subprocess
-import matplotlib.pyplot as plt
-from matplotlib.patches import Circle
+import imio
+import re
+from spheres import fit_sphere, sum_voxels_in_sphere, sphere_weights, hot_threshold, centroid
+from spheres import detect_spheres, source_sphere
 
-def fit_sphere(points, weights=None):
-    """
-    Fit a sphere to a set of 3D points using least squares.
-    
-    Parameters:
-        points (ndarray): Nx3 array of (x, y, z) coordinates.
-        weights (ndarray, optional): N-length array of weights for each point.
-    
-    Returns:
-        center (ndarray): Estimated sphere center (cx, cy, cz).
-        radius (float): Estimated sphere radius.
-    """
-    # Construct matrix A for linear system: [2x, 2y, 2z, 1]
-    A = np.hstack((2*points, np.ones((points.shape[0], 1))))
-    
-    # Compute vector f = x^2 + y^2 + z^2 for each point
-    f = np.sum(points**2, axis=1)
-
-    # Apply weights if provided
-    if weights is not None:
-        W = np.diag(weights)
-        A = W @ A
-        f = W @ f
-
-    # Solve least squares: A * c ~= f
-    # c contains [cx, cy, cz, constant]
-    c, *_ = np.linalg.lstsq(A, f, rcond=None)
-
-    # Extract center coordinates
-    center = c[:3]
-
-    # Compute radius using formula: r = sqrt(cx^2 + cy^2 + cz^2 + constant)
-    radius = np.sqrt(np.sum(center**2) + c[3])
-
-    return center, radius
-
-def sum_voxels_in_sphere(array, center, radius):
-    """
-    Sum voxel values within a sphere of given center and radius.
-    
-    Parameters:
-        array (ndarray): 3D array of voxel intensities.
-        center (tuple): (cx, cy, cz) coordinates of sphere center.
-        radius (float): Sphere radius in voxel units.
-    
-    Returns:
-        float: Sum of voxel values inside the sphere.
-    """
-
-    # Generate 3D grid of voxel coordinates
-    z, y, x = np.indices(array.shape)
+class error(Exception):
+    pass
 
-    # Compute Euclidean distance from each voxel to the center
-    distances = np.sqrt((x - center[0])**2 +
-                        (y - center[1])**2 +
-                        (z - center[2])**2)
-    
-    # Create mask for voxels inside the sphere
-    mask = distances <= radius
+def display_circle(pix, radius, centroid_x, centroid_y, centroid_z):
+    # matplotlib is only needed to display the VOI
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Circle
 
-    # Sum voxel values where mask is True
-    return array[mask].sum()
-
-def display_circle(pix, radius):
     # Extract slices for 3 views
     axial_slice = pix[centroid_z,:,:]
     sagittal_slice = pix[:,:,centroid_x]
@@ -104,116 +53,88 @@ def display_circle(pix, radius):
     plt.tight_layout()
     plt.show()
 
-# Ensure user inputs are present
-if len(argv) != 4 and len(argv) != 5:
-    print("Usage: quantify.py CF projection_file recon_file outfile")
-    print("\nCF: conversion factor for the image in cps/MBq")
-    print("To use the calibration mode, enter a CF of 0 or smaller and do not specify an outfile")
-    exit(1)
-
-# Retrieve user input
-CF = float(argv[1])
-if CF <= 0:
-    print("---Calibration mode---")
-    calibration_mode = True
-else:
-    calibration_mode = False
-    outf = argv[4]
-proj = argv[2]
-recon = argv[3]
-
-# Check to make sure the files exist
-if not exists(proj) or not exists(recon):
-    print("Infiles do not exist!")
-    exit(1)
-
-# Read in the infile (assumes units of counts)
-pix = npi.ArrayFromIm(recon)
-
-# Get the frame duration from projections
-hdr = subprocess.check_output(["header", "-i", proj])
-hdr = hdr.decode('ascii').strip().split("\n")
-try:
-    frame_duration_txt = [item for item in hdr if "Actual Frame Duration" in item]
-    frame_duration = frame_duration_txt[0].split("\t")
-    frame_duration = float(frame_duration[-1]) / 1000 # convert to seconds
-    print(f"Found frame duration of {frame_duration} seconds in header")
-except:
-    print("No frame duration found in header")
-    frame_duration = float(input("Enter the frame duration in seconds: "))
-
-# Get the total number of frames
-try:
-    num_frames_txt = [item for item in hdr if "Number of Projections" in item]
-    num_frames = num_frames_txt[0].split("\t")
-    num_frames = int(num_frames[-1])
-    print(f"Found {num_frames} frames in header")
-except:
-    print("No number of projections found in header")
-    num_frames = int(input("Enter the number of projections: "))
-
-if calibration_mode:
+def header_value(path, key, convert, what, interactive):
+    """Value of a header field, asking for it in interactive mode"""
+    try:
+        value = convert(imio.get_field(path, key))
+        print(f"Found {what} of {value} in header of {path}")
+        return value
+    except (TypeError, ValueError, imio.error):
+        if not interactive:
+            raise error(f"no {what} found in header of {path}") from None
+        print(f"No {what} found in header")
+        return convert(input(f"Enter the {what}: "))
+
+def frame_time(proj, interactive):
+    """Total acquisition time (s) of the projections"""
+    # Get the frame duration from projections
+    try:
+        frame_duration = float(imio.get_field(proj, "Actual Frame Duration")) / 1000 # convert to seconds
+        print(f"Found frame duration of {frame_duration} seconds in header")
+    except (TypeError, ValueError, imio.error):
+        if not interactive:
+            raise error(f"no frame duration found in header of {proj}") from None
+        print("No frame duration found in header")
+        frame_duration = float(input("Enter the frame duration in seconds: "))
+    # Get the total number of frames
+    num_frames = header_value(proj, "Number of Projections", int, "number of projections", interactive)
+    return frame_duration * num_frames
+
+def find_sphere(pix, percentile=None):
+    """Center (x, y, z) and radius of the hot sphere in pix"""
     # Compute centroid
-    centroid = subprocess.check_output(["centroid", recon])
-    centroid = centroid.decode('ascii').strip().split("\t")
-    centroid_x = round(float(centroid[-3]))
-    centroid_y = round(float(centroid[-2]))
-    centroid_z = round(float(centroid[-1]))
-    print(f"Centroid found at {centroid_x}, {centroid_y}, {centroid_z}")
-    
+    center = [round(c) for c in centroid(pix)]
     # Calculate radius of sphere (assumes isotopric voxels)
-    mean = pix.mean()
-    std = pix.std()
-    threshold = mean + 2 * std
-    #threshold = np.percentile(pix, 98) # causes slow processing
+    threshold = hot_threshold(pix, percentile)
     coords = np.argwhere(pix > threshold)  # pick voxels above threshold
     weights = pix[tuple(coords.T)]         # intensity as weight
-    center, radius = fit_sphere(coords, weights)
+    _, radius = fit_sphere(coords, weights)
+    return center, float(radius)
+
+def calibrate(proj, recon, activity_MBq=None, percentile=None, interactive=False):
+    """Conversion factor (cps/MBq) from a recon of a sphere of known activity"""
+    # Read in the infile (assumes units of counts)
+    pix = imio.read(recon)
+    acq_time = frame_time(proj, interactive)
+    center, radius = find_sphere(pix, percentile)
+    print(f"Centroid found at {center[0]}, {center[1]}, {center[2]}")
     print(f"Calculated radius = {radius}")
 
-    # Ask for confirmation on radius
-    accepted = False
-    while accepted == False:
-        display_circle(pix, radius)
-        response = input("Is the VOI acceptable (Y/N)? ")
-        if response == 'Y' or response == 'y':
-            accepted = True
-        elif response == 'N' or response == 'n':
-            radius = float(input("Enter in the new radius: "))
-        else:
-            print("Unknown response, please answer Y or N.")
+    if interactive:
+        # Ask for confirmation on radius
+        accepted = False
+        while accepted == False:
+            display_circle(pix, radius, *center)
+            response = input("Is the VOI acceptable (Y/N)? ")
+            if response == 'Y' or response == 'y':
+                accepted = True
+            elif response == 'N' or response == 'n':
+                radius = float(input("Enter in the new radius: "))
+            else:
+                print("Unknown response, please answer Y or N.")
 
     # Sum the in the sphere
-    tot_counts = sum_voxels_in_sphere(pix, (centroid_x, centroid_y, centroid_z), radius)
+    tot_counts = sum_voxels_in_sphere(pix, center, radius)
     print(f"{tot_counts} counts in image")
-        
-    activity_MBq = float(input("Enter the activity in MBq: "))
 
-    CF = (tot_counts / (frame_duration * num_frames)) / activity_MBq
+    if activity_MBq is None:
+        activity_MBq = float(input("Enter the activity in MBq: "))
+
+    CF = (tot_counts / acq_time) / activity_MBq
     print(f"CF = {CF} cps/MBq")
-    exit(1)
-else:
+    return dict(CF=CF, counts=tot_counts, activity_MBq=activity_MBq, radius=radius,
+                center_x=center[0], center_y=center[1], center_z=center[2])
+
+def quantify(proj, recon, CF, outf, percentile=None, interactive=False):
+    """Convert a recon in counts to Bq/mL and save it to outf"""
+    pix = np.array(imio.read(recon), dtype=np.float64)
+
     # Convert image to cps
-    pix = pix / (frame_duration * num_frames)
+    pix = pix / frame_time(proj, interactive)
 
     # Get the voxel dimensions
-    slice_thickness = subprocess.check_output(["imghdr", "-i", "SliceThickness", recon])
-    slice_thickness = slice_thickness.decode('ascii')
-    try:
-        slice_thickness = float(slice_thickness)
-        print(f"Found slice thickness of {slice_thickness} cm in header")
-    except:
-        print("No slice thickness found in header")
-        slice_thickness = float(input("Enter the slice thickness in cm: "))
-
-    pixel_width = subprocess.check_output(["imghdr", "-i", "PixelWidth", recon])
-    pixel_width = pixel_width.decode('ascii')
-    try:
-        pixel_width = float(pixel_width)
-        print(f"Found pixel width of {pixel_width} cm in header")
-    except:
-        print("No pixel width found in header")
-        pixel_width = float(input("Enter the pixel width in cm: "))
+    slice_thickness = header_value(recon, "SliceThickness", float, "slice thickness in cm", interactive)
+    pixel_width = header_value(recon, "PixelWidth", float, "pixel width in cm", interactive)
 
     # Convert image to cps/mL
     pix = pix / (slice_thickness * pixel_width * pixel_width) # assumes square pixels in the axial direction
@@ -221,5 +142,216 @@ else:
     # Convert image to Bq/mL
     pix = pix * (1 / CF) * 1e6
 
-# Save output image
-npi.ArrayToIm(pix.astype(np.float32), outf)
\ No newline at end of file
+    # Save output image
+    imio.write(pix, outf, dtype=np.float32)
+
+    # Mean concentration in the hot sphere
+    center, radius = find_sphere(pix, percentile)
+    ones = np.ones_like(pix)
+    volume = sum_voxels_in_sphere(ones, center, radius)
+    conc = sum_voxels_in_sphere(pix, center, radius) / volume
+    print(f"Mean concentration in sphere of radius {radius:.2f} at {center}: {conc} Bq/mL")
+    return dict(CF=CF, outfile=outf, radius=radius, concentration_Bq_mL=conc,
+                center_x=center[0], center_y=center[1], center_z=center[2])
+
+def read_par(path):
+    """key = value pairs of a parameter file like activity_frame_time.par"""
+    par = {}
+    with open(path, "r") as fp:
+        for line in fp:
+            line = re.sub('#.*', '', line).strip()
+            if len(line) == 0:
+                continue
+            k, v = line.split('=')
+            par[k.strip()] = v.strip()
+    return par
+
+def measure_spheres(proj, recon, CF, par_file=None, sources=None, percentile=None):
+    """Counts, concentration and recovery coefficient of every hot sphere
+
+    The spheres are detected in one labelling pass over the voxels above
+    the threshold. With sources (basenames of source maps, e.g. nemab1) the
+    spheres of the source maps are used as VOIs instead and matched to the
+    activities in par_file by name. Without them, detected spheres are
+    matched to the activities of par_file by size (largest sphere to
+    largest activity), which assumes the same concentration in every sphere.
+    """
+    pix = imio.read(recon)
+    found = detect_spheres(pix, hot_threshold(pix, percentile))
+    print(f"Detected {len(found)} hot spheres in {recon}")
+    activities = {}
+    if par_file is not None:
+        par = read_par(par_file)
+        activities = {k: float(v) for k, v in par.items() if k not in ["frame duration", "noise seed"]}
+    if sources:
+        spheres = []
+        for name in sources:
+            center, radius = source_sphere(f"{name}.im", pix.shape)
+            spheres.append(dict(name=name, center=center, radius=radius))
+    else:
+        names = sorted(activities, key=lambda k: -activities[k])
+        spheres = [dict(name=names[n] if n < len(names) else f"sphere{n + 1}",
+                        center=s["center"], radius=s["radius"]) for n, s in enumerate(found)]
+    acq_time = frame_time(proj, False) if CF > 0 else None
+    try:
+        voxel_mL = (float(imio.get_field(recon, "SliceThickness"))
+                    * float(imio.get_field(recon, "PixelWidth")) ** 2)
+    except (TypeError, ValueError, imio.error):
+        voxel_mL = None
+    rows = []
+    for s in spheres:
+        cx, cy, cz = s["center"]
+        slices, weights = sphere_weights(pix.shape, s["center"], s["radius"])
+        counts = float(np.sum(pix[slices] * weights, dtype=np.float64))
+        volume = float(weights.sum())
+        row = dict(recon=recon, name=s["name"], center_x=cx, center_y=cy, center_z=cz,
+                   radius=s["radius"], voxels=volume, counts=counts)
+        if sources:
+            # the detected component closest to the source sphere
+            d = [np.linalg.norm(np.subtract(f["center"], s["center"])) for f in found]
+            if len(d) > 0 and min(d) < s["radius"]:
+                row["detected_radius"] = found[int(np.argmin(d))]["radius"]
+        if acq_time is not None:
+            row["activity_MBq"] = counts / acq_time / CF
+            if voxel_mL is not None and volume > 0:
+                row["concentration_Bq_mL"] = row["activity_MBq"] * 1e6 / (volume * voxel_mL)
+            if s["name"] in activities:
+                row["true_activity_MBq"] = activities[s["name"]]
+                row["recovery"] = row["activity_MBq"] / activities[s["name"]]
+        print(", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()))
+        rows.append(row)
+    return rows
+
+def run_entry(entry, percentile):
+    """Process one manifest entry; returns the result row"""
+    result = dict(entry)
+    try:
+        for f in [entry["projection"], entry["recon"]]:
+            if not exists(f):
+                raise error(f"{f} does not exist")
+        CF = float(entry.get("CF") or 0)
+        if CF <= 0:
+            activity = entry.get("activity")
+            if not activity:
+                raise error("calibration entries need an activity")
+            result.update(calibrate(entry["projection"], entry["recon"], float(activity), percentile))
+        else:
+            recon = entry["recon"]
+            outf = entry.get("outfile") or (recon[:-3] if recon.endswith(".im") else recon) + ".bqml.im"
+            result.update(quantify(entry["projection"], entry["recon"], CF, outf, percentile))
+        result["error"] = ""
+    except (error, imio.error, ValueError, KeyError) as e:
+        result["error"] = str(e)
+    return result
+
+def read_manifest(path):
+    """Manifest entries: a CSV file with a header line or a JSON list"""
+    with open(path, "r") as fp:
+        if path.endswith(".json"):
+            entries = json.load(fp)
+        else:
+            entries = list(csv.DictReader(row for row in fp if not row.startswith("#")))
+    for n, e in enumerate(entries):
+        if "projection" not in e or "recon" not in e:
+            raise error(f"{path}: entry {n + 1} needs a projection and a recon")
+    return entries
+
+def write_results(results, path):
+    if path.endswith(".json"):
+        with open(path, "w") as fp:
+            json.dump(results, fp, indent=1)
+        return
+    keys = []
+    for r in results:
+        keys += [k for k in r if k not in keys]
+    with open(path, "w", newline="") as fp:
+        w = csv.DictWriter(fp, fieldnames=keys)
+        w.writeheader()
+        w.writerows(results)
+
+def batch(manifest, results_file, maxproc, percentile):
+    try:
+        entries = read_manifest(manifest)
+    except (OSError, ValueError, error) as e:
+        print(f"error reading {manifest}: {e}")
+        exit(1)
+    if maxproc is None:
+        maxproc = cpu_count()
+    results = [None] * len(entries)
+    with ProcessPoolExecutor(max_workers=max(1, min(maxproc, len(entries)))) as pool:
+        futures = {pool.submit(run_entry, e, percentile): n for n, e in enumerate(entries)}
+        for fut in as_completed(futures):
+            results[futures[fut]] = fut.result()
+    write_results(results, results_file)
+    failed = [r for r in results if r["error"]]
+    for r in failed:
+        print(f"error processing {r['recon']}: {r['error']}")
+    print(f"processed {len(results) - len(failed)} of {len(results)} entries, results in {results_file}")
+    exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="quantify.py CF projection_file recon_file [outfile]\n"
+              "       quantify.py --batch MANIFEST [--results FILE] [--maxproc N]\n"
+              "       quantify.py --spheres CF projection_file recon_file [--par PAR] [--sources A,B,...]",
+        description="CF: conversion factor for the image in cps/MBq. To use the calibration mode, "
+                    "enter a CF of 0 or smaller and do not specify an outfile.",
+        epilog="In batch mode, MANIFEST is a CSV file with the columns projection, recon, "
+               "activity (MBq, for calibration), CF and outfile (optional) or a JSON list of "
+               "such entries. Entries with a CF of 0 or smaller (or none) are calibrated. They "
+               "are processed in parallel without asking anything, and the CFs and "
+               "concentrations are written to --results (.csv or .json).")
+    parser.add_argument("args", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--batch", metavar="MANIFEST", default=None, help="process the entries in MANIFEST")
+    parser.add_argument("--results", default="quantify_results.csv",
+                        help="results of the batch and spheres modes (default quantify_results.csv)")
+    parser.add_argument("--maxproc", type=int, default=None,
+                        help="maximum number of entries to process at a time (default is number of CPUs)")
+    parser.add_argument("--spheres", action="store_true",
+                        help="measure every hot sphere in the recon (arguments CF projection_file recon_file)")
+    parser.add_argument("--par", default=None,
+                        help="activities (MBq) of the spheres for --spheres, e.g. activity_frame_time.par")
+    parser.add_argument("--sources", default=None,
+                        help="comma separated basenames of the source maps of the spheres (e.g. nemab1,nemab2)")
+    parser.add_argument("--percentile", type=float, default=None,
+                        help="threshold for the sphere fit as a percentile (default mean + 2 std)")
+    opts = parser.parse_args()
+
+    if opts.batch is not None:
+        batch(opts.batch, opts.results, opts.maxproc, opts.percentile)
+
+    # Ensure user inputs are present
+    argv = opts.args
+    if len(argv) != 3 and len(argv) != 4:
+        parser.print_help()
+        exit(1)
+
+    # Retrieve user input
+    CF = float(argv[0])
+    proj = argv[1]
+    recon = argv[2]
+
+    # Check to make sure the files exist
+    if not exists(proj) or not exists(recon):
+        print("Infiles do not exist!")
+        exit(1)
+
+    if opts.spheres:
+        sources = opts.sources.split(",") if opts.sources else None
+        try:
+            rows = measure_spheres(proj, recon, CF, opts.par, sources, opts.percentile)
+        except (error, imio.error, ValueError, OSError) as e:
+            print(f"error measuring spheres: {e}")
+            exit(1)
+        write_results(rows, opts.results)
+        print(f"results in {opts.results}")
+        exit(0)
+
+    if CF <= 0:
+        print("---Calibration mode---")
+        calibrate(proj, recon, percentile=opts.percentile, interactive=True)
+        exit(1)
+    if len(argv) != 4:
+        print("An outfile is needed to quantify an image")
+        exit(1)
+    quantify(proj, recon, CF, argv[3], opts.percentile, interactive=True)
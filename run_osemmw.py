@@ -1,38 +1,244 @@
 #! /usr/bin/env python3
-from os.path import exists
+import argparse
+import json
+import os
+import re
+import shlex
+from glob import glob, escape
+from os.path import exists, getsize
 from multiprocessing import cpu_count
 from sys import exit
-from runcmd import runcmd, waitall
-
-# Declare variables
-prj_nf = "collapsed.prj.nf.w0"
-prj_n = "collapsed.prj.n.w0"
-atn = "atn.w1"
-out_prefix = "ads"
-
-# Ensure projections exist
-if not exists(prj_nf + "1.im") or not exists(prj_nf + "2.im"):
-    print("Noise free projections are missing")
-    exit(1)
-if not exists(prj_n + "1.im") or not exists(prj_n + "2.im"):
-    print("Noisey projections are missing")
-    exit(1)
-
-# Ensure attenuation maps exist
-if not exists(atn + ".im") or not exists(atn + "i1.im") or not exists(atn + "i2.im"):
-    print("Attenuation maps are missing")
-    exit(1)
-
-# Ensure outputs don't exist
-if exists(out_prefix + "nf.reconi1.1.im") or exists (out_prefix + "n.reconi1.1.im"):
-    print("Outputs already exist, exiting to prevent overwriting")
-    exit(1)
-
-# Reconstruct noise free projections
-cmd = f"nice -n 9 ~frey/bin/osemmw mwosem.2ws.par {prj_nf} {atn} {out_prefix}.nf.recon >& {out_prefix}.nf.recon.log"
-runcmd(cmd,cpu_count(), 60)
-waitall()
-
-# Reconstruct noisey projections
-cmd = f"nice -n 9 ~frey/bin/osemmw mwosem.2ws.par {prj_n} {atn} {out_prefix}.n.recon >& {out_prefix}.n.recon.log"
-runcmd(cmd,cpu_count(), 60)
\ No newline at end of file
+from runcmd import JobPool
+import metrics
+
+"""
+Runs a batch of osemmw reconstructions: every combination of the projection
+prefixes (noise free, noisy, noise realizations, windows), OSEM parameter
+files and attenuation maps given. Each recon runs in its own directory,
+
+    {outdir}/{projection}+{parameter file}+{attenuation map}/
+
+with the recon images ({dir}/recon*), the log ({dir}/recon.log) and
+{dir}/job.json with the inputs, exit status and run time. As many recons
+run at a time as fit in the CPU and memory budgets, and each one is
+recorded as soon as it finishes. Recons that finished before are skipped
+unless --overwrite is given. The resource use of every recon is appended
+to {outdir}/metrics.jsonl (see metrics.py).
+"""
+
+
+def label(path):
+    # directory name part for an input
+    name = os.path.basename(path)
+    name = name.removesuffix(".par")
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+def default_memory():
+    # half of the physical memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**31
+
+
+def recon_memory(prj_files, atn):
+    """Estimate of the memory (GB) one recon needs
+
+    The projections and attenuation maps are held in memory as float32 with
+    a few copies of the image and projections for the updates.
+    """
+    size = sum(getsize(f) for f in prj_files + glob(escape(atn) + "*.im"))
+    return 4 * size / 2**30
+
+
+def make_jobs(prjs, pars, atns, outdir):
+    jobs = []
+    errs = False
+    for prj in prjs:
+        prj_files = sorted(glob(escape(prj) + "*.im"))
+        if len(prj_files) == 0:
+            print(f"no projections {prj}*.im")
+            errs = True
+        for par in pars:
+            for atn in atns:
+                name = f"{label(prj)}+{label(par)}+{label(atn)}"
+                jobs.append(
+                    dict(
+                        name=name,
+                        prj=prj,
+                        par=par,
+                        atn=atn,
+                        dir=os.path.join(outdir, name),
+                        prj_files=prj_files,
+                    )
+                )
+    for par in pars:
+        if not exists(par):
+            print(f"no OSEM parameter file {par}")
+            errs = True
+    for atn in atns:
+        if not exists(atn + ".im"):
+            print(f"no attenuation map {atn}.im")
+            errs = True
+    if errs:
+        print("inputs are missing: exiting")
+        exit(1)
+    return jobs
+
+
+def finished_before(job):
+    try:
+        with open(os.path.join(job["dir"], "job.json"), "r") as fp:
+            return json.load(fp).get("returncode") == 0
+    except (OSError, ValueError):
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run osemmw for every combination of projections, parameter files "
+        "and attenuation maps, as many at a time as fit in the CPU and memory budgets."
+    )
+    parser.add_argument(
+        "--prj",
+        action="append",
+        default=None,
+        help="projection prefix, e.g. collapsed.prj.n.w0 (repeat for more; default "
+        "collapsed.prj.nf.w0 and collapsed.prj.n.w0)",
+    )
+    parser.add_argument(
+        "--par",
+        action="append",
+        default=None,
+        help="OSEM parameter file (repeat for more; default mwosem.2ws.par)",
+    )
+    parser.add_argument(
+        "--atn",
+        action="append",
+        default=None,
+        help="attenuation map prefix (repeat for more; default atn.w1)",
+    )
+    parser.add_argument(
+        "--outdir", default="recons", help="directory for the recons (default recons)"
+    )
+    parser.add_argument(
+        "--osemmw",
+        default="~frey/bin/osemmw",
+        help="osemmw program (default ~frey/bin/osemmw)",
+    )
+    parser.add_argument(
+        "--maxproc",
+        type=int,
+        default=None,
+        help="CPUs to use (default is number of CPUs)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="CPUs each recon uses (default 1)"
+    )
+    parser.add_argument(
+        "--mem-gb",
+        type=float,
+        default=None,
+        help="memory the recons may use (default is half the physical memory)",
+    )
+    parser.add_argument(
+        "--recon-mem-gb",
+        type=float,
+        default=None,
+        help="memory of one recon (default is estimated from the input sizes)",
+    )
+    parser.add_argument(
+        "--nice", type=int, default=9, help="nice level of the recons (default 9)"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="rerun recons that finished before"
+    )
+    args = parser.parse_args()
+
+    prjs = args.prj or ["collapsed.prj.nf.w0", "collapsed.prj.n.w0"]
+    pars = args.par or ["mwosem.2ws.par"]
+    atns = args.atn or ["atn.w1"]
+    jobs = make_jobs(prjs, pars, atns, args.outdir)
+    todo = [j for j in jobs if args.overwrite or not finished_before(j)]
+    for j in jobs:
+        if j not in todo:
+            print(f"skipping {j['name']}: finished before")
+    if len(todo) == 0:
+        exit(0)
+
+    # number of recons at a time from the CPU and memory budgets
+    maxproc = args.maxproc if args.maxproc is not None else cpu_count()
+    mem_gb = args.mem_gb if args.mem_gb is not None else default_memory()
+    per_recon = args.recon_mem_gb
+    if per_recon is None:
+        per_recon = max(recon_memory(j["prj_files"], j["atn"]) for j in todo)
+    nrun = max(
+        1,
+        min(
+            maxproc // max(args.threads, 1),
+            int(mem_gb // per_recon) if per_recon > 0 else len(todo),
+        ),
+    )
+    nrun = min(nrun, len(todo))
+    print(f"running {len(todo)} recons, {nrun} at a time ({per_recon:.2f} GB each)")
+
+    os.makedirs(args.outdir, exist_ok=True)
+    metrics_file = os.path.join(args.outdir, "metrics.jsonl")
+    by_key = {j["name"]: j for j in todo}
+    failed = []
+
+    def recon_done(job):
+        j = by_key[job.key]
+        info = dict(
+            prj=j["prj"],
+            par=j["par"],
+            atn=j["atn"],
+            cmd=job.cmd,
+            returncode=job.returncode,
+            start=job.start,
+            end=job.end,
+            wall=job.wall,
+            outputs=sorted(
+                os.path.basename(f)
+                for f in glob(os.path.join(escape(j["dir"]), "recon*.im"))
+            ),
+        )
+        with open(os.path.join(j["dir"], "job.json"), "w") as fp:
+            json.dump(info, fp, indent=1)
+        # Record the run time and resource use of the reconstruction
+        metrics.append(
+            metrics_file,
+            metrics.job_record(
+                job,
+                recon=j["name"],
+                prj=j["prj"],
+                par=j["par"],
+                atn=j["atn"],
+                threads=args.threads,
+                maxproc=maxproc,
+            ),
+        )
+        if job.returncode != 0:
+            failed.append(j["name"])
+            print(
+                f"{j['name']}: failed with status {job.returncode}, see {j['dir']}/recon.log"
+            )
+        else:
+            print(
+                f"{j['name']}: done in {job.wall:.0f} s, {len(info['outputs'])} images"
+            )
+
+    pool = JobPool(maxruns=nrun)
+    for j in todo:
+        os.makedirs(j["dir"], exist_ok=True)
+        out = os.path.join(j["dir"], "recon")
+        cmd = (
+            f"nice -n {args.nice} {args.osemmw} {shlex.quote(j['par'])} {shlex.quote(j['prj'])} "
+            f"{shlex.quote(j['atn'])} {shlex.quote(out)} > {shlex.quote(out)}.log 2>&1"
+        )
+        print(f"starting {j['name']}")
+        pool.submit(cmd, key=j["name"], on_exit=recon_done)
+    pool.wait_all()
+
+    print(
+        f"{len(todo) - len(failed)} of {len(todo)} recons finished, outputs in {args.outdir}"
+    )
+    exit(1 if failed else 0)
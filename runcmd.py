@@ -1,69 +1,248 @@
 #! /usr/bin/env python3
-from sys import argv, exit, stdout
-
-pids = []
+from sys import stdout
 from subprocess import Popen
-from os import waitpid, WNOHANG
-from time import sleep
+import os
+import select
+import time
+
+# returncode of a job whose exit status was collected by someone else
+LOST = 255
+# seconds between checks of the running jobs when pidfds aren't available
+POLL_INTERVAL = 0.05
+
+
+class Job:
+    """A command started by a JobPool
+
+    Attributes:
+      cmd: the shell command that was run
+      key: optional caller supplied identifier (e.g. the simulation base name)
+      pid: process id of the shell running the command
+      queued, start, end: time.time() values for when the job was handed to
+        the pool, when it was started and when its exit was seen
+      returncode: exit code of the command (negative signal number if it was
+        killed) or None while it is running. LOST if the process was reaped
+        outside the pool, so its status is unknown; it counts as failed
+      lost: True if the exit status was lost
+      rusage: resource.struct_rusage from wait4 for the finished job (None
+        if the status was lost)
+    """
+
+    def __init__(self, cmd, key=None, queued=None, on_exit=None):
+        self.cmd = cmd
+        self.key = key
+        self.queued = queued
+        self.on_exit = on_exit
+        self.pid = None
+        self.popen = None
+        self.start = None
+        self.end = None
+        self.returncode = None
+        self.lost = False
+        self.rusage = None
+
+    @property
+    def done(self):
+        return self.returncode is not None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def wall(self):
+        if self.start is None:
+            return None
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def __repr__(self):
+        return f"Job(pid={self.pid}, key={self.key!r}, returncode={self.returncode})"
+
+
+class JobPool:
+    """Run a limited number of shell commands at a time in the background
+
+    pool = JobPool(maxruns=4)
+    job = pool.submit(cmd)
+
+      submit() starts 'cmd' under the shell as soon as fewer than 'maxruns'
+      jobs are active. When the pool is full it blocks until one of the
+      running jobs exits, so a free slot is reused immediately instead of
+      after a polling interval. Only the pool's own processes are waited for
+      (through a pidfd per job, or by checking each job every POLL_INTERVAL
+      seconds where pidfds aren't available), so children started elsewhere
+      in the program are left to their owners. Every finished job is
+      returned as a Job with its exit status and rusage from wait4(). If 'on_exit' is given to submit() it is
+      called with the Job right after the job is reaped. 'env' replaces the
+      environment of the command and 'start_new_session' puts it in its own
+      process group so the whole job can be killed with os.killpg().
+    """
+
+    def __init__(self, maxruns=4, debug=False):
+        self.maxruns = maxruns
+        self.debug = debug
+        self.running = {}
+        self.finished = []
+        self.pidfds = {}
+        self.poller = None
+
+    def __len__(self):
+        return len(self.running)
 
+    def submit(
+        self,
+        cmd,
+        rundir=None,
+        key=None,
+        queued=None,
+        on_exit=None,
+        env=None,
+        start_new_session=False,
+    ):
+        if queued is None:
+            queued = time.time()
+        while len(self.running) >= self.maxruns:
+            if self.debug:
+                print("waiting on ", list(self.running))
+                stdout.flush()
+            self.wait_one()
+        if self.debug:
+            print("run ", cmd)
+            stdout.flush()
+        job = Job(cmd, key=key, queued=queued, on_exit=on_exit)
+        job.start = time.time()
+        job.popen = Popen(
+            cmd, cwd=rundir, shell=True, env=env, start_new_session=start_new_session
+        )
+        job.pid = job.popen.pid
+        self.running[job.pid] = job
+        self._watch(job.pid)
+        return job
+
+    def _watch(self, pid):
+        try:
+            fd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return
+        if self.poller is None:
+            self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN)
+        self.pidfds[pid] = fd
+
+    def _unwatch(self, pid):
+        fd = self.pidfds.pop(pid, None)
+        if fd is not None:
+            self.poller.unregister(fd)
+            os.close(fd)
+
+    def _wait_exited(self):
+        """Block until a running job has exited; return (pid, wait4 result)
+
+        The wait4 result is None if the process was reaped elsewhere.
+        """
+        while True:
+            # jobs without a pidfd are checked without blocking
+            for pid in [p for p in self.running if p not in self.pidfds]:
+                try:
+                    result = os.wait4(pid, os.WNOHANG)
+                except ChildProcessError:
+                    return pid, None
+                if result[0] == pid:
+                    return pid, result
+            if len(self.pidfds) < len(self.running):
+                if self.pidfds:
+                    ready = self.poller.poll(POLL_INTERVAL * 1000)
+                else:
+                    time.sleep(POLL_INTERVAL)
+                    ready = []
+            else:
+                ready = self.poller.poll()
+            fds = dict((fd, pid) for pid, fd in self.pidfds.items())
+            for fd, _ in ready:
+                pid = fds[fd]
+                try:
+                    return pid, os.wait4(pid, 0)
+                except ChildProcessError:
+                    return pid, None
+
+    def wait_one(self):
+        """Block until a job from this pool exits and return it
+
+        Returns None if no jobs are running. A job whose process was reaped
+        outside the pool is returned with returncode LOST.
+        """
+        if not self.running:
+            return None
+        pid, result = self._wait_exited()
+        self._unwatch(pid)
+        job = self.running.pop(pid)
+        job.end = time.time()
+        if result is None:
+            job.returncode = LOST
+            job.lost = True
+            print(f"exit status of {job.pid} ({job.cmd}) was lost: counted as failed")
+        else:
+            job.returncode = os.waitstatus_to_exitcode(result[1])
+            job.rusage = result[2]
+        # keep Popen from trying to reap a pid that no longer exists
+        job.popen.returncode = job.returncode
+        self.finished.append(job)
+        if self.debug:
+            print(f"finished {job.pid} status={job.returncode}")
+            stdout.flush()
+        if job.on_exit is not None:
+            job.on_exit(job)
+        return job
+
+    def wait_all(self):
+        """Wait for every running job and return the list of finished jobs"""
+        done = []
+        while self.running:
+            job = self.wait_one()
+            if job is not None:
+                done.append(job)
+        return done
 
-def runcmd(cmd, maxruns=4, waittime=5, debug=False, rundir=None):
+
+# pool used by the runcmd()/waitall() compatibility functions and the jobs
+# of it that finished since the last waitall()
+pool = JobPool()
+finished = []
+
+
+def runcmd(cmd, maxruns=4, waittime=None, debug=False, rundir=None):
     """Run a limited number of jobs at a time in the background
-    runcmd(cmd, maxruns=4, waittime=5, debug=False)
+    runcmd(cmd, maxruns=4, waittime=None, debug=False)
 
       Runs the command 'cmd'in the background under the shell. A maximum of
       'maxruns' jobs at a time can be run. If this function is called and that
-      many jobs are already active then the subroutine waits and checks for
-      one to exist before starting the requested job. It waits 'waittime' seconds
-      between checks for a completed job. If 'debug' is true then lots of
-      information is printed.
+      many jobs are already active then the subroutine waits for one to exit
+      before starting the requested job. 'waittime' is accepted for the old
+      polling interface and ignored: the wait ends as soon as a job exits. If
+      'debug' is true then lots of information is printed. Returns the Job for
+      the started command.
     """
-    global pids
-    while len(pids) >= maxruns:
-        if debug:
-            print("waiting on ", pids)
-            stdout.flush()
-        running = []
-        for p in pids:
-            try:
-                n = waitpid(p, WNOHANG)
-            except OSError:
-                continue
-            if len(n) == 2 and n[0] == 0 and n[1] == 0:
-                running.append(p)
-        pids = running
-        print("running=", pids)
-        sleep(waittime)
-    if debug:
-        print("run ", cmd)
-        stdout.flush()
-
-    p = Popen(cmd, cwd=rundir, shell=True)
-    pids.append(p.pid)
-
-
-def waitall(debug=False, waittime=5):
-    global pids
-    while len(pids) > 0:
-        if debug:
-            print("waiting on ", pids)
-            stdout.flush()
-        running = []
-        for p in pids:
-            try:
-                n = waitpid(p, WNOHANG)
-            except OSError:
-                continue
-            if len(n) == 2 and n[0] == 0 and n[1] == 0:
-                running.append(p)
-        pids = running
-        print("still running=", pids)
-        if len(pids) > 0:
-            sleep(waittime)
+    pool.maxruns = maxruns
+    pool.debug = debug
+    return pool.submit(cmd, rundir=rundir, on_exit=finished.append)
+
+
+def waitall(debug=False, waittime=None):
+    """Wait for all jobs started with runcmd
+
+    Returns every Job started with runcmd that finished since the last
+    waitall(), also the ones that finished while runcmd() waited for a free
+    slot. 'waittime' is ignored, as in runcmd().
+    """
+    pool.debug = debug
+    pool.wait_all()
+    done = list(finished)
+    finished.clear()
     print("all done")
+    return done
 
 
 if __name__ == "__main__":
     for i in range(10):
-        runcmd("sleep " + str(3 + i * 0.1), maxruns=4, waittime=1)
-    waitall(waittime=1)
+        runcmd("sleep " + str(3 + i * 0.1), maxruns=4)
+    waitall()
@@ -1,15 +1,26 @@
 #! /usr/bin/env python3
-from runcmd import runcmd, waitall
+from runcmd import JobPool
+from jobdb import JobDB
+import simqueue
+import shards
+import smicache
+import metrics
+import nnplan
 import os
 import re
-from time import sleep
+import time
+from glob import glob, escape
+from collections import deque
 from sys import exit
-from os.path import exists, getsize
+from os.path import exists
 from multiprocessing import cpu_count
 import configparser
 import click
 import numpy as np
-import NumpyIm as npi
+import imio
+import impack
+import shlex
+from seedstats import RunningStats
 
 
 def get_parms(parfile, int_parms=[], float_parms=[], str_parms=[], list_parms=[]):
@@ -56,50 +67,220 @@ def get_files(config, section, rns, ext):
     return files
 
 
-def get_object_sums(objs):
+def get_object_sums(objs, maxproc=1, strict=False):
+    """Sums and shape of the source maps; also makes their .smi copies
+
+    The conversions are cached (see smicache), so unchanged objects aren't
+    read again and changed ones are converted again. Voxels that aren't
+    integers or don't fit in uint16 are truncated in the .smi copy with a
+    warning, or are an error if strict.
+    """
     sums = {}
     maxsum = 0.0
     errs = False
     first = True
-    for o in objs:
-        if o in sums:
-            errs = True
-            print(f"object {o} is duplicated")
-        try:
-            pix = npi.ArrayFromIm(f"{o}.im")
-        except npi.error as e:
-            print(f"error reading source image for :{o}: {e}")
+    if len(set(objs)) != len(objs):
+        errs = True
+        print(f"objects are duplicated: {objs}")
+    results = smicache.cached_all([(f"{o}.im", f"{o}.smi") for o in objs], maxproc)
+    for o, (info, rebuilt) in zip(objs, results, strict=True):
+        if isinstance(info, Exception):
+            print(f"error reading source image for :{o}: {info}")
             errs = True
             continue
-        if pix.min() < 0.0:
-            print("min pixel for {o} is < 0")
+        if rebuilt:
+            print(f"converted {o}.im to {o}.smi")
+        if info["min"] < 0.0:
+            print(f"min pixel for {o} is < 0")
             errs = True
-        sums[o] = pix.sum()
+        if info["overflow"]:
+            if strict:
+                print(f"{o}.im has pixels that don't fit in uint16 (simind reads {o}.smi)")
+                errs = True
+            else:
+                print(f"warning: {o}.im has pixels that aren't integers or don't fit "
+                      f"in uint16; they are truncated in {o}.smi")
+        shape = tuple(info["shape"])
+        sums[o] = info["sum"]
         maxsum = max(maxsum, sums[o])
         if first:
             first = False
-            objshape = pix.shape
+            objshape = shape
             if len(objshape) != 3:
                 print(f"{o} is not a 3d image")
                 errs = 1
                 continue
         else:
-            if objshape != pix.shape:
+            if objshape != shape:
                 print(
-                    f"{o} has a different size than previous objects: {pix.shape} vs {objshape}"
+                    f"{o} has a different size than previous objects: {shape} vs {objshape}"
                 )
                 errs = True
                 continue
-        if not exists(f"{o}.smi"):
-            pix.astype(np.uint16).tofile(f"{o}.smi")
-        if getsize(f"{o}.smi") != 2 * pix.flatten().shape[0]:
-            print("{o}.smi has unexpected size")
     if errs:
         print("errors reading objects: exiting")
         exit(1)
     return sums, maxsum, objshape
 
 
+def get_isd_yields(isd_files, parms):
+    """Return the number of photons per decay simulated for each radionuclide
+
+    The isd files list one emission per line as energy (keV) and abundance.
+    The files are looked for in the current directory and then in smc_dir.
+    If a positive photon_energy is given only that energy is simulated and
+    the yield is 1. Yields are only used to compare the cost of jobs, so a
+    file that can't be read gets a yield of 1 and a warning.
+    """
+    yields = {}
+    for rn, isd_file in isd_files.items():
+        yields[rn] = 1.0
+        if parms["photon_energy"] > 0:
+            continue
+        for d in ["", parms["smc_dir"]]:
+            if exists(d + isd_file):
+                yields[rn] = read_isd_yield(d + isd_file)
+                break
+        else:
+            print(f"warning: could not find {isd_file}: assuming a yield of 1 for {rn}")
+    return yields
+
+
+def read_isd_yield(isd_path, e_low=None, e_high=None):
+    """Sum the abundances of the emissions in an isd file
+
+    Lines whose first two fields are not numbers (titles, comments) are
+    skipped. If e_low or e_high are given only emissions within that
+    energy range are counted.
+    """
+    total = 0.0
+    with open(isd_path, "r", errors="replace") as fp:
+        for line in fp:
+            fields = re.split(r"[,\s]+", line.strip())
+            if len(fields) < 2:
+                continue
+            try:
+                energy = float(fields[0])
+                abundance = float(fields[1])
+            except ValueError:
+                continue
+            if e_low is not None and energy < e_low:
+                continue
+            if e_high is not None and energy > e_high:
+                continue
+            total += abundance
+    if total <= 0:
+        print(f"warning: no emissions found in {isd_path}: assuming a yield of 1")
+        return 1.0
+    return total
+
+
+def make_plan(par_file, noise, parms, objsums, yields, nseeds):
+    """Choose NN for each (radionuclide, object); see nnplan.py
+
+    Returns the plan as saved in {prefix}_nn_plan.json and the NN of each
+    (rn, obj).
+    """
+    rns = parms["radionuclides"]
+    objs = parms["objects"]
+    try:
+        par = nnplan.read_par(par_file)
+        act = nnplan.activities(par, rns, objs)
+        frame_duration = float(par["frame duration"])
+    except KeyError:
+        print(f'No "frame duration" key was found in {par_file}')
+        exit(1)
+    except (nnplan.error, ValueError) as e:
+        print(e)
+        exit(1)
+    nns = nnplan.plan_nn(objsums, act, frame_duration, noise, nseeds)
+    print(f"NN plan for a noise ratio of {noise} with {nseeds} seeds:")
+    print(f"{'rn':<10} {'obj':<12} {'MBq':>10} {'NN':>10} {'photons':>12}")
+    photons = 0.0
+    photons_nn = 0.0
+    for rn in rns:
+        for obj in objs:
+            nn = nns[(rn, obj)]
+            p = nn * objsums[obj] * yields[rn] * nseeds
+            photons += p
+            photons_nn += parms["NN"] * objsums[obj] * yields[rn] * nseeds
+            print(f"{rn:<10} {obj:<12} {act[(rn, obj)]:>10.4g} {nn:>10} {p:>12.4g}")
+    print(
+        f"{photons:.4g} photons per view, {photons / photons_nn:.3g} times "
+        f"as many as with NN={parms['NN']}"
+    )
+    plan = dict(
+        par=par_file,
+        noise=noise,
+        seeds=nseeds,
+        frame_duration=frame_duration,
+        nn={f"{rn}:{obj}": nn for (rn, obj), nn in nns.items()},
+        photons=photons,
+        photons_config_nn=photons_nn,
+    )
+    return plan, nns
+
+
+def sim_options(
+    parms, obj, isd_file, seed, startseed, objshape, NN=None, stream=None, save_atn=None
+):
+    """Build the simind option string for one object, radionuclide and seed
+
+    stream is the random number stream (default is the seed) and save_atn
+    whether to save the aligned attenuation map (default is only for the
+    start seed).
+    """
+    # simulation flags
+    # FA:1: no screen output
+    # FA:8: don't use random seed
+    # options
+    # FD: density map name
+    # FS: source map name
+    # PX: pixel size of source map
+    # SD: seed
+    # FI: isotope file
+    # RR: skip random numbers
+    # NN: scale factor for photons in voxelized phantoms.
+    # Index values
+    # 01: energy: negative means to use the isotope file
+    # 02: source half-length
+    # 05: phantom half-length
+    # 20:  Upper energy threshold
+    # 21:  lower energy threshold
+    # 28: voxel size in output image
+    # 31: voxel size in density map
+    # 84: score routine: 41-muliplewin
+    # 76: matrix size image I
+    # 77: matrix size image J
+    # 78: matrix size density map I
+    # 79: matrix size source map I
+    # 81: matrix size density map J
+    # 82: matrix size source map J
+
+    pixsize = parms["pixsize"]
+    zdim, ydim, xdim = objshape
+    z_halflen = pixsize * zdim / 2.0
+    densmap = parms["densmap"]
+    if NN is None:
+        NN = parms["NN"]
+    if stream is None:
+        stream = seed
+    if save_atn is None:
+        save_atn = seed == startseed
+    opts = (
+        f"/FA:1/FA:8/FD:{densmap}/FS:{obj}/PX:{pixsize}/RR:{stream}"
+        f"/SD:{stream}/FI:{isd_file}/01:{parms['photon_energy']}"
+        f"/02:{z_halflen}/05:{z_halflen}/28:{pixsize}/31:{pixsize}"
+        f"/20:{parms['e_high']}/21:{parms['e_low']}/NN:{NN}/TR:5"
+        f"/31:{pixsize}/29:{parms['nang']}/84:41/CA:{parms['score41_val']}/34:{zdim}"
+        f"/76:{xdim}/77:{zdim}/78:{xdim}/79:{xdim}/81:{ydim}/82:{ydim}/83:-10"
+    )
+    # this saves an aligned attenuation map only for the start seed
+    opts += "/TR:15" if save_atn else "/FA:15"
+    opts += f"/84:41/fw:{parms['ewin_file']}/CC:{parms['collimator']}"
+    return opts
+
+
 @click.command()
 @click.option(
     "--maxproc",
@@ -108,16 +289,125 @@ def get_object_sums(objs):
     default=None,
     help="maximum number of processes to run (default is number of CPUs on the system)",
 )
+@click.option(
+    "--order",
+    type=click.Choice(["seed", "longest"]),
+    default="seed",
+    help="order to run jobs in: 'seed' runs them by seed, object and radionuclide; "
+    "'longest' runs the jobs with the most photons to simulate first",
+)
+@click.option(
+    "--queue",
+    "queuedir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="write the jobs to this queue directory instead of running them. "
+    "Run them with 'simqueue.py worker QUEUEDIR' on one or more hosts",
+)
+@click.option(
+    "--db",
+    "dbfile",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="job state database used to resume a sweep (default is {prefix}_jobs.db)",
+)
+@click.option(
+    "--retry-failed",
+    is_flag=True,
+    help="rerun jobs that the job database records as failed",
+)
+@click.option(
+    "--shards",
+    "max_shards",
+    type=int,
+    default=1,
+    help="split jobs that are much longer than the average into up to this many "
+    "shards with fewer photons each. The shards are merged when they finish",
+)
+@click.option(
+    "--noise-target",
+    type=float,
+    default=None,
+    help="keep adding seeds to each radionuclide and object until the relative "
+    "noise of the averaged projections in every window is below this value",
+)
+@click.option(
+    "--max-seeds",
+    type=int,
+    default=100,
+    help="maximum number of seeds for each radionuclide and object with --noise-target",
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="file the resource use of every job is appended to (default is "
+    "{prefix}_metrics.jsonl). Summarize it with 'metrics.py summary FILE'",
+)
+@click.option(
+    "--plan",
+    "plan_par",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="choose NN for each radionuclide and object from the activities and frame "
+    "duration in this par file (as for post_process_simind.py) instead of using NN "
+    "from the config file",
+)
+@click.option(
+    "--plan-noise",
+    type=float,
+    default=0.3,
+    help="with --plan, noise of the averaged simulation relative to the Poisson "
+    "noise of the acquisition (default 0.3)",
+)
+@click.option(
+    "--pack",
+    is_flag=True,
+    help="pack the outputs of every finished job into {base}.impack (see impack.py)",
+)
+@click.option(
+    "--strict-maps",
+    is_flag=True,
+    help="stop if a source or density map has voxels that aren't integers or don't "
+    "fit in uint16 instead of truncating them with a warning",
+)
 @click.argument("configfile", type=click.Path(exists=True), required=True)
 @click.argument("startseed", type=int, required=True)
 @click.argument("endseed", type=int, required=True)
-def runspectsims(configfile, startseed, endseed, maxproc):
+def runspectsims(
+    configfile,
+    startseed,
+    endseed,
+    maxproc,
+    order,
+    queuedir,
+    dbfile,
+    retry_failed,
+    max_shards,
+    noise_target,
+    max_seeds,
+    metrics_file,
+    plan_par,
+    plan_noise,
+    pack,
+    strict_maps,
+):
     ncpus = cpu_count()
     if maxproc is None:
         maxproc = ncpus
     else:
         maxproc = min(maxproc, ncpus)
     print(f"run up to {maxproc} jobs at a time")
+    if queuedir is not None:
+        # the queue only runs a fixed set of jobs; its own state is in QUEUEDIR
+        if noise_target is not None:
+            print("--noise-target can't be used with --queue: seeds are only added "
+                  "while runspectsims runs the jobs")
+            exit(1)
+        if dbfile is not None or retry_failed:
+            print("--db and --retry-failed are ignored with --queue: use "
+                  "'simqueue.py requeue --failed QUEUEDIR' to rerun failed jobs")
 
     # these are the parameters that are expected to be in the 'parms' section
     # of the configfile
@@ -156,87 +446,359 @@ def runspectsims(configfile, startseed, endseed, maxproc):
     if not exists(ewin_file + ".win"):
         print(f"energy window file {ewin_file + '.win'} does not exist")
         exit(1)
-    dens = npi.ArrayFromIm(f"{densmap}.im")
-    print(dens.min(), dens.max())
-    if dens.min() < 0 or dens.max() > 5000:
-        print("density map voxels must be >= 0 and <= 5")
+    try:
+        dens, _ = smicache.cached(f"{densmap}.im", f"{densmap}.dmi")
+    except (OSError, imio.error) as e:
+        print(f"error reading density map {densmap}.im: {e}")
         exit(1)
-    if not exists(f"{densmap}.dmi"):
-        dens.astype(np.uint16).tofile(f"{densmap}.dmi")
-    if getsize(f"{densmap}.dmi") != dens.flatten().shape[0] * 2:
-        print(f"{densmap}.dmi has unexpected size")
+    dens_shape = tuple(dens["shape"])
+    print(dens["min"], dens["max"])
+    if dens["min"] < 0 or dens["max"] > 5000:
+        print("density map voxels must be >= 0 and <= 5000")
         exit(1)
+    if dens["overflow"]:
+        if strict_maps:
+            print("density map voxels must be integers")
+            exit(1)
+        print(f"warning: {densmap}.im has voxels that aren't integers; they are "
+              f"truncated in {densmap}.dmi")
     os.environ["SMC_DIR"] = parms["smc_dir"]
-    simind = parms["simind"]
     print(os.environ["SMC_DIR"])
-    print(f"running {simind} using SMC_DIR={parms['smc_dir']}")
+    print(f"running {parms['simind']} using SMC_DIR={parms['smc_dir']}")
     objs = parms["objects"]
-    objsums, maxsum, objshape = get_object_sums(objs)
-    if objshape != dens.shape:
+    objsums, maxsum, objshape = get_object_sums(objs, maxproc, strict_maps)
+    if objshape != dens_shape:
         print(f"{densmap}.im and objects must be the same shape")
         exit(1)
     print(objsums)
     print(maxsum)
-    # simulation flags
-    # FA:1: no screen output
-    # FA:8: don't use random seed
-    # options
-    # FD: density map name
-    # FS: source map name
-    # PX: pixel size of source map
-    # SD: seed
-    # FI: isotope file
-    # RR: skip random numbers
-    # NN: scale factor for photons in voxelized phantoms.
-    # Index values
-    # 01: energy: negative means to use the isotope file
-    # 02: source half-length
-    # 05: phantom half-length
-    # 20:  Upper energy threshold
-    # 21:  lower energy threshold
-    # 28: voxel size in output image
-    # 31: voxel size in density map
-    # 84: score routine: 41-muliplewin
-    # 76: matrix size image I
-    # 77: matrix size image J
-    # 78: matrix size density map I
-    # 79: matrix size source map I
-    # 81: matrix size density map J
-    # 82: matrix size source map J
 
-    pixsize = parms["pixsize"]
-    zdim, ydim, xdim = objshape
-    z_halflen = pixsize * zdim / 2.0
     prefix = parms["prefix"]
     NN = parms["NN"]
+    yields = get_isd_yields(isd_files, parms)
+    plan = None
+    nns = {}
+    if plan_par is not None:
+        plan, nns = make_plan(
+            plan_par,
+            plan_noise,
+            parms,
+            objsums,
+            yields,
+            max(endseed - startseed, 1),
+        )
+    # the NN of the jobs is only recorded when a plan chose them, now or in
+    # an earlier run with the same prefix (whose seeds are weighted by NN)
+    record_nns = plan is not None or exists(nnplan.plan_file(prefix))
+
+    def record_jobs(jobs):
+        if record_nns:
+            nnplan.save_plan(prefix, plan, {j["base"]: j["nn"] for j in jobs})
+
+    def new_job(rn, obj, seed):
+        nn = nns.get((rn, obj), NN)
+        return dict(
+            base=f"{prefix}_{rn}_{obj}_{seed}",
+            rn=rn,
+            obj=obj,
+            seed=seed,
+            nn=nn,
+            opts=sim_options(
+                parms, obj, isd_files[rn], seed, startseed, objshape, NN=nn
+            ),
+            cost=objsums[obj] * nn * yields[rn],
+            queued=time.time(),
+        )
+
+    jobs = []
     for seed in range(startseed, endseed):
         for obj in objs:
             for rn in parms["radionuclides"]:
-                isd_file = isd_files[rn]
-                print(f"running {prefix} {rn} {obj} {seed} nn={NN}")
-                opts = (
-                    f"/FA:1/FA:8/FD:{densmap}/FS:{obj}/PX:{pixsize}/RR:{seed}"
-                    f"/SD:{seed}/FI:{isd_file}/01:{parms['photon_energy']}"
-                    f"/02:{z_halflen}/05:{z_halflen}/28:{pixsize}/31:{pixsize}"
-                    f"/20:{parms['e_high']}/21:{parms['e_low']}/NN:{NN}/TR:5"
-                    f"/31:{pixsize}/29:{parms['nang']}/84:41/CA:{parms['score41_val']}/34:{zdim}"
-                    f"/76:{xdim}/77:{zdim}/78:{xdim}/79:{xdim}/81:{ydim}/82:{ydim}/83:-10"
+                jobs.append(new_job(rn, obj, seed))
+
+    # jobs that are split into shards, keyed by the base name of the whole job
+    sharded = {}
+    shard_target = None
+    if max_shards > 1 and queuedir is not None:
+        print("--shards is ignored with --queue")
+    elif max_shards > 1:
+        # split jobs that would take more than half of the time each process
+        # needs if the work was spread evenly
+        shard_target = sum(j["cost"] for j in jobs) / (2 * maxproc)
+
+    def split(job):
+        """Return the jobs to run for 'job': itself or its shards"""
+        if shard_target is None:
+            return [job]
+        k = shards.num_shards(job["cost"], shard_target, job["nn"], max_shards)
+        if k == 1:
+            return [job]
+        nns = shards.split_nn(job["nn"], k)
+        sbs = [shards.shard_base(job["base"], i) for i in range(len(nns))]
+        sharded[job["base"]] = dict(job, shards=sbs, nns=nns)
+        runs = []
+        for i, (sb, nn) in enumerate(zip(sbs, nns, strict=True)):
+            opts = sim_options(
+                parms,
+                job["obj"],
+                isd_files[job["rn"]],
+                job["seed"],
+                startseed,
+                objshape,
+                NN=nn,
+                stream=shards.shard_stream(job["seed"], i),
+                save_atn=job["seed"] == startseed and i == 0,
+            )
+            cost = job["cost"] * nn / job["nn"]
+            runs.append(
+                dict(job, base=sb, parent=job["base"], nn=nn, opts=opts, cost=cost)
+            )
+        return runs
+
+    runs = [r for job in jobs for r in split(job)]
+    if sharded:
+        print(f"split {len(sharded)} jobs into shards")
+
+    if order == "longest":
+        # start the most expensive jobs first so a long job doesn't end up
+        # running alone at the end of the sweep. sorted() is stable, so equal
+        # cost jobs keep the seed order
+        runs = sorted(runs, key=lambda j: -j["cost"])
+
+    simind = parms["simind"]
+    if metrics_file is None:
+        metrics_file = f"{prefix}_metrics.jsonl"
+    if queuedir is not None:
+        queued = []
+        for job in runs:
+            base = job["base"]
+            if exists(f"{base}.res"):
+                print("skipping", prefix, job["obj"], job["seed"])
+                continue
+            job["cmd"] = f"{simind} voxphan{job['opts']} {base} > {base}.log 2>&1"
+            if pack:
+                script = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)), "impack.py"
                 )
-                # this saves an aligned attenuation map only for the start seed
-                opts += "/FA:15" if seed != startseed else "/TR:15"
-                opts += f"/84:41/fw:{ewin_file}"
-                base = f"{prefix}_{rn}_{obj}_{seed}"
-                cmd = f"{simind} voxphan{opts}/CC:{parms['collimator']} {base} >& {base}.log"
-                if not exists(f"{base}.log") and not exists(f"{base}.res"):
-                    print(cmd)
-                    with open(f"{base}.log", "w") as fp:
-                        fp.write("\n")
-                    runcmd(cmd, maxruns=maxproc)
-                    sleep(1)
-                else:
-                    print("skipping", prefix, obj, seed)
-
-    waitall()
+                job["cmd"] += f" && {shlex.quote(script)} pack {base}"
+            job["cwd"] = os.getcwd()
+            job["env"] = {"SMC_DIR": parms["smc_dir"]}
+            # the worker that runs the job appends its metrics record
+            job["metrics"] = dict(
+                file=os.path.abspath(metrics_file),
+                fields=dict(
+                    rn=job["rn"],
+                    obj=job["obj"],
+                    seed=job["seed"],
+                    nn=job["nn"],
+                    nang=parms["nang"],
+                    photons=float(objsums[job["obj"]] * job["nn"]),
+                ),
+            )
+            queued.append(job)
+        record_jobs(queued)
+        n = simqueue.add_jobs(queuedir, queued)
+        print(f"added {n} jobs to {queuedir}")
+        return
+
+    if dbfile is None:
+        dbfile = f"{prefix}_jobs.db"
+    db = JobDB(dbfile)
+    n = db.reset(failed=retry_failed)
+    if n > 0:
+        print(f"requeued {n} failed or interrupted jobs from {dbfile}")
+
+    def will_run(job):
+        row = db.get(job["base"])
+        if row is None:
+            return not exists(f"{job['base']}.res")
+        return row["state"] != "done"
+
+    # the NN of the jobs that will be run is recorded so the seeds can be
+    # weighted by their NN when they are averaged
+    record_jobs([j for j in jobs if will_run(j)])
+
+    def db_state(job, opts=None):
+        base = job["base"]
+        if db.get(base) is None and exists(f"{base}.res"):
+            # finished before this sweep used the job database
+            db.add(base, job["rn"], job["obj"], job["seed"], job["nn"], opts, "done")
+        return db.add(base, job["rn"], job["obj"], job["seed"], job["nn"], opts)
+
+    # adaptive seeding: per (radionuclide, object) group the running statistics
+    # of the total projection in each window, the seeds used so far and the
+    # number of those seeds that have not finished
+    adaptive = noise_target is not None
+    group_stats = {}
+    group_seeds = {}
+    group_open = {}
+    for job in jobs:
+        g = (job["rn"], job["obj"])
+        group_seeds.setdefault(g, set()).add(job["seed"])
+        group_open[g] = group_open.get(g, 0) + 1
+
+    todo = deque(runs)
+
+    def pack_job(job, ok):
+        if not pack or not ok:
+            return
+        try:
+            impack.pack(job["base"])
+        except (OSError, imio.error) as e:
+            print(f"error packing {job['base']}: {e}")
+
+    def window_files(base):
+        files = sorted(glob(escape(base) + ".w[0-9][0-9].im"))
+        if len(files) == 0 and exists(impack.pack_file(base)):
+            p = impack.open_pack(impack.pack_file(base))
+            d = os.path.dirname(base)
+            files = sorted(os.path.join(d, n) for n in p.names(component="total"))
+        return files
+
+    def job_complete(job, ok):
+        """Called once for every whole (unsharded or merged) job that ends"""
+        if not adaptive:
+            pack_job(job, ok)
+            return
+        g = (job["rn"], job["obj"])
+        group_open[g] -= 1
+        if ok:
+            stats = group_stats.setdefault(g, {})
+            for f in window_files(job["base"]):
+                window = f[len(job["base"]) :]
+                try:
+                    stats.setdefault(window, RunningStats()).add(
+                        impack.read(f), weight=job["nn"]
+                    )
+                except (imio.error, ValueError) as e:
+                    print(f"error adding {f} to the noise estimate: {e}")
+        pack_job(job, ok)
+        if group_open[g] > 0:
+            return
+        # all seeds of the group are done: decide if more are needed
+        stats = group_stats.get(g, {})
+        if len(stats) == 0:
+            print(f"no projections found for {g}: not adding seeds")
+            return
+        n = min(s.n for s in stats.values())
+        noise = max(s.rel_noise() for s in stats.values())
+        nseeds = len(group_seeds[g])
+        if noise <= noise_target:
+            print(f"{g[0]} {g[1]}: relative noise {noise:.4f} with {n} seeds: done")
+            return
+        if nseeds >= max_seeds:
+            print(
+                f"{g[0]} {g[1]}: relative noise {noise:.4f} with {n} seeds: "
+                f"reached --max-seeds={max_seeds}"
+            )
+            return
+        # the noise of the mean goes as 1/sqrt(seeds)
+        if np.isfinite(noise):
+            needed = int(np.ceil(n * (noise / noise_target) ** 2)) - n
+        else:
+            needed = 1
+        needed = max(1, min(needed, max_seeds - nseeds))
+        print(
+            f"{g[0]} {g[1]}: relative noise {noise:.4f} with {n} seeds: "
+            f"adding {needed} seeds"
+        )
+        added = []
+        for _ in range(needed):
+            seed = max(group_seeds[g]) + 1
+            group_seeds[g].add(seed)
+            group_open[g] += 1
+            added.append(new_job(g[0], g[1], seed))
+            todo.extend(split(added[-1]))
+        record_jobs(added)
+
+    # shards of each sharded job that still have to finish
+    unfinished = {}
+
+    def merge(parent):
+        pjob = sharded[parent]
+        ok = shards.merge_shards(parent, pjob["shards"], pjob["nns"])
+        outputs = sorted(glob(escape(parent) + ".*"))
+        db.finish(parent, 0 if ok else 1, outputs=outputs)
+        del unfinished[parent]
+        job_complete(pjob, ok)
+
+    def shard_finished(job, ok):
+        parent = job["parent"]
+        if parent not in unfinished:
+            return
+        if not ok:
+            # the whole job failed; the other shards are left for a rerun
+            db.finish(parent, 1)
+            del unfinished[parent]
+            job_complete(sharded[parent], False)
+            return
+        unfinished[parent].discard(job["base"])
+        if len(unfinished[parent]) == 0:
+            merge(parent)
+
+    run_of = {}
+
+    def job_done(pj):
+        job = run_of[pj.key]
+        rec = metrics.job_record(
+            pj,
+            rn=job["rn"],
+            obj=job["obj"],
+            seed=job["seed"],
+            nn=job["nn"],
+            nang=parms["nang"],
+            photons=objsums[job["obj"]] * job["nn"],
+            maxproc=maxproc,
+        )
+        metrics.append(metrics_file, rec)
+        outputs = sorted(glob(escape(pj.key) + ".*"))
+        db.finish(pj.key, pj.returncode, end=pj.end, outputs=outputs)
+        if pj.returncode != 0:
+            print(f"{pj.key} failed with status {pj.returncode}")
+        job = run_of.pop(pj.key)
+        if "parent" in job:
+            shard_finished(job, pj.returncode == 0)
+        else:
+            job_complete(job, pj.returncode == 0)
+
+    seen_parents = set()
+    pool = JobPool(maxruns=maxproc)
+    while True:
+        if len(todo) == 0:
+            # finished jobs can add more seeds to todo
+            if pool.wait_one() is None:
+                break
+            continue
+        job = todo.popleft()
+        base = job["base"]
+        parent = job.get("parent")
+        if parent is not None and parent not in seen_parents:
+            seen_parents.add(parent)
+            pjob = sharded[parent]
+            if db_state(pjob) == "done":
+                print("skipping", prefix, pjob["obj"], pjob["seed"], "done")
+                job_complete(pjob, True)
+            else:
+                shards.write_manifest(parent, pjob["shards"], pjob["nns"])
+                unfinished[parent] = set(pjob["shards"])
+        if parent is not None and parent not in unfinished:
+            continue
+        state = db_state(job, job["opts"])
+        if state != "pending":
+            print("skipping", prefix, job["obj"], job["seed"], state)
+            if parent is not None:
+                shard_finished(job, state == "done")
+            else:
+                job_complete(job, state == "done")
+            continue
+        cmd = f"{simind} voxphan{job['opts']} {base} > {base}.log 2>&1"
+        print(f"running {prefix} {job['rn']} {job['obj']} {job['seed']} nn={job['nn']}")
+        print(cmd)
+        run_of[base] = job
+        pj = pool.submit(cmd, key=base, queued=job["queued"], on_exit=job_done)
+        db.start(base, cmd, pid=pj.pid, start=pj.start)
+
+    print(f"job states: {db.counts()}")
 
 
 if __name__ == "__main__":
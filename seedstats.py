@@ -0,0 +1,90 @@
+"""
+Running per-pixel statistics of images from independent simulation seeds.
+"""
+
+import numpy as np
+
+
+class RunningStats:
+    """Per-pixel running sum and sum of squares of a set of images
+
+    Images are added one at a time with add(). The mean, sample variance and
+    standard error of the mean can be computed at any time, so statistics
+    can be updated as seeds finish without rereading earlier seeds.
+
+    Images can be given weights, e.g. the NN of the seed, when their
+    variances are inversely proportional to them. The mean is then the
+    weighted mean, var() the variance of an image with the average weight
+    and sem() the standard error of the weighted mean.
+    """
+
+    def __init__(self, shape=None):
+        self.n = 0
+        self.wsum = 0.0
+        self.sum = None if shape is None else np.zeros(shape, dtype=np.float64)
+        self.sumsq = None if shape is None else np.zeros(shape, dtype=np.float64)
+
+    def add(self, pix, slab=16, weight=1.0):
+        """Add an image. pix can be a memmap; it is read 'slab' planes at a
+        time so no float64 copy of the whole image is made"""
+        if self.sum is None:
+            self.sum = np.zeros(pix.shape, dtype=np.float64)
+            self.sumsq = np.zeros(pix.shape, dtype=np.float64)
+        elif pix.shape != self.sum.shape:
+            raise ValueError(f"image shape {pix.shape} != {self.sum.shape}")
+        for i in range(0, max(len(pix), 1), slab):
+            p = np.asarray(pix[i : i + slab], dtype=np.float64)
+            self.sum[i : i + slab] += weight * p
+            self.sumsq[i : i + slab] += weight * p * p
+        self.n += 1
+        self.wsum += weight
+
+    def mean(self):
+        return self.sum / self.wsum
+
+    def var(self):
+        """Sample variance of the images (0 if there is only 1 image)"""
+        if self.n < 2:
+            return np.zeros_like(self.sum)
+        m = self.mean()
+        # variance of an image of weight 1, scaled to the average weight
+        v = (self.sumsq - self.wsum * m * m) / (self.n - 1) * (self.n / self.wsum)
+        # round off can make it slightly negative
+        return np.maximum(v, 0.0)
+
+    def sem(self):
+        """Standard error of the mean"""
+        return np.sqrt(self.var() / self.n)
+
+    def rel_noise(self, frac=0.1):
+        """Relative noise (standard error / mean) of the mean image
+
+        Returns the median over the pixels whose mean is at least 'frac'
+        times the maximum, so empty background pixels don't count. Returns
+        inf with fewer than 2 images since the noise can't be estimated.
+        """
+        if self.n < 2:
+            return np.inf
+        m = self.mean()
+        mask = m >= frac * m.max()
+        if m.max() <= 0 or not mask.any():
+            return np.inf
+        return float(np.median(self.sem()[mask] / m[mask]))
+
+    @classmethod
+    def from_mean_var(cls, n, mean, var, wsum=None):
+        """Restart the running sums from a saved mean and sample variance
+
+        wsum is the sum of the weights (default n, i.e. unweighted).
+        """
+        stats = cls()
+        mean = np.asarray(mean, dtype=np.float64)
+        if wsum is None:
+            wsum = n
+        stats.n = n
+        stats.wsum = float(wsum)
+        stats.sum = wsum * mean
+        stats.sumsq = wsum * mean * mean
+        if n > 1:
+            stats.sumsq += (n - 1) * (wsum / n) * np.asarray(var, dtype=np.float64)
+        return stats
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+"""
+Split one simulation into shards with fewer photons and merge the results.
+
+A shard of {base} is run with NN_i photons per source count, its own random
+number stream and the output base name shards/{base}.sNN. When all shards
+have finished, the images (total and score 41 components for every window)
+and .bis spectra are averaged with weights NN_i / NN into {base}.*, i.e.
+the same files a single run with NN would have written. The simind outputs
+are normalized per MBq, so this is the same as one run with all photons.
+The .res and .log files of the shards are concatenated and other outputs
+(e.g. the aligned attenuation map) are taken from shard 0.
+
+A manifest, shards/{base}.shards.json, lists the shards and their NN so
+that an interrupted merge can be redone with
+
+    shards.py BASE [BASE ...]
+"""
+
+import json
+import math
+import os
+from os.path import basename, dirname, exists, join
+from glob import glob, escape
+from sys import argv, exit
+import numpy as np
+import imio
+
+SHARD_DIR = "shards"
+
+# streams of shards must not overlap with those of unsharded seeds (which
+# use the seed as the stream number) or with those of other seeds
+SHARD_STREAM_OFFSET = 100000
+MAX_SHARDS = 100
+
+
+def split_nn(NN, nshards):
+    """Split NN into nshards positive integers that add up to NN"""
+    nshards = max(1, min(nshards, NN, MAX_SHARDS))
+    q, r = divmod(NN, nshards)
+    return [q + 1 if i < r else q for i in range(nshards)]
+
+
+def num_shards(cost, target, NN, max_shards):
+    """Number of shards needed so each one costs about 'target' or less"""
+    if target <= 0 or max_shards <= 1:
+        return 1
+    return max(1, min(math.ceil(cost / target), max_shards, NN, MAX_SHARDS))
+
+
+def shard_base(base, i):
+    return join(dirname(base), SHARD_DIR, f"{basename(base)}.s{i:02d}")
+
+
+def shard_stream(seed, i):
+    return SHARD_STREAM_OFFSET + seed * MAX_SHARDS + i
+
+
+def manifest_path(base):
+    return join(dirname(base), SHARD_DIR, f"{basename(base)}.shards.json")
+
+
+def write_manifest(base, shard_bases, nns):
+    os.makedirs(join(dirname(base), SHARD_DIR), exist_ok=True)
+    with open(manifest_path(base), "w") as fp:
+        json.dump(dict(base=base, shards=shard_bases, nn=nns), fp, indent=1)
+
+
+def read_manifest(base):
+    with open(manifest_path(base), "r") as fp:
+        m = json.load(fp)
+    return m["shards"], m["nn"]
+
+
+def merge_shards(base, shard_bases=None, nns=None, remove=True):
+    """Merge the outputs of the shards of 'base'. Returns True on success"""
+    if shard_bases is None:
+        shard_bases, nns = read_manifest(base)
+    for sb in shard_bases:
+        if not exists(f"{sb}.res"):
+            print(f"{sb}.res is missing: can't merge {base}")
+            return False
+    weights = np.array(nns, dtype=np.float64) / float(sum(nns))
+    first = shard_bases[0]
+    suffixes = [f[len(first) :] for f in glob(escape(first) + ".*")]
+    for suffix in sorted(suffixes):
+        outf = base + suffix
+        files = [sb + suffix for sb in shard_bases]
+        if suffix in [".res", ".log"]:
+            continue
+        if suffix.endswith(".im"):
+            total = None
+            for f, w in zip(files, weights, strict=True):
+                try:
+                    pix = imio.read(f)
+                except imio.error as e:
+                    print(f"error reading {f}: {e}")
+                    return False
+                if total is None:
+                    total = w * pix.astype(np.float64)
+                elif pix.shape != total.shape:
+                    print(f"image {f} has a different size than {files[0]}")
+                    return False
+                else:
+                    total += w * pix
+            # copy the header of a shard to the merged image
+            try:
+                imio.write_like(total, outf, files[0])
+            except imio.error as e:
+                print(f"error writing {outf}: {e}")
+                return False
+        elif suffix.endswith(".bis"):
+            total = None
+            for f, w in zip(files, weights, strict=True):
+                spec = np.fromfile(f, dtype=np.float32).astype(np.float64)
+                if total is not None and spec.shape != total.shape:
+                    print(f"spectrum {f} has a different size than {files[0]}")
+                    return False
+                total = w * spec if total is None else total + w * spec
+            total.astype(np.float32).tofile(outf)
+        else:
+            os.replace(files[0], outf)
+    # the .res file is written last since it marks the job as finished
+    for suffix in [".log", ".res"]:
+        with open(base + suffix, "w") as out:
+            for sb, nn in zip(shard_bases, nns, strict=True):
+                if exists(sb + suffix):
+                    out.write(f"# shard {sb} NN={nn}\n")
+                    with open(sb + suffix, "r", errors="replace") as fp:
+                        out.write(fp.read())
+    if remove:
+        for sb in shard_bases:
+            for f in glob(escape(sb) + ".*"):
+                os.unlink(f)
+        os.unlink(manifest_path(base))
+    print(f"merged {len(shard_bases)} shards into {base}")
+    return True
+
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print("Usage: shards.py base [base ...]")
+        print("\nMerges the shards of simulations listed in shards/{base}.shards.json")
+        exit(1)
+    ok = True
+    for base in argv[1:]:
+        if not exists(manifest_path(base)):
+            print(f"no shard manifest for {base}")
+            ok = False
+            continue
+        ok = merge_shards(base) and ok
+    exit(0 if ok else 1)
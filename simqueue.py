@@ -0,0 +1,344 @@
+#! /usr/bin/env python3
+"""
+Work queue for running simulations on several hosts that share a directory.
+
+runspectsims.py --queue QUEUEDIR writes one job file per simulation to
+QUEUEDIR/pending. Any number of workers started with
+
+    simqueue.py worker QUEUEDIR
+
+on any host that mounts QUEUEDIR (and the simulation directory at the same
+path) claim jobs and run them. The queue directory contains:
+
+  pending/NAME.job   jobs waiting to be run (json: base, cmd, cwd, env)
+  claimed/NAME.job   jobs that a worker is running
+  leases/NAME.lease  one per claimed job. Created with O_EXCL, so only one
+                     worker can claim a job. Its mtime is renewed by the
+                     worker while the job runs
+  done/NAME.job      finished jobs with the exit status, host and times
+  failed/NAME.job    jobs that exited with a non-zero status
+
+A job with a 'metrics' entry (file and fields) gets a metrics.py record,
+with the rusage of the job from wait4(), appended to that file by the
+worker that ran it.
+
+A lease whose mtime is older than the lease time belongs to a worker that
+died or lost the directory; its job is moved back to pending. A worker that
+finds its lease gone kills its copy of the job so two hosts never write the
+same outputs.
+"""
+
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from os.path import exists, join
+from multiprocessing import cpu_count
+import click
+from runcmd import JobPool
+import metrics
+
+SUBDIRS = ["pending", "claimed", "leases", "done", "failed"]
+
+
+def job_name(base):
+    # the base name can include a directory
+    return base.replace("/", "%")
+
+
+def init_queue(qdir):
+    for d in SUBDIRS:
+        os.makedirs(join(qdir, d), exist_ok=True)
+
+
+def write_json(path, obj):
+    # write to a temporary name and rename so readers never see a partial file
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(obj, fp, indent=1)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def add_jobs(qdir, jobs):
+    """Write jobs to the queue. Each job is a dict with at least base and cmd
+
+    Jobs that are already pending, claimed or done are not added again.
+    Returns the number of jobs added.
+    """
+    init_queue(qdir)
+    added = 0
+    for job in jobs:
+        name = job_name(job["base"]) + ".job"
+        if any(exists(join(qdir, d, name)) for d in ["pending", "claimed", "done"]):
+            continue
+        job = dict(job, created=time.time())
+        write_json(join(qdir, "pending", name), job)
+        added += 1
+    return added
+
+
+def lease_path(qdir, name):
+    return join(qdir, "leases", name[: -len(".job")] + ".lease")
+
+
+def lease_owner(qdir, name):
+    try:
+        with open(lease_path(qdir, name), "r") as fp:
+            return fp.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def claim_next(qdir):
+    """Claim the next pending job. Returns (name, job, token) or None
+
+    token identifies this claim; it is written to the lease file.
+    """
+    for name in sorted(os.listdir(join(qdir, "pending"))):
+        if not name.endswith(".job"):
+            continue
+        lease = lease_path(qdir, name)
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        token = f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+        with os.fdopen(fd, "w") as fp:
+            fp.write(token + "\n")
+        try:
+            os.rename(join(qdir, "pending", name), join(qdir, "claimed", name))
+        except FileNotFoundError:
+            # someone else finished or requeued it between listdir and here
+            os.unlink(lease)
+            continue
+        return name, read_json(join(qdir, "claimed", name)), token
+    return None
+
+
+def requeue_expired(qdir, lease_time):
+    """Move jobs whose lease has not been renewed within lease_time back to
+    pending. Returns the names of the requeued jobs"""
+    requeued = []
+    now = time.time()
+    for lease in os.listdir(join(qdir, "leases")):
+        if not lease.endswith(".lease"):
+            continue
+        path = join(qdir, "leases", lease)
+        try:
+            if now - os.stat(path).st_mtime < lease_time:
+                continue
+            # renaming the lease away is atomic, so only one worker requeues it
+            tomb = f"{path}.{uuid.uuid4().hex}.expired"
+            os.rename(path, tomb)
+        except FileNotFoundError:
+            continue
+        name = lease[: -len(".lease")] + ".job"
+        try:
+            os.rename(join(qdir, "claimed", name), join(qdir, "pending", name))
+            requeued.append(name)
+        except FileNotFoundError:
+            pass
+        os.unlink(tomb)
+    return requeued
+
+
+def queue_counts(qdir):
+    return {
+        d: len([f for f in os.listdir(join(qdir, d)) if f.endswith((".job", ".lease"))])
+        for d in SUBDIRS
+    }
+
+
+class LeaseKeeper(threading.Thread):
+    """Renew the leases of the jobs a worker is running
+
+    The main thread is blocked in wait4() while jobs run, so renewal is done
+    from this thread. If a lease has disappeared or now belongs to another
+    claim, the job was requeued and the process group of our copy is killed.
+    """
+
+    def __init__(self, qdir, interval):
+        super().__init__(daemon=True)
+        self.qdir = qdir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.lost = set()
+        self.stopping = threading.Event()
+
+    def add(self, name, job, token):
+        with self.lock:
+            self.jobs[name] = (job, token)
+
+    def remove(self, name):
+        with self.lock:
+            self.jobs.pop(name, None)
+            self.lost.discard(name)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            with self.lock:
+                jobs = list(self.jobs.items())
+            for name, (job, token) in jobs:
+                try:
+                    if lease_owner(self.qdir, name) != token:
+                        raise FileNotFoundError(name)
+                    os.utime(lease_path(self.qdir, name))
+                except FileNotFoundError:
+                    print(f"lost the lease for {name}: killing {job.pid}")
+                    with self.lock:
+                        self.lost.add(name)
+                    try:
+                        os.killpg(job.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+    def stop(self):
+        self.stopping.set()
+
+
+def finish_job(qdir, keeper, name, token, record, job, maxproc=None):
+    lost = name in keeper.lost or lease_owner(qdir, name) != token
+    keeper.remove(name)
+    if lost:
+        # the job was requeued while we ran it; leave it to its new owner
+        return
+    record.update(
+        host=socket.gethostname(),
+        returncode=job.returncode,
+        start=job.start,
+        end=job.end,
+    )
+    dest = "done" if job.returncode == 0 else "failed"
+    write_json(join(qdir, "claimed", name), record)
+    os.rename(join(qdir, "claimed", name), join(qdir, dest, name))
+    try:
+        os.unlink(lease_path(qdir, name))
+    except FileNotFoundError:
+        pass
+    if "metrics" in record:
+        m = record["metrics"]
+        try:
+            metrics.append(
+                m["file"], metrics.job_record(job, maxproc=maxproc, **m["fields"])
+            )
+        except OSError as e:
+            print(f"error writing the metrics of {record['base']}: {e}")
+    print(f"{record['base']} {dest} status={job.returncode}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="maximum number of jobs to run on this host (default is number of CPUs)",
+)
+@click.option(
+    "--lease",
+    "lease_time",
+    type=float,
+    default=300.0,
+    help="seconds without a renewal after which a claimed job is requeued",
+)
+@click.option(
+    "--poll",
+    type=float,
+    default=10.0,
+    help="seconds to wait before looking for new jobs when the queue is empty",
+)
+@click.option(
+    "--wait/--no-wait",
+    default=False,
+    help="keep waiting for new jobs when the queue is empty",
+)
+@click.argument("qdir", type=click.Path(exists=True, file_okay=False))
+def worker(qdir, maxproc, lease_time, poll, wait):
+    """Run jobs from the queue in QDIR"""
+    if maxproc is None:
+        maxproc = cpu_count()
+    init_queue(qdir)
+    pool = JobPool(maxruns=maxproc)
+    keeper = LeaseKeeper(qdir, lease_time / 3.0)
+    keeper.start()
+    print(f"worker {socket.gethostname()}:{os.getpid()} running up to {maxproc} jobs")
+    while True:
+        for name in requeue_expired(qdir, lease_time):
+            print(f"requeued expired job {name}")
+        while len(pool) < maxproc:
+            claimed = claim_next(qdir)
+            if claimed is None:
+                break
+            name, record, token = claimed
+            env = dict(os.environ)
+            env.update(record.get("env", {}))
+            print(f"running {record['base']}")
+            job = pool.submit(
+                record["cmd"],
+                rundir=record.get("cwd"),
+                key=record["base"],
+                queued=record.get("created"),
+                on_exit=lambda j, n=name, t=token, r=record: finish_job(
+                    qdir, keeper, n, t, r, j, maxproc
+                ),
+                env=env,
+                start_new_session=True,
+            )
+            keeper.add(name, job, token)
+        if len(pool) > 0:
+            pool.wait_one()
+            continue
+        counts = queue_counts(qdir)
+        if counts["pending"] == 0 and counts["claimed"] == 0 and not wait:
+            break
+        # other workers still hold jobs that may expire, or we wait for more
+        time.sleep(poll)
+    keeper.stop()
+    print(f"queue empty: {queue_counts(qdir)}")
+
+
+@cli.command()
+@click.argument("qdir", type=click.Path(exists=True, file_okay=False))
+def status(qdir):
+    """Print the number of jobs in each state"""
+    counts = queue_counts(qdir)
+    for d in SUBDIRS:
+        print(f"{d}: {counts[d]}")
+
+
+@cli.command()
+@click.option("--failed", is_flag=True, help="also requeue jobs that failed")
+@click.option(
+    "--lease",
+    "lease_time",
+    type=float,
+    default=300.0,
+    help="seconds without a renewal after which a claimed job is requeued",
+)
+@click.argument("qdir", type=click.Path(exists=True, file_okay=False))
+def requeue(qdir, failed, lease_time):
+    """Requeue expired (and optionally failed) jobs"""
+    n = len(requeue_expired(qdir, lease_time))
+    if failed:
+        for name in os.listdir(join(qdir, "failed")):
+            if name.endswith(".job"):
+                os.rename(join(qdir, "failed", name), join(qdir, "pending", name))
+                n += 1
+    print(f"requeued {n} jobs")
+
+
+if __name__ == "__main__":
+    cli()
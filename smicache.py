@@ -0,0 +1,126 @@
+"""
+Cache of the raw uint16 copies of source maps and density maps.
+
+simind reads source and density maps as raw uint16 files, {obj}.smi and
+{densmap}.dmi. Each one is written together with a sidecar, e.g.
+{obj}.smi.json, that records a content hash of the .im it was made from
+and what was learned while converting it: shape, sum, min, max and
+whether any voxel didn't fit in uint16 (negative, above 65535 or not an
+integer).
+
+When the .im has the same size and mtime as recorded, the sidecar is used
+without reading the image. When the mtime changed the image is hashed and
+if the contents changed (or the raw file is missing or has the wrong
+size) it is converted again, so a simulation never uses a stale copy.
+"""
+
+import hashlib
+import json
+import os
+from os.path import exists, getsize
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import imio
+
+CACHE_VERSION = 1
+
+
+def content_hash(path, chunk=16 * 2**20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(chunk)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def sidecar(raw):
+    return f"{raw}.json"
+
+
+def convert(path, raw, digest=None):
+    """Write path as raw uint16 and return its info (also saved in the sidecar)"""
+    st = os.stat(path)
+    if digest is None:
+        digest = content_hash(path)
+    im = imio.ImFile(path)
+    total = 0.0
+    pmin = np.inf
+    pmax = -np.inf
+    overflow = False
+    tmp = f"{raw}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fp:
+        for _, _, slab in im.slabs():
+            total += float(slab.sum(dtype=np.float64))
+            pmin = min(pmin, float(slab.min()))
+            pmax = max(pmax, float(slab.max()))
+            out = slab.astype(np.uint16)
+            if not overflow and not np.array_equal(out, slab):
+                overflow = True
+            out.tofile(fp)
+    os.replace(tmp, raw)
+    info = dict(
+        version=CACHE_VERSION,
+        source=path,
+        hash=digest,
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        shape=list(im.shape),
+        sum=total,
+        min=pmin,
+        max=pmax,
+        overflow=overflow,
+        raw_size=getsize(raw),
+    )
+    with open(sidecar(raw) + ".tmp", "w") as fp:
+        json.dump(info, fp, indent=1)
+    os.replace(sidecar(raw) + ".tmp", sidecar(raw))
+    return info
+
+
+def cached(path, raw):
+    """Return (info, rebuilt) for the raw copy of path, converting if stale"""
+    try:
+        with open(sidecar(raw), "r") as fp:
+            info = json.load(fp)
+    except (OSError, ValueError):
+        info = None
+    st = os.stat(path)
+    if (
+        info is None
+        or info.get("version") != CACHE_VERSION
+        or not exists(raw)
+        or getsize(raw) != info["raw_size"]
+    ):
+        return convert(path, raw), True
+    if info["size"] == st.st_size and info["mtime_ns"] == st.st_mtime_ns:
+        return info, False
+    digest = content_hash(path)
+    if digest != info["hash"]:
+        return convert(path, raw, digest), True
+    # touched but not changed
+    info["mtime_ns"] = st.st_mtime_ns
+    with open(sidecar(raw), "w") as fp:
+        json.dump(info, fp, indent=1)
+    return info, False
+
+
+def _cached(args):
+    path, raw = args
+    try:
+        return cached(path, raw)
+    except (OSError, imio.error) as e:
+        return e, False
+
+
+def cached_all(pairs, maxproc=1):
+    """cached() for a list of (path, raw) in parallel
+
+    Returns a list of (info or exception, rebuilt) in the same order.
+    """
+    if maxproc <= 1 or len(pairs) <= 1:
+        return [_cached(p) for p in pairs]
+    with ProcessPoolExecutor(max_workers=min(maxproc, len(pairs))) as pool:
+        return list(pool.map(_cached, pairs))
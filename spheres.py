@@ -0,0 +1,225 @@
+"""
+Sphere VOIs in reconstructed images: fitting a sphere to hot voxels,
+summing the counts in a sphere and thresholds.
+
+Coordinates are in voxels. Arrays are indexed (z, y, x) and sphere centers
+are given as (x, y, z), as the centroid program prints them.
+"""
+
+import numpy as np
+
+
+def fit_sphere(points, weights=None):
+    """
+    Fit a sphere to a set of 3D points using least squares.
+
+    Parameters:
+        points (ndarray): Nx3 array of (x, y, z) coordinates.
+        weights (ndarray, optional): N-length array of weights for each point.
+
+    Returns:
+        center (ndarray): Estimated sphere center (cx, cy, cz).
+        radius (float): Estimated sphere radius.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    # Construct matrix A for linear system: [2x, 2y, 2z, 1]
+    A = np.hstack((2 * points, np.ones((points.shape[0], 1))))
+
+    # Compute vector f = x^2 + y^2 + z^2 for each point
+    f = np.sum(points**2, axis=1)
+
+    # Apply weights if provided: scaling the rows is the same as multiplying
+    # by diag(weights) without forming the NxN matrix
+    if weights is not None:
+        w = np.asarray(weights, dtype=np.float64)
+        A *= w[:, np.newaxis]
+        f *= w
+
+    # Solve least squares: A * c ~= f
+    # c contains [cx, cy, cz, constant]
+    c, *_ = np.linalg.lstsq(A, f, rcond=None)
+
+    # Extract center coordinates
+    center = c[:3]
+
+    # Compute radius using formula: r = sqrt(cx^2 + cy^2 + cz^2 + constant)
+    radius = np.sqrt(np.sum(center**2) + c[3])
+
+    return center, radius
+
+
+def _bounds(c, r, n):
+    return max(0, int(np.floor(c - r))), min(n, int(np.ceil(c + r)) + 1)
+
+
+def sphere_weights(shape, center, radius, subsample=4):
+    """Fraction of each voxel inside a sphere, for the sphere's bounding box
+
+    Returns (slices, weights) where weights has the shape of
+    array[slices]. Voxels entirely inside the sphere get 1 and voxels
+    entirely outside 0; voxels cut by the surface are sampled on a
+    subsample^3 grid.
+    """
+    cx, cy, cz = center
+    z0, z1 = _bounds(cz, radius + 0.5, shape[0])
+    y0, y1 = _bounds(cy, radius + 0.5, shape[1])
+    x0, x1 = _bounds(cx, radius + 0.5, shape[2])
+    slices = (slice(z0, z1), slice(y0, y1), slice(x0, x1))
+    dz = np.abs(np.arange(z0, z1) - cz)[:, np.newaxis, np.newaxis]
+    dy = np.abs(np.arange(y0, y1) - cy)[np.newaxis, :, np.newaxis]
+    dx = np.abs(np.arange(x0, x1) - cx)[np.newaxis, np.newaxis, :]
+    # distance of the nearest and farthest points of each voxel
+    near = (
+        np.maximum(dz - 0.5, 0) ** 2
+        + np.maximum(dy - 0.5, 0) ** 2
+        + np.maximum(dx - 0.5, 0) ** 2
+    )
+    far = (dz + 0.5) ** 2 + (dy + 0.5) ** 2 + (dx + 0.5) ** 2
+    r2 = radius * radius
+    weights = (far <= r2).astype(np.float64)
+    edge = np.argwhere((near < r2) & (far > r2))
+    if len(edge) > 0:
+        offs = (np.arange(subsample) + 0.5) / subsample - 0.5
+        oz, oy, ox = np.meshgrid(offs, offs, offs, indexing="ij")
+        offs = np.stack([oz.ravel(), oy.ravel(), ox.ravel()], axis=1)
+        pos = edge + np.array([z0, y0, x0]) - np.array([cz, cy, cx])
+        d2 = ((pos[:, np.newaxis, :] + offs[np.newaxis, :, :]) ** 2).sum(axis=2)
+        weights[tuple(edge.T)] = (d2 <= r2).mean(axis=1)
+    return slices, weights
+
+
+def sum_voxels_in_sphere(array, center, radius, partial=True):
+    """
+    Sum voxel values within a sphere of given center and radius.
+
+    Only the bounding box of the sphere is used. With partial, voxels cut
+    by the surface count with the fraction of their volume inside the
+    sphere, otherwise voxels count if their center is inside.
+
+    Parameters:
+        array (ndarray): 3D array of voxel intensities.
+        center (tuple): (cx, cy, cz) coordinates of sphere center.
+        radius (float): Sphere radius in voxel units.
+
+    Returns:
+        float: Sum of voxel values inside the sphere.
+    """
+    if partial:
+        slices, weights = sphere_weights(array.shape, center, radius)
+        return float(np.sum(array[slices] * weights, dtype=np.float64))
+    cx, cy, cz = center
+    z0, z1 = _bounds(cz, radius, array.shape[0])
+    y0, y1 = _bounds(cy, radius, array.shape[1])
+    x0, x1 = _bounds(cx, radius, array.shape[2])
+    z, y, x = np.ogrid[z0:z1, y0:y1, x0:x1]
+    mask = (x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2 <= radius * radius
+    return float(array[z0:z1, y0:y1, x0:x1][mask].sum(dtype=np.float64))
+
+
+def percentile(array, q):
+    """q-th percentile of array (linear interpolation like np.percentile)
+
+    Uses np.partition, which selects the 2 values needed in linear time
+    instead of sorting the whole array.
+    """
+    flat = np.asarray(array).ravel()
+    pos = (flat.size - 1) * q / 100.0
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, flat.size - 1)
+    part = np.partition(flat, [lo, hi])
+    return part[lo] + (part[hi] - part[lo]) * (pos - lo)
+
+
+def hot_threshold(array, q=None):
+    """Threshold for hot voxels: mean + 2 std, or the q-th percentile"""
+    if q is not None:
+        return percentile(array, q)
+    return array.mean() + 2 * array.std()
+
+
+def centroid(array):
+    """Intensity weighted centroid (x, y, z) of a 3D array"""
+    total = array.sum(dtype=np.float64)
+    zs = array.sum(axis=(1, 2), dtype=np.float64)
+    ys = array.sum(axis=(0, 2), dtype=np.float64)
+    xs = array.sum(axis=(0, 1), dtype=np.float64)
+    return (
+        float(xs @ np.arange(len(xs)) / total),
+        float(ys @ np.arange(len(ys)) / total),
+        float(zs @ np.arange(len(zs)) / total),
+    )
+
+
+def detect_spheres(array, threshold, min_voxels=4):
+    """Find hot spheres as the connected components above threshold
+
+    One labelling pass finds all spheres. Returns a list of dicts with the
+    intensity weighted center (x, y, z), the radius of a sphere with the
+    volume of the component and the number of voxels, largest first.
+    """
+    # scipy is only needed to detect spheres
+    from scipy import ndimage
+
+    labels, n = ndimage.label(array > threshold)
+    found = []
+    for i, sl in enumerate(ndimage.find_objects(labels), 1):
+        if sl is None:
+            continue
+        mask = labels[sl] == i
+        nvox = int(mask.sum())
+        if nvox < min_voxels:
+            continue
+        cz, cy, cx = ndimage.center_of_mass(np.where(mask, array[sl], 0))
+        found.append(
+            dict(
+                center=(cx + sl[2].start, cy + sl[1].start, cz + sl[0].start),
+                radius=float((3 * nvox / (4 * np.pi)) ** (1 / 3)),
+                voxels=nvox,
+            )
+        )
+    found.sort(key=lambda s: -s["voxels"])
+    return found
+
+
+def rot90_point(center, shape, k):
+    """Center (x, y, z) in an array of shape (z, y, x) after
+    np.rot90(array, k, axes=(1, 2))
+
+    Returns the center and the shape of the rotated array.
+    """
+    x, y, z = center
+    for _ in range(k % 4):
+        # one turn: new y = nx - 1 - x, new x = y
+        x, y = y, shape[2] - 1 - x
+        shape = (shape[0], shape[2], shape[1])
+    return np.array([x, y, z], dtype=np.float64), tuple(shape)
+
+
+def source_sphere(path, shape=None, k=3):
+    """Center (x, y, z) and radius of the sphere in a source map
+
+    The source map is read a slab at a time. The center is rotated by k
+    quarter turns with np.rot90(..., k, axes=(1, 2)), the orientation
+    create_atn.py gives the attenuation maps and so the recons (k=0 keeps
+    the orientation of the source map). If shape is given, the center and
+    radius are converted to the voxels of an image of that shape covering
+    the same field of view (e.g. a recon on a coarser grid).
+    """
+    import imio
+
+    im = imio.ImFile(path)
+    nvox = 0
+    sums = np.zeros(3)
+    for z0, _, slab in im.slabs():
+        idx = np.nonzero(slab > 0)
+        nvox += len(idx[0])
+        sums += [idx[2].sum(), idx[1].sum(), (idx[0] + z0).sum()]
+    if nvox == 0:
+        raise ValueError(f"{path} has no source voxels")
+    center, src_shape = rot90_point(sums / nvox, im.shape, k)
+    radius = (3 * nvox / (4 * np.pi)) ** (1 / 3)
+    if shape is not None:
+        f = np.array(shape[::-1], dtype=np.float64) / np.array(src_shape[::-1])
+        center = (center + 0.5) * f - 0.5
+        radius *= np.cbrt(np.prod(f))
+    return tuple(float(c) for c in center), float(radius)